@@ -0,0 +1,107 @@
+"""
+Admission control for the expensive part of /api/chat.
+
+At most ADMISSION_MAX_ACTIVE chat turns per worker run the classify / search /
+answer path at once; up to ADMISSION_QUEUE_MAX more wait for a slot, each for
+at most ADMISSION_QUEUE_TIMEOUT_MS. A request is shed (the caller answers it
+cheaply) when the queue is full, when its wait runs out, or right away when
+the recent time per turn says it could not get a slot in time. Disable with
+ADMISSION_CONTROL=0.
+"""
+
+import os
+import threading
+import time
+
+import metrics
+
+ADMISSION_CONTROL = os.getenv('ADMISSION_CONTROL', '1') == '1'
+ADMISSION_MAX_ACTIVE = int(os.getenv('ADMISSION_MAX_ACTIVE', '16'))
+ADMISSION_QUEUE_MAX = int(os.getenv('ADMISSION_QUEUE_MAX', '32'))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_MS', '3000'))
+# Completed turns needed before the expected wait is trusted for shedding on arrival
+ADMISSION_MIN_SAMPLES = int(os.getenv('ADMISSION_MIN_SAMPLES', '20'))
+# Sent as Retry-After with a shed response
+ADMISSION_RETRY_AFTER_S = int(os.getenv('ADMISSION_RETRY_AFTER_S', '5'))
+
+_cond = threading.Condition()
+_active = 0
+_waiting = 0
+
+
+class Rejected(Exception):
+    """The request was shed; reason is 'queue_full', 'predicted' or 'timeout'."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def _gauges():
+    metrics.set_gauge('admission.active', _active)
+    metrics.set_gauge('admission.queue_depth', _waiting)
+
+
+def _shed(reason: str):
+    metrics.incr('admission.shed')
+    metrics.incr(f'admission.shed_{reason}')
+    raise Rejected(reason)
+
+
+def expected_wait_ms(ahead: int) -> float:
+    """Estimated wait behind `ahead` queued turns: their typical duration spread over the slots."""
+    turn_ms = metrics.recent_percentile('admission.turn_ms', 50, min_samples=ADMISSION_MIN_SAMPLES)
+    return ahead * turn_ms / max(1, ADMISSION_MAX_ACTIVE)
+
+
+def acquire():
+    """Take a chat slot, waiting in the bounded queue if needed; raises Rejected when shed.
+
+    Returns the time the slot was taken (for release()), or None with admission control off.
+    """
+    global _active, _waiting
+    if not ADMISSION_CONTROL:
+        return None
+    t0 = time.perf_counter()
+    with _cond:
+        # Nobody may overtake requests already queued
+        if _active < ADMISSION_MAX_ACTIVE and not _waiting:
+            _active += 1
+            _gauges()
+            metrics.incr('admission.admitted')
+            return t0
+        if _waiting >= ADMISSION_QUEUE_MAX:
+            _shed('queue_full')
+        if expected_wait_ms(_waiting + 1) > ADMISSION_QUEUE_TIMEOUT_MS:
+            _shed('predicted')
+        _waiting += 1
+        _gauges()
+        deadline = t0 + ADMISSION_QUEUE_TIMEOUT_MS / 1000.0
+        try:
+            while _active >= ADMISSION_MAX_ACTIVE:
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    _shed('timeout')
+                _cond.wait(left)
+            _active += 1
+        finally:
+            _waiting -= 1
+            _gauges()
+    started = time.perf_counter()
+    metrics.observe('queue', (started - t0) * 1000)
+    metrics.incr('admission.admitted')
+    metrics.incr('admission.queued')
+    return started
+
+
+def release(started):
+    """Give back the slot taken by acquire() (no-op for None)."""
+    global _active
+    if started is None:
+        return
+    metrics.observe('admission.turn_ms', (time.perf_counter() - started) * 1000, per_request=False)
+    with _cond:
+        _active -= 1
+        _gauges()
+        _cond.notify()
+
@@ -11,11 +11,15 @@ from dotenv import load_dotenv
 from datetime import datetime
 import time
 import re
+import select
+import socket
 import requests
 from bs4 import BeautifulSoup
-from urllib.parse import urlparse, quote_plus, parse_qs, unquote
+from urllib.parse import urlparse, urljoin, quote_plus, parse_qs, unquote
 import logging
 import uuid
+import json
+from concurrent.futures import ThreadPoolExecutor, wait
 from scenarios import (
     list_scenarios,
     get_scenario,
@@ -23,7 +27,22 @@ from scenarios import (
     scenario_index,
     get_scenario_system_prompt,
     scenario_definitions_text,
+    match_scenario,
 )
+import profiling
+import metrics
+import recorder
+import page_cache
+import cache_warmer
+import prefetch
+import hedge
+import dedupe
+import ranking
+import http_cache
+import batch
+import admission
+import routing
+import degraded
 
 # Load environment variables
 load_dotenv()
@@ -35,6 +54,15 @@ app.logger.setLevel(logging.INFO)
 # Configure OpenAI
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
+# Upstream endpoints; overridable so benchmarks can point the app at local stand-ins
+# (OpenAI itself honours OPENAI_API_BASE)
+DDG_HTML_URL = os.getenv('DDG_HTML_URL', 'https://duckduckgo.com/html/')
+DDG_LITE_URL = os.getenv('DDG_LITE_URL', 'https://lite.duckduckgo.com/lite/')
+BING_SEARCH_URL = os.getenv('BING_SEARCH_URL', 'https://www.bing.com/search')
+READER_PROXY_URL = os.getenv('READER_PROXY_URL', 'https://r.jina.ai/')
+# When set, requests for https://harbour.space/... are sent to this origin instead (docs keep the real URL)
+SITE_ORIGIN = os.getenv('SITE_ORIGIN', '').rstrip('/')
+
 # System prompt for the chatbot
 SYSTEM_PROMPT = """You are a helpful assistant for Harbour.Space University in Barcelona. 
 You help prospective students learn about programmes, admissions, scholarships, and campus life.
@@ -54,6 +82,56 @@ WEB_ANSWER_PROMPT = (
     "Write in the user's language. Avoid guessing."
 )
 
+# Single-call mode: the answer completion also returns the scenario label via function calling,
+# replacing the separate classify_scenario round trip
+SINGLE_CALL_CLASSIFY = os.getenv('SINGLE_CALL_CLASSIFY', '0') == '1'
+
+SINGLE_CALL_PROMPT = (
+    "Reply by calling the `reply` function. Put your answer to the user in `answer` and label the latest user message "
+    "with exactly one scenario in `scenario`. If the message is unrelated to the university context use 'off_topic': "
+    "do not answer the off-topic question, politely explain that this chatbot is for university-related assistance only.\n"
+    "Scenario labels and descriptions:\n"
+)
+
+REPLY_FUNCTION = {
+    'name': 'reply',
+    'description': 'Send the answer to the user together with the scenario label of their message.',
+    'parameters': {
+        'type': 'object',
+        'properties': {
+            'scenario': {'type': 'string', 'enum': SCENARIO_NAMES},
+            'answer': {'type': 'string'},
+        },
+        'required': ['scenario', 'answer'],
+    },
+}
+
+# Reuse the client-sent active_scenario on follow-up turns instead of re-classifying
+STICKY_SCENARIO = os.getenv('STICKY_SCENARIO', '1') == '1'
+# Without a local topic match only follow-ups this short ("and for bachelors?") keep the active scenario
+STICKY_MAX_WORDS = int(os.getenv('STICKY_MAX_WORDS', '6'))
+# A follow-up continues the previous turn ("and ...", "what about ...") or points back at it ("is it ...")
+_FOLLOW_UP_RE = re.compile(
+    r'^\W*(?:(?:ok(?:ay)?|thanks?|yes|no)\W+)?(?:and|also|so|but|then|what about|how about|what if|и|а|ещ[её]|также|тогда)\b'
+    r'|\b(?:it|its|that|this|these|those|there|they|them|the same|это|этого|там|они|их)\b',
+    re.I)
+
+# Client-side OpenAI timeouts: base seconds per model plus a budget per requested completion token
+OPENAI_TIMEOUT_BASE = {
+    k: float(v) for k, v in
+    (item.split('=', 1) for item in os.getenv('OPENAI_TIMEOUT_BASE', 'gpt-3.5-turbo=5,gpt-4o-mini=8').split(',') if '=' in item)
+}
+OPENAI_TIMEOUT_DEFAULT_S = float(os.getenv('OPENAI_TIMEOUT_DEFAULT_S', '8'))
+OPENAI_TIMEOUT_PER_TOKEN_MS = float(os.getenv('OPENAI_TIMEOUT_PER_TOKEN_MS', '30'))
+OPENAI_TIMEOUT_MAX_S = float(os.getenv('OPENAI_TIMEOUT_MAX_S', '60'))
+# Optional hedged second completion when the first runs past the recent p95 (doubles cost for those calls)
+OPENAI_HEDGE = os.getenv('OPENAI_HEDGE', '0') == '1'
+OPENAI_HEDGE_PERCENTILE = float(os.getenv('OPENAI_HEDGE_PERCENTILE', '95'))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv('OPENAI_HEDGE_MIN_SAMPLES', '20'))
+# OpenAI calls get their own threads so they never queue behind page fetches, the warmer or
+# the prefetcher: one call and one hedge per admitted request
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', '0') or 0) or 2 * admission.ADMISSION_MAX_ACTIVE
+
 # Fallback responses for common questions when rate limited
 FALLBACK_RESPONSES = {
     'programmes': "Harbour.Space offers Master's degrees in Computer Science, Data Science, Cyber Security, and Digital Marketing. Type 'catalogue' to see all programmes!",
@@ -100,17 +178,59 @@ PROGRAMMES = [
 ]
 
 
+@app.before_request
+def _metrics_begin():
+    metrics.begin_request()
+
+
+@app.after_request
+def _metrics_end(response):
+    stages = metrics.end_request()
+    if stages:
+        response.headers['Server-Timing'] = metrics.server_timing_header(stages)
+    return response
+
+
+# Registered after _metrics_end so it runs first and compression shows in Server-Timing
+@app.after_request
+def _http_cache(response):
+    return http_cache.finish(response)
+
+
+@app.url_defaults
+def _static_version(endpoint, values):
+    if endpoint == 'static':
+        http_cache.version_static_url(app.static_folder, values)
+
+
+def start_background_workers():
+    """Start the page cache warmer and link prefetcher in this process (once per pid)."""
+    cache_warmer.ensure_started(lambda u: fetch_and_clean(u, use_cache=False), app.logger)
+    prefetch.ensure_started(lambda u: fetch_and_clean(u, use_cache=False), app.logger)
+
+
+@app.before_request
+def _start_background_workers():
+    # Once per process; also covers workers forked after the app was imported
+    start_background_workers()
+    prefetch.request_started()
+
+
+@app.teardown_request
+def _request_done(exc):
+    prefetch.request_finished()
+
+
 @app.route('/')
 def index():
     """Render the main chatbot page"""
-    return render_template('index.html')
+    return http_cache.conditional(app.make_response(render_template('index.html')))
 
 
 @app.route('/api/scenarios', methods=['GET'])
 def scenarios_list_route():
     """List available scenario templates"""
-    scenarios = scenario_index()
-    return jsonify({'scenarios': scenarios})
+    return http_cache.json_response('scenarios', lambda: {'scenarios': scenario_index()})
 
 
 @app.route('/api/scenarios/<name>', methods=['GET'])
@@ -119,7 +239,8 @@ def scenarios_get_route(name):
     scen = get_scenario(name)
     if not scen:
         return jsonify({'error': 'Scenario not found'}), 404
-    return jsonify({'scenario': scen})
+    # Keyed by the scenario, not the URL segment: any casing or alias of a name shares one entry
+    return http_cache.json_response(f"scenario:{scen['name']}", lambda: {'scenario': scen})
 
 
 @app.route('/api/chat', methods=['POST'])
@@ -130,7 +251,8 @@ def chat():
     Request JSON:
     {
         "message": "user message",
-        "history": [{"role": "user/assistant", "content": "..."}]
+        "history": [{"role": "user/assistant", "content": "..."}],
+        "citations": false  # optional: answer from several numbered sources
     }
     
     Response JSON:
@@ -140,11 +262,15 @@ def chat():
         "data": {...}  # Optional, for catalogue or embed types
     }
     """
+    slot = None
     try:
         data = request.json
         user_message = data.get('message', '').strip()
         image_data_url = (data.get('image') or '').strip()
         conversation_history = data.get('history', [])
+        client_scenario = (data.get('active_scenario') or '').strip().lower()
+        # Per-tab id from the browser; falls back to client address + user agent
+        session_id = (data.get('session_id') or '').strip()[:64] or f"{request.remote_addr}|{request.headers.get('User-Agent', '')}"
         rid = uuid.uuid4().hex[:8]
         app.logger.info(f"[{rid}] /api/chat start text='{user_message[:160]}' img={'yes' if image_data_url else 'no'} hist={len(conversation_history)}")
         
@@ -153,7 +279,7 @@ def chat():
         
         # Check for "catalogue" keyword
         if user_message.lower() in ['catalogue', 'catalog']:
-            return jsonify({
+            return http_cache.json_response('catalogue', lambda: {
                 'response': 'Here are our available programmes:',
                 'type': 'catalogue',
                 'data': {'programmes': PROGRAMMES}
@@ -186,24 +312,62 @@ def chat():
                 'type': 'text'
             })
 
-        # Classify the user's message into one scenario label (no keyword matching)
-        scenario_to_use = classify_scenario(user_message, image_data_url)
-        app.logger.info(f"[{rid}] scenario='{scenario_to_use or '-'}'")
+        # Past this point a turn costs OpenAI calls and page fetches: cap how many run at once
+        try:
+            slot = admission.acquire()
+        except admission.Rejected as e:
+            app.logger.info(f"[{rid}] shed reason={e.reason}")
+            return shed_response(user_message, client_scenario if client_scenario in SCENARIO_NAMES else '')
+
+        # Keep the client's active scenario on follow-ups unless the message looks like a topic switch
+        scenario_to_use, sticky_reason = sticky_scenario(client_scenario, user_message)
+        if scenario_to_use:
+            app.logger.info(f"[{rid}] scenario='{scenario_to_use}' (sticky: {sticky_reason})")
+            if not SINGLE_CALL_CLASSIFY:
+                metrics.incr('classifier.avoided')
+        elif not SINGLE_CALL_CLASSIFY:
+            # Classify the user's message into one scenario label (no keyword matching).
+            # In single-call mode the answer completion returns the label instead.
+            with metrics.timed('classify'):
+                scenario_to_use = classify_scenario(user_message, image_data_url)
+            metrics.incr('classifier.needed')
+            app.logger.info(f"[{rid}] scenario='{scenario_to_use or '-'}' (classified: {sticky_reason})")
         
         # Build messages for OpenAI
         messages = [{'role': 'system', 'content': SYSTEM_PROMPT}]
         # Try web retrieval (single-best page). Also allow explicit force with prefixes.
         web_doc = None
+        cited = []
+        cite = CITATION_MODE or bool(data.get('citations'))
+        t_retrieval = time.perf_counter()
         try:
             force_web = False
             q = user_message
-            if q.lower().startswith(('web:', 'найди:', 'lookup:', 'search:', 'find:')):
+            if q.lower().startswith(('web:', 'найди:', 'lookup:', 'search:', 'find:') + CITATION_PREFIXES):
                 force_web = True
+                cite = cite or q.lower().startswith(CITATION_PREFIXES)
                 q = q.split(':', 1)[1].strip() or user_message
             urls_in_text = extract_urls(user_message)
             app.logger.info(f"[{rid}] retrieval try force={force_web} urls_in_text={len(urls_in_text)} q='{q}'")
-            # Always attempt to collect relevant pages for any text query
-            docs = collect_web_docs(web_urls=urls_in_text if urls_in_text else None, query=(None if urls_in_text else q), max_sources=3)
+            # Decide whether this turn needs a web search at all
+            gate, gate_reason = retrieval_gate(q, scenario_to_use, conversation_history, force_web, bool(urls_in_text))
+            docs = []
+            if gate == 'reuse':
+                prev_url = previous_source_url(conversation_history)
+                try:
+                    prev_doc = fetch_and_clean(prev_url, max_chars=3000)
+                except Exception as e:
+                    prev_doc = None
+                    app.logger.info(f"[{rid}] reuse fetch error url={prev_url}: {e}")
+                if prev_doc and doc_covers_query(prev_doc, q):
+                    docs = [prev_doc]
+                else:
+                    gate, gate_reason = 'search', gate_reason + '; previous page does not cover the question'
+            if gate == 'search' and cite:
+                # Several sources answered with [n] citations instead of one page
+                sources_block, cited = citation_sources(urls_in_text or None, q)
+            elif gate == 'search':
+                docs = collect_web_docs(web_urls=urls_in_text if urls_in_text else None, query=(None if urls_in_text else q), max_sources=3)
             web_doc = choose_best_doc(docs, q)
             # If selected doc is too short, try targeted fallbacks
             if web_doc and len((web_doc.get('text') or '')) < 400 and q:
@@ -234,13 +398,38 @@ def chat():
             if web_doc:
                 web_excerpt = (web_doc.get('text') or '')[:2400]
                 app.logger.info(f"[{rid}] web doc chosen len={len(web_excerpt)} url={web_doc.get('url')}")
+                prefetch.note_used(web_doc.get('url'))
+                # Warm the pages this one links to; the next question usually goes there
+                queued = prefetch.schedule(session_id, web_doc, q, scenario_to_use or '')
+                if queued:
+                    app.logger.info(f"[{rid}] prefetch queued={queued} links={len(web_doc.get('links') or [])}")
                 messages.append({'role': 'system', 'content': WEB_ANSWER_PROMPT})
                 messages.append({'role': 'system', 'content': f"WEB PAGE: {web_doc.get('title','')} ({web_doc.get('url','')})\nCONTENT:\n{web_excerpt}"})
+            elif cited:
+                app.logger.info(f"[{rid}] citation sources={len(cited)} chars={len(sources_block)}")
+                for d in cited:
+                    prefetch.note_used(d.get('url'))
+                prefetch.schedule(session_id, cited[0], q, scenario_to_use or '')
+                messages.append({'role': 'system', 'content': CITATION_PROMPT})
+                messages.append({'role': 'system', 'content': f"WEB SOURCES:\n{sources_block}"})
             elif force_web:
                 messages.append({'role': 'system', 'content': 'No web page could be retrieved for the explicit web request.'})
         except Exception as e:
             app.logger.info(f"[{rid}] retrieval error: {e}")
             web_doc = None
+            cited = []
+            gate, gate_reason = 'search', f'error: {e}'
+        retrieval_ms = (time.perf_counter() - t_retrieval) * 1000
+        metrics.observe('retrieval', retrieval_ms)
+        metrics.incr(f'retrieval_gate.{gate}')
+        if gate == 'search':
+            metrics.observe('retrieval_gate.search_ms', retrieval_ms, per_request=False)
+            app.logger.info(f"[{rid}] retrieval gate=search reason='{gate_reason}' ms={retrieval_ms:.0f}")
+        else:
+            # Saved time is estimated from recent full searches on this worker
+            saved_ms = max(0.0, metrics.recent_percentile('retrieval_gate.search_ms', 50) - retrieval_ms)
+            metrics.observe('retrieval_gate.saved_ms', saved_ms, per_request=False)
+            app.logger.info(f"[{rid}] retrieval gate={gate} reason='{gate_reason}' ms={retrieval_ms:.0f} est_saved_ms={saved_ms:.0f}")
 
         # If a scenario is active, inject its system prompt to guide generation
         if scenario_to_use:
@@ -249,6 +438,8 @@ def chat():
                 messages.append({'role': 'system', 'content': f"[Scenario: {scenario_to_use}] {scen_prompt}"})
             else:
                 messages.append({'role': 'system', 'content': f"Answer strictly within the '{scenario_to_use}' domain."})
+        if SINGLE_CALL_CLASSIFY:
+            messages.append({'role': 'system', 'content': SINGLE_CALL_PROMPT + scenario_definitions_text()})
         messages.extend(conversation_history)
         # Build user content, supporting optional image
         if image_data_url:
@@ -262,41 +453,74 @@ def chat():
         else:
             messages.append({'role': 'user', 'content': user_message})
         
+        # Nobody is waiting for the answer any more: skip the most expensive call
+        if client_disconnected():
+            metrics.incr('openai.answer_cancelled')
+            app.logger.info(f"[{rid}] client disconnected before the answer call")
+            return jsonify({'error': 'Client disconnected'}), 499
+
         # Call OpenAI API with retry logic
         max_retries = 2
         retry_delay = 1
         
         for attempt in range(max_retries):
             try:
-                model = ('gpt-4o-mini' if image_data_url else 'gpt-3.5-turbo')
-                temp = 0.2 if web_doc else 0.7
-                app.logger.info(f"[{rid}] OpenAI call attempt={attempt+1} model={model} msgs={len(messages)} web={'yes' if web_doc else 'no'} max_tokens=500 temp={temp}")
-                response = openai.ChatCompletion.create(
-                    model=model,
-                    messages=messages,
-                    temperature=temp,
-                    max_tokens=500
-                )
+                # Re-routed on every attempt: a rate-limited model is swapped for its fallback
+                rt = routing.route(scenario_to_use or '', bool(image_data_url), bool(web_doc), bool(cited), messages)
+                model = rt['model']
+                app.logger.info(f"[{rid}] OpenAI call attempt={attempt+1} route={rt['name']} model={model} ({rt['reason']}) msgs={len(messages)} web={'yes' if web_doc else 'cited' if cited else 'no'} max_tokens={rt['max_tokens']} temp={rt['temperature']}")
+                t_answer = time.perf_counter()
+                extra = {'functions': [REPLY_FUNCTION], 'function_call': {'name': 'reply'}} if SINGLE_CALL_CLASSIFY else {}
+                with metrics.timed('answer'):
+                    response = openai_completion(
+                        'answer',
+                        should_stop=client_disconnected,
+                        model=model,
+                        messages=messages,
+                        temperature=rt['temperature'],
+                        max_tokens=rt['max_tokens'],
+                        **extra
+                    )
+                routing.record(rt, (time.perf_counter() - t_answer) * 1000, response)
                 break
-            except openai.error.RateLimitError:
+            except openai.error.Timeout:
+                routing.record(rt, (time.perf_counter() - t_answer) * 1000)
+                recorder.note_upstream('openai', 'answer', 504, '', (time.perf_counter() - t_answer) * 1000)
+                app.logger.info(f"[{rid}] OpenAI timeout after {(time.perf_counter() - t_answer):.1f}s")
+                return jsonify(degraded_response(user_message, scenario_to_use))
+            except openai.error.RateLimitError as e:
+                routing.note_rate_limited(model, retry_after_s(e))
+                recorder.note_upstream('openai', 'answer', 429, '', (time.perf_counter() - t_answer) * 1000)
                 if attempt < max_retries - 1:
                     time.sleep(retry_delay)
                     retry_delay *= 2
                 else:
-                    # Use fallback response
-                    fallback_msg = get_fallback_response(user_message)
-                    return jsonify({
-                        'response': fallback_msg,
-                        'type': 'text'
-                    })
+                    # Answer from remembered answers / cached pages instead
+                    return jsonify(degraded_response(user_message, scenario_to_use))
+            except (openai.error.APIConnectionError, openai.error.ServiceUnavailableError, openai.error.APIError) as e:
+                # OpenAI unreachable or failing: no point in retrying within this request
+                recorder.note_upstream('openai', 'answer', getattr(e, 'http_status', None) or 502, '', (time.perf_counter() - t_answer) * 1000)
+                app.logger.info(f"[{rid}] OpenAI unavailable: {e}")
+                return jsonify(degraded_response(user_message, scenario_to_use))
             except Exception as e:
                 raise e
         
-        assistant_message = response.choices[0].message.content
+        assistant_message, reply_label = parse_reply(response.choices[0].message)
+        if not assistant_message:
+            app.logger.info(f"[{rid}] OpenAI returned no usable answer text")
+            return jsonify(degraded_response(user_message, scenario_to_use))
+        recorder.note_upstream('openai', 'answer', 200, assistant_message, (time.perf_counter() - t_answer) * 1000)
+        if SINGLE_CALL_CLASSIFY:
+            # A cut-off or malformed reply may carry no label: keep the sticky scenario then
+            scenario_to_use = reply_label or scenario_to_use
+            app.logger.info(f"[{rid}] scenario='{scenario_to_use or '-'}' (single call)")
         try:
             app.logger.info(f"[{rid}] OpenAI ok len={len(assistant_message)}")
         except Exception:
             pass
+        if not image_data_url:
+            degraded.remember(q, scenario_to_use, assistant_message, web_doc.get('url') if web_doc else '',
+                              history=conversation_history)
         # Append single source link when web doc was used
         if web_doc and web_doc.get('url'):
             assistant_message = f"{assistant_message}\n\nSource: {web_doc.get('url')}"
@@ -304,8 +528,17 @@ def chat():
         # Tell the client which scenario is active after classification
         if scenario_to_use:
             resp['data'] = {'active_scenario': scenario_to_use}
+        # Citation answers list their sources in the text; clients also get them structured
+        if cited:
+            resp.setdefault('data', {})['sources'] = [
+                {'n': i, 'url': d.get('url'), 'title': d.get('title')} for i, d in enumerate(cited, start=1)
+            ]
         return jsonify(resp)
         
+    except hedge.Cancelled:
+        metrics.incr('openai.answer_cancelled')
+        app.logger.info('Chat cancelled: client disconnected during the answer call')
+        return jsonify({'error': 'Client disconnected'}), 499
     except openai.error.AuthenticationError:
         return jsonify({
             'error': 'Invalid OpenAI API key. Please check your configuration.',
@@ -313,11 +546,9 @@ def chat():
             'type': 'text'
         }), 401
     except openai.error.RateLimitError:
-        fallback_msg = get_fallback_response(data.get('message', ''))
-        return jsonify({
-            'response': fallback_msg + '\n\n⏳ (Rate limit - please wait 20 seconds between messages)',
-            'type': 'text'
-        })
+        body = degraded_response(data.get('message', ''))
+        body['response'] += '\n\n⏳ (Rate limit - please wait 20 seconds between messages)'
+        return jsonify(body)
     except Exception as e:
         app.logger.error(f'Chat error: {str(e)}')
         return jsonify({
@@ -325,6 +556,108 @@ def chat():
             'response': 'Sorry, I encountered an error. Please try again.',
             'type': 'text'
         }), 500
+    finally:
+        admission.release(slot)
+
+
+def batch_turn(payload: dict) -> tuple:
+    """Answer one /api/chat payload in-process: (status, body, stage timings)."""
+    with app.test_request_context('/api/chat', method='POST', json=payload):
+        response = app.full_dispatch_request()
+    body = response.get_json(silent=True) or {}
+    return response.status_code, body, metrics.parse_server_timing(response.headers.get('Server-Timing'))
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch_route():
+    """
+    Run many chat turns and stream the results as JSON lines
+
+    Request JSON:
+    {
+        "items": [
+            {"id": "q1", "message": "...", "history": [...], "active_scenario": "...", "citations": false},
+            {"id": "c1", "conversation": ["first question", "follow-up"]}
+        ],
+        "parallel": 4  # optional, items played at once (BATCH_PARALLEL, at most BATCH_MAX_PARALLEL)
+    }
+
+    One line per turn, in completion order:
+    {"id", "index", "turn", "message", "status", "ms", "scenario", "source", "type", "degraded", "response", "stages"}
+    and a last line {"summary": {...}} with throughput, latency and the work shared between items.
+    Needs the X-Batch-Token header (BATCH_ADMIN_TOKEN); disabled when that is unset.
+    """
+    if not batch.authorized(request.headers.get('X-Batch-Token', '')):
+        return jsonify({'error': 'Batch endpoint disabled or token missing'}), 403
+    data = request.get_json(silent=True) or {}
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non-empty list'}), 400
+    if len(items) > batch.BATCH_MAX_ITEMS:
+        return jsonify({'error': f'At most {batch.BATCH_MAX_ITEMS} items per batch'}), 400
+    if not all(isinstance(it, dict) and batch.item_turns(it) for it in items):
+        return jsonify({'error': 'Every item needs a message or a conversation'}), 400
+    if not openai.api_key:
+        return jsonify({'error': 'OpenAI API key not configured'}), 500
+    try:
+        parallel = int(data.get('parallel') or batch.BATCH_PARALLEL)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'parallel must be a number'}), 400
+    app.logger.info(f"[batch] start items={len(items)} parallel={parallel}")
+
+    def lines():
+        for line in batch.run(items, batch_turn, parallel):
+            if 'summary' in line:
+                app.logger.info(f"[batch] done {json.dumps(line['summary'])}")
+            yield json.dumps(line, ensure_ascii=False) + '\n'
+    return app.response_class(lines(), mimetype='application/x-ndjson')
+
+
+def degraded_response(message: str, scenario: str = '') -> dict:
+    """Chat response built without OpenAI or any fetch, marked "degraded".
+
+    In order: a remembered answer to a similar question, the catalogue for
+    programme questions, a passage of the best matching cached page, a canned reply.
+    """
+    t0 = time.perf_counter()
+    message = message or ''
+    programmes = any(word in message.lower() for word in ['programme', 'program', 'course', 'degree', 'master', 'bachelor'])
+    hit = degraded.answer(message, scenario, (get_scenario(scenario) or {}).get('title', ''))
+    if hit and hit['kind'] == 'page' and programmes:
+        # The catalogue lists every programme; one page passage would not
+        hit = None
+    if hit:
+        if hit['kind'] == 'answer':
+            text = hit['text']
+        else:
+            text = f"Here is what our page \"{hit['title']}\" says:\n\n{hit['text']}"
+        if hit['source']:
+            text = f"{text}\n\nSource: {hit['source']}"
+        body = {'response': text, 'type': 'text', 'data': {'degraded': hit['kind'], 'source': hit['source']}}
+    elif programmes:
+        metrics.incr('degraded.catalogue')
+        body = {'response': 'Here are our available programmes:', 'type': 'catalogue',
+                'data': {'programmes': PROGRAMMES, 'degraded': 'catalogue'}}
+    else:
+        metrics.incr('degraded.canned')
+        body = {'response': get_fallback_response(message), 'type': 'text', 'data': {'degraded': 'canned'}}
+    if scenario:
+        body['data']['active_scenario'] = scenario
+    body['degraded'] = True
+    metrics.observe('degraded', (time.perf_counter() - t0) * 1000)
+    return body
+
+
+def shed_response(message: str, scenario: str = ''):
+    """503 with a degraded answer and a retry hint for a chat turn admission control turned away."""
+    body = degraded_response(message, scenario)
+    body['response'] += f"\n\n⏳ We're handling a lot of questions right now - please ask again in {admission.ADMISSION_RETRY_AFTER_S} seconds for a full answer."
+    body['degraded'] = True
+    body['retry_after'] = admission.ADMISSION_RETRY_AFTER_S
+    resp = jsonify(body)
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(admission.ADMISSION_RETRY_AFTER_S)
+    return resp
 
 
 def get_fallback_response(message):
@@ -343,10 +676,172 @@ def get_fallback_response(message):
         return FALLBACK_RESPONSES['default']
 
 
+def sticky_scenario(active: str, user_message: str) -> tuple:
+    """Return (label, reason) where label is the client's active scenario if it can be kept
+    without calling the classifier, or '' if the message needs classifying.
+
+    The local check is match_scenario's alias/fuzzy matching: a hit on the active
+    scenario keeps it, a hit on a different one is a topic switch. A message with
+    no hit keeps it only when it reads as a short follow-up: at most STICKY_MAX_WORDS
+    words that continue or point back at the previous turn. Anything else may be a
+    new question ("What programmes do you offer?", an off-topic one) and is classified.
+    """
+    if not STICKY_SCENARIO:
+        return '', 'sticky disabled'
+    if active not in SCENARIO_NAMES:
+        return '', 'no active scenario'
+    if active == 'off_topic':
+        return '', 'active is off_topic'
+    local = match_scenario(user_message)
+    if local:
+        return (active, 'same topic') if local == active else ('', f'topic switch to {local}')
+    if len(user_message.split()) <= STICKY_MAX_WORDS and _FOLLOW_UP_RE.search(user_message):
+        return active, 'short follow-up'
+    return '', 'no topic signal'
+
+
+_ARG_SCENARIO_RE = re.compile(r'"scenario"\s*:\s*"([a-z_]+)"')
+_ARG_ANSWER_RE = re.compile(r'"answer"\s*:\s*"((?:[^"\\]|\\.)*)', re.S)
+
+
+def _partial_reply_args(raw: str) -> dict:
+    """{'scenario', 'answer'} recovered from cut-off `reply` arguments (answer up to where the text stops)."""
+    out = {}
+    m = _ARG_SCENARIO_RE.search(raw)
+    if m:
+        out['scenario'] = m.group(1)
+    m = _ARG_ANSWER_RE.search(raw)
+    if m:
+        # Drop a half-written escape (\ or \u00e) at the cut before decoding the JSON string
+        text = re.sub(r'\\(u[0-9a-fA-F]{0,3})?$', '', m.group(1))
+        try:
+            out['answer'] = json.loads(f'"{text}"').strip()
+        except ValueError:
+            out['answer'] = ''
+    return out
+
+
+def parse_reply(message) -> tuple:
+    """Return (answer text, scenario label) from a completion message.
+
+    Plain completions have no label; single-call completions carry both in a `reply` function call.
+    An unknown label comes back as an empty string.
+    """
+    fc = message.get('function_call')
+    if not fc:
+        return message.get('content') or '', ''
+    raw = fc.get('arguments') or ''
+    try:
+        args = json.loads(raw)
+    except ValueError:
+        # Truncated (max_tokens) or malformed arguments: keep the part of the answer that arrived, never the JSON
+        metrics.incr('single_call.truncated')
+        args = _partial_reply_args(raw)
+    if not isinstance(args, dict):
+        args = {}
+    label = (args.get('scenario') or '').strip().lower()
+    return args.get('answer') or message.get('content') or '', (label if label in SCENARIO_NAMES else '')
+
+
+def retry_after_s(err) -> float | None:
+    """Retry-After seconds from an OpenAI error response, if the server sent one."""
+    try:
+        return float((getattr(err, 'headers', None) or {}).get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def openai_timeout(model: str, max_tokens: int) -> float:
+    """Seconds to wait for one completion of up to max_tokens tokens from model."""
+    base = OPENAI_TIMEOUT_BASE.get(model, OPENAI_TIMEOUT_DEFAULT_S)
+    return min(OPENAI_TIMEOUT_MAX_S, base + max_tokens * OPENAI_TIMEOUT_PER_TOKEN_MS / 1000.0)
+
+
+def client_disconnected() -> bool:
+    """True when the browser has closed the connection.
+
+    Peeks at the client socket where the server exposes it (werkzeug, gunicorn);
+    always False elsewhere, e.g. behind a buffering proxy or in the test client.
+    """
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        # Check readability first: a cooperative socket (gevent) would wait in recv instead of failing
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            if not poller.poll(0):
+                return False
+        elif not select.select([sock], [], [], 0)[0]:
+            return False
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except BlockingIOError:
+        return False
+    except OSError:
+        return True
+    except (ValueError, TypeError):
+        # TLS sockets do not support peeking
+        return False
+
+
+def openai_completion(stage: str, should_stop=None, **kwargs):
+    """openai.ChatCompletion.create with a model/max_tokens timeout and optional hedging.
+
+    stage ('answer' or 'classify') names the counters and latency window. With
+    OPENAI_HEDGE=1 a second identical call starts once the first passes the recent
+    p95 for the stage; the first successful one wins and the other is abandoned.
+    Raises the call's error (openai.error.Timeout on timeout), or hedge.Cancelled
+    when should_stop() turns True while waiting.
+    """
+    timeout = openai_timeout(kwargs.get('model', ''), kwargs.get('max_tokens') or 256)
+    kwargs.setdefault('request_timeout', timeout)
+
+    def call():
+        metrics.incr(f'openai.{stage}_calls')
+        t0 = time.perf_counter()
+        try:
+            return openai.ChatCompletion.create(**kwargs)
+        except Exception as e:
+            # Returned, not raised, so the race can tell a failed call from a pending one
+            return e
+        finally:
+            metrics.observe(f'openai.{stage}_ms', (time.perf_counter() - t0) * 1000, per_request=False)
+
+    delay_s = None
+    if OPENAI_HEDGE:
+        delay_s = metrics.recent_percentile(f'openai.{stage}_ms', OPENAI_HEDGE_PERCENTILE, timeout * 1000,
+                                            min_samples=OPENAI_HEDGE_MIN_SAMPLES) / 1000
+    # The calls run on hedge threads: a profiled request samples them too
+    call = profiling.follow(call)
+    winner, results, fired = hedge.race(
+        call, call, delay_s, lambda r: not isinstance(r, Exception), fallback=False, should_stop=should_stop,
+        on_abandoned=lambda name, fut: metrics.incr(f'openai_hedge.{stage}_abandoned'),
+        pool=hedge.executor('openai', OPENAI_POOL_SIZE),
+    )
+    if fired:
+        metrics.incr(f'openai_hedge.{stage}_fired')
+        if winner:
+            metrics.incr(f"openai_hedge.{stage}_won_{'hedge' if winner == 'secondary' else 'first'}")
+    if winner:
+        return results[winner]
+    err = results.get('primary') or results.get('secondary') or RuntimeError('OpenAI call failed')
+    if isinstance(err, openai.error.Timeout):
+        metrics.incr(f'openai.{stage}_timeouts')
+    raise err
+
+
 def classify_scenario(user_message: str, image_data_url: str = "") -> str:
     """Classify the user's message into one of SCENARIO_NAMES using OpenAI.
     Returns a scenario name (lowercase) from SCENARIO_NAMES, or an empty string if classification failed.
     """
+    if image_data_url:
+        return _classify_scenario(user_message, image_data_url)
+    # Batch items with the same question classify it once
+    return batch.shared('classify', user_message.strip(), lambda: _classify_scenario(user_message))
+
+
+def _classify_scenario(user_message: str, image_data_url: str = "") -> str:
     labels = SCENARIO_NAMES
     definitions = scenario_definitions_text()
     instruction = (
@@ -373,8 +868,10 @@ def classify_scenario(user_message: str, image_data_url: str = "") -> str:
         else:
             user_payload = {'role': 'user', 'content': user_message}
 
-        resp = openai.ChatCompletion.create(
-            model=('gpt-4o-mini' if image_data_url else 'gpt-3.5-turbo'),
+        t0 = time.perf_counter()
+        resp = openai_completion(
+            'classify',
+            model=(routing.ROUTE_VISION_MODEL if image_data_url else routing.available(routing.ROUTE_TEXT_MODEL)[0]),
             messages=[
                 {'role': 'system', 'content': instruction},
                 user_payload,
@@ -383,6 +880,7 @@ def classify_scenario(user_message: str, image_data_url: str = "") -> str:
             max_tokens=10,
         )
         label = (resp.choices[0].message.content or '').strip().lower()
+        recorder.note_upstream('openai', 'classify', 200, label, (time.perf_counter() - t0) * 1000)
         # Strict match against allowed labels
         if label in labels:
             return label
@@ -399,6 +897,16 @@ def extract_urls(text: str) -> list:
     return re.findall(r'https?://[^\s)]+', text)
 
 
+def _upstream_url(url: str) -> str:
+    """Map a harbour.space URL to SITE_ORIGIN when a local stand-in site is configured."""
+    if not SITE_ORIGIN:
+        return url
+    for prefix in ('https://harbour.space', 'http://harbour.space', 'https://www.harbour.space', 'http://www.harbour.space'):
+        if url.startswith(prefix):
+            return SITE_ORIGIN + url[len(prefix):]
+    return url
+
+
 def should_web_search(message: str) -> bool:
     if not message:
         return False
@@ -413,46 +921,275 @@ def should_web_search(message: str) -> bool:
     return any(k in m for k in keywords)
 
 
-def fetch_and_clean(url: str, timeout: int = 8, max_chars: int = 3000) -> dict:
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119 Safari/537.36',
-        'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
-    }
-    resp = requests.get(url, headers=headers, timeout=timeout)
-    status = resp.status_code
-    try:
-        app.logger.info(f"[fetch] status={status} url={url} len={len(resp.text)}")
-    except Exception:
-        pass
-    html = resp.text
+# Same-site links kept per page for the prefetcher, and paths that are never worth prefetching
+MAX_PAGE_LINKS = int(os.getenv('MAX_PAGE_LINKS', '40'))
+_SKIP_LINK_RE = re.compile(r'(privacy|cookie|terms|login|signin|sign-in|/cart|\.(pdf|jpe?g|png|gif|svg|zip|mp4))', re.I)
+_MD_LINK_RE = re.compile(r'\[([^\]]{1,120})\]\((https?://[^)\s]+)\)')
+
+
+def _same_site_link(href: str, base_url: str) -> str:
+    """Absolute URL without fragment when href points to another page of base_url's site, else ''."""
+    if not href or href.startswith(('#', 'mailto:', 'tel:', 'javascript:')):
+        return ''
+    absolute = urljoin(base_url, href).split('#', 1)[0].rstrip('/')
+    a, b = urlparse(absolute), urlparse(base_url)
+    if a.scheme not in ('http', 'https') or a.netloc.lower().removeprefix('www.') != b.netloc.lower().removeprefix('www.'):
+        return ''
+    if absolute == base_url.rstrip('/') or _SKIP_LINK_RE.search(a.path):
+        return ''
+    return absolute
+
+
+def _add_link(links: list, seen: set, href: str, anchor: str, base_url: str):
+    link = _same_site_link(href, base_url)
+    if link and link not in seen and len(links) < MAX_PAGE_LINKS:
+        seen.add(link)
+        links.append({'url': link, 'text': ' '.join(anchor.split())[:120]})
+
+
+def reader_links(text: str, base_url: str) -> list:
+    """Same-site links from reader-proxy markdown ([anchor](url))."""
+    links, seen = [], set()
+    for anchor, href in _MD_LINK_RE.findall(text or ''):
+        _add_link(links, seen, href, anchor, base_url)
+    return links
+
+
+def clean_html(html: str, url: str = '', with_links: bool = False) -> tuple:
+    """Strip boilerplate tags from a page and return (title, whitespace-collapsed text).
+
+    with_links=True returns (title, text, links) where links are the same-site
+    [{'url', 'text'}] anchors of the page body (navigation and footer excluded).
+    """
     soup = BeautifulSoup(html, 'html.parser')
     for tag in soup(['script', 'style', 'noscript', 'header', 'footer', 'nav', 'aside']):
         tag.decompose()
     title = (soup.title.string.strip() if soup.title and soup.title.string else url)
     text = ' '.join(soup.get_text(separator=' ').split())
-    # If page seems empty or blocked, try r.jina.ai readability proxy
-    if status >= 400 or len(text) < 300 or 'enable javascript' in text.lower() or 'captcha' in text.lower():
-        try:
-            parsed = urlparse(url)
-            reader = f"https://r.jina.ai/http://{parsed.netloc}{parsed.path}"
-            if parsed.query:
-                reader += f"?{parsed.query}"
-            r2 = requests.get(reader, headers=headers, timeout=timeout)
-            app.logger.info(f"[fetch] reader status={r2.status_code} url={reader} len={len(r2.text)}")
-            if r2.ok and len(r2.text) > 200:
-                text = ' '.join(r2.text.split())
-                title = title or parsed.netloc
-        except Exception as e:
-            try:
-                app.logger.info(f"[fetch] reader error for {url}: {e}")
-            except Exception:
-                pass
-    text = text[:max_chars]
-    return {'url': url, 'title': title, 'text': text}
+    if not with_links:
+        return title, text
+    links, seen = [], set()
+    for a in soup.find_all('a', href=True):
+        _add_link(links, seen, a['href'], a.get_text(' '), url)
+    return title, text, links
+
+
+# Retrieval gate: scenarios that never need site content unless the message asks for it explicitly
+RETRIEVAL_GATE = os.getenv('RETRIEVAL_GATE', '1') == '1'
+RETRIEVAL_SKIP_SCENARIOS = set(filter(None, os.getenv('RETRIEVAL_SKIP_SCENARIOS', 'off_topic,cafeteria').split(',')))
+# Messages of at most this many words count as chatter / follow-ups
+RETRIEVAL_SHORT_WORDS = int(os.getenv('RETRIEVAL_SHORT_WORDS', '6'))
+
+# Words that carry no retrieval signal (greetings, thanks, question glue) in the languages we see
+GATE_STOPWORDS = {
+    'hi', 'hello', 'hey', 'thanks', 'thank', 'thx', 'you', 'ok', 'okay', 'cool', 'great', 'nice', 'bye', 'yes', 'yeah',
+    'and', 'the', 'for', 'what', 'about', 'how', 'why', 'when', 'where', 'which', 'who', 'can', 'could', 'should',
+    'would', 'does', 'did', 'are', 'is', 'this', 'that', 'there', 'then', 'next', 'also', 'more', 'tell', 'please',
+    'привет', 'здравствуйте', 'спасибо', 'пока', 'хорошо', 'ладно', 'понятно', 'что', 'как', 'для', 'это', 'ещё',
+    'еще', 'а', 'и', 'про', 'тогда', 'дальше', 'hola', 'gracias', 'vale', 'que', 'qué', 'para',
+}
+
+_SOURCE_LINE_RE = re.compile(r'\n\nSource: (https?://\S+)\s*$')
+
+
+def _content_terms(message: str) -> list:
+    return [t for t in re.split(r"[^\w]+", (message or '').lower()) if len(t) > 2 and t not in GATE_STOPWORDS]
+
+
+def previous_source_url(history: list) -> str:
+    """URL from the 'Source: <url>' line of the last assistant turn, if it had one."""
+    for turn in reversed(history or []):
+        if isinstance(turn, dict) and turn.get('role') == 'assistant':
+            m = _SOURCE_LINE_RE.search(str(turn.get('content') or ''))
+            return m.group(1) if m else ''
+    return ''
+
 
+def doc_covers_query(doc: dict, query: str) -> bool:
+    """True when every content term of a short follow-up appears in the page (or there are none)."""
+    terms = _content_terms(query)
+    if not terms:
+        return True
+    hay = f"{doc.get('title') or ''} {doc.get('text') or ''}".lower()
+    # Crude stemming so 'bachelors' matches 'Bachelor' and 'стипендии' matches 'стипендия'
+    return all(t[:max(4, len(t) - 2)] in hay for t in terms)
 
-def search_duckduckgo(query: str, max_results: int = 3) -> list:
+
+def retrieval_gate(message: str, scenario: str, history: list, force_web: bool = False, has_urls: bool = False) -> tuple:
+    """Decide how to get web context for a turn: ('search' | 'reuse' | 'skip', reason).
+
+    'reuse' means the previous turn's source page may answer it; chat() confirms with doc_covers_query.
+    """
+    if not RETRIEVAL_GATE:
+        return 'search', 'gate disabled'
+    if force_web or has_urls:
+        return 'search', 'explicit web request' if force_web else 'urls in message'
+    if not message:
+        return 'skip', 'no text'
+    keyword_hit = should_web_search(message)
+    short = len(message.split()) <= RETRIEVAL_SHORT_WORDS
+    if short and not keyword_hit and not _content_terms(message):
+        return 'skip', 'chatter'
+    # Checked before the scenario rule: the classifier sees no history, so follow-ups often come back off_topic
+    if short and previous_source_url(history):
+        return 'reuse', 'short follow-up'
+    if scenario in RETRIEVAL_SKIP_SCENARIOS and not keyword_hit:
+        return 'skip', f'scenario {scenario}'
+    return 'search', 'keywords' if keyword_hit else 'question'
+
+
+# Hedged page fetches: start the reader proxy when the direct fetch is slower than
+# the recent FETCH_HEDGE_PERCENTILE, or immediately for hosts that usually need it
+FETCH_HEDGE = os.getenv('FETCH_HEDGE', '1') == '1'
+FETCH_HEDGE_PERCENTILE = float(os.getenv('FETCH_HEDGE_PERCENTILE', '90'))
+FETCH_HEDGE_MIN_MS = float(os.getenv('FETCH_HEDGE_MIN_MS', '150'))
+FETCH_HEDGE_DEFAULT_MS = float(os.getenv('FETCH_HEDGE_DEFAULT_MS', '1500'))
+FETCH_HEDGE_HOST_MIN = int(os.getenv('FETCH_HEDGE_HOST_MIN', '4'))
+
+PAGE_FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+}
+
+# Which path (direct = 'primary', reader = 'secondary') recently produced each page and host
+fetch_paths = hedge.HostPaths()
+
+_READER_TITLE_RE = re.compile(r'^Title:\s*(.+)$', re.M)
+
+
+def _direct_fetch(url: str, timeout: int) -> dict:
+    t0 = time.perf_counter()
+    try:
+        resp = requests.get(_upstream_url(url), headers=PAGE_FETCH_HEADERS, timeout=timeout)
+    except Exception as e:
+        return {'path': 'site', 'error': e, 'ms': (time.perf_counter() - t0) * 1000}
+    ms = (time.perf_counter() - t0) * 1000
+    t1 = time.perf_counter()
+    title, text, links = clean_html(resp.text, url, with_links=True)
+    return {'path': 'site', 'resp': resp, 'status': resp.status_code, 'title': title, 'text': text,
+            'links': links, 'ms': ms, 'clean_ms': (time.perf_counter() - t1) * 1000}
+
+
+def _reader_fetch(url: str, timeout: int) -> dict:
+    parsed = urlparse(url)
+    reader = f"{READER_PROXY_URL}http://{parsed.netloc}{parsed.path}"
+    if parsed.query:
+        reader += f"?{parsed.query}"
+    t0 = time.perf_counter()
+    try:
+        r2 = requests.get(reader, headers=PAGE_FETCH_HEADERS, timeout=timeout)
+    except Exception as e:
+        return {'path': 'reader', 'error': e, 'ms': (time.perf_counter() - t0) * 1000, 'reader_url': reader}
+    ok = r2.ok and len(r2.text) > 200
+    m = _READER_TITLE_RE.search(r2.text[:500]) if ok else None
+    return {'path': 'reader', 'resp': r2, 'status': r2.status_code, 'reader_url': reader,
+            'title': m.group(1).strip() if m else parsed.netloc,
+            'text': ' '.join(r2.text.split()) if ok else '',
+            'links': reader_links(r2.text, url) if ok else [],
+            'ms': (time.perf_counter() - t0) * 1000}
+
+
+def _fetch_usable(res: dict) -> bool:
+    if res.get('error') is not None or res.get('status', 500) >= 400:
+        return False
+    if res['path'] == 'reader':
+        return bool(res['text'])
+    low = res['text'].lower()
+    # Empty or blocked pages go to the r.jina.ai readability proxy
+    return len(res['text']) >= 300 and 'enable javascript' not in low and 'captcha' not in low
+
+
+def _note_fetch(url: str, res: dict, per_request: bool = True):
+    """Timings, recording and logs for one fetch result."""
+    metrics.observe('fetch' if res['path'] == 'site' else 'reader', res['ms'], per_request=per_request)
+    if 'clean_ms' in res:
+        metrics.observe('clean', res['clean_ms'], per_request=per_request)
+    try:
+        if res.get('error') is not None:
+            app.logger.info(f"[fetch] {res['path']} error for {url}: {res['error']}")
+            return
+        if per_request:
+            recorder.note_response(res['resp'], res['path'])
+        if res['path'] == 'site':
+            app.logger.info(f"[fetch] status={res['status']} url={url} len={len(res['resp'].text)}")
+        else:
+            app.logger.info(f"[fetch] reader status={res['status']} url={res['reader_url']} len={len(res['resp'].text)}")
+    except Exception:
+        pass
+
+
+def _note_abandoned(url: str, fut):
+    metrics.incr('fetch_hedge.abandoned')
+    try:
+        _note_fetch(url, fut.result(), per_request=False)
+    except Exception:
+        pass
+
+
+def fetch_and_clean(url: str, timeout: int = 8, max_chars: int = 3000, use_cache: bool = True) -> dict:
+    """Fetch a page (through the page cache) and return {'url', 'title', 'text', 'links', 'simhash', 'tf', 'tf_len'} with text cut to max_chars.
+
+    use_cache=False always fetches but still stores the fresh result (used by the cache warmer).
+    Slow or JavaScript-only pages are raced against the reader proxy (see FETCH_HEDGE).
+    """
+    if use_cache:
+        cached = page_cache.get(url)
+        if cached is not None:
+            cached['text'] = cached['text'][:max_chars]
+            return cached
+        if batch.current() is not None:
+            # Another batch item may be loading this page right now: wait for its fetch
+            doc = batch.shared('page', url, lambda: fetch_and_clean(url, timeout, page_cache.PAGE_CACHE_MAX_CHARS, use_cache=False))
+            doc['text'] = doc['text'][:max_chars]
+            return doc
+    parsed = urlparse(url)
+    host, page = parsed.netloc.lower(), f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+    # A page's own history decides; unknown pages follow their host once it has enough history
+    reader_first = fetch_paths.needs_secondary(page)
+    if reader_first is None:
+        reader_first = fetch_paths.needs_secondary(host, min_samples=FETCH_HEDGE_HOST_MIN) or False
+    reader_first = FETCH_HEDGE and reader_first
+    delay_s = None
+    if FETCH_HEDGE:
+        delay_s = max(FETCH_HEDGE_MIN_MS, metrics.recent_percentile('fetch', FETCH_HEDGE_PERCENTILE, FETCH_HEDGE_DEFAULT_MS)) / 1000
+    winner, results, fired = hedge.race(
+        profiling.follow(lambda: _direct_fetch(url, timeout)),
+        profiling.follow(lambda: _reader_fetch(url, timeout)),
+        delay_s, _fetch_usable, start_both=reader_first,
+        on_abandoned=lambda name, fut: _note_abandoned(url, fut),
+    )
+    if fired:
+        metrics.incr('fetch_hedge.reader_first' if reader_first else 'fetch_hedge.fired')
+        metrics.incr(f"fetch_hedge.won_{'reader' if winner == 'secondary' else 'direct' if winner else 'none'}")
+    for r in results.values():
+        if r is not None:
+            _note_fetch(url, r)
+    if winner:
+        fetch_paths.record(winner, page, host)
+        res = results[winner]
+    else:
+        # Neither path gave a usable page: keep the direct result as before, or surface its error
+        res = results.get('primary') or {}
+        if res.get('error') is not None or not res:
+            raise res.get('error') or RuntimeError(f'fetch failed for {url}')
+    title, text = res.get('title') or url, res.get('text') or ''
+    doc = {'url': url, 'title': title, 'text': text, 'links': res.get('links') or [], 'simhash': dedupe.simhash(text)}
+    # Term vector for choose_best_doc, cached with the page
+    ranking.doc_vector(doc)
+    # Only usable pages are cached: a blocked or near-empty 200 is served once, then fetched again
+    if winner:
+        page_cache.put(url, doc)
+    doc['text'] = text[:max_chars]
+    return doc
+
+
+def _search_timeout(deadline: float | None) -> float:
+    """Seconds one search request may take: 8, or what is left before deadline (time.monotonic(); <= 0 once passed)."""
+    return 8 if deadline is None else min(8.0, deadline - time.monotonic())
+
+
+def search_duckduckgo(query: str, max_results: int = 3, deadline: float | None = None) -> list:
     # Try DuckDuckGo HTML endpoint
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119 Safari/537.36',
@@ -476,8 +1213,10 @@ def search_duckduckgo(query: str, max_results: int = 3) -> list:
 
     try:
         q = quote_plus(query)
-        url = f'https://duckduckgo.com/html/?q={q}&kl=us-en'
-        r = requests.get(url, headers=headers, timeout=8)
+        url = f'{DDG_HTML_URL}?q={q}&kl=us-en'
+        with metrics.timed('search'):
+            r = requests.get(url, headers=headers, timeout=_search_timeout(deadline))
+        recorder.note_response(r, 'search')
         r.raise_for_status()
         soup = BeautifulSoup(r.text, 'html.parser')
         # DDG HTML uses links with class 'result__a'
@@ -492,11 +1231,13 @@ def search_duckduckgo(query: str, max_results: int = 3) -> list:
     except Exception:
         pass
     # Fallback to lite version if needed
-    if not urls:
+    if not urls and _search_timeout(deadline) > 0:
         try:
             q = quote_plus(query)
-            url = f'https://lite.duckduckgo.com/lite/?q={q}'
-            r = requests.get(url, headers=headers, timeout=8)
+            url = f'{DDG_LITE_URL}?q={q}'
+            with metrics.timed('search'):
+                r = requests.get(url, headers=headers, timeout=_search_timeout(deadline))
+            recorder.note_response(r, 'search')
             r.raise_for_status()
             soup = BeautifulSoup(r.text, 'html.parser')
             anchors = soup.find_all('a')
@@ -518,7 +1259,9 @@ def search_duckduckgo(query: str, max_results: int = 3) -> list:
     return urls_sorted[:max_results]
 
 
-def search_bing_html(query: str, max_results: int = 3) -> list:
+def search_bing_html(query: str, max_results: int = 3, deadline: float | None = None) -> list:
+    if _search_timeout(deadline) <= 0:
+        return []
     headers = {
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119 Safari/537.36',
         'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8'
@@ -526,8 +1269,10 @@ def search_bing_html(query: str, max_results: int = 3) -> list:
     urls = []
     try:
         q = quote_plus(query)
-        url = f'https://www.bing.com/search?q={q}&setlang=en'
-        r = requests.get(url, headers=headers, timeout=8)
+        url = f'{BING_SEARCH_URL}?q={q}&setlang=en'
+        with metrics.timed('search'):
+            r = requests.get(url, headers=headers, timeout=_search_timeout(deadline))
+        recorder.note_response(r, 'search')
         r.raise_for_status()
         soup = BeautifulSoup(r.text, 'html.parser')
         anchors = soup.select('li.b_algo h2 a, h2 a')
@@ -548,86 +1293,38 @@ def search_bing_html(query: str, max_results: int = 3) -> list:
     return urls_sorted[:max_results]
 
 
-def build_sources_block(web_urls: list = None, query: str = None, max_sources: int = 3, max_chars_per: int = 3000) -> str:
-    urls = list(web_urls or [])
-    seen = set(urls)
-    if not urls and query:
-        query_variants = [
-            f"{query} site:harbour.space",
-            f"Harbour.Space University {query}",
-            query,
-        ]
-        for q in query_variants:
-            results = search_duckduckgo(q, max_results=max_sources)
-            if not results:
-                results = search_bing_html(q, max_results=max_sources)
-            for u in results:
-                if u in seen:
-                    continue
-                urls.append(u)
-                seen.add(u)
-                if len(urls) >= max_sources:
-                    break
-            if len(urls) >= max_sources:
-                break
-    if not urls and query:
-        # Seed fallback for known Harbour.Space sections when query hints at them
-        m = query.lower()
-        seeds = []
-        if ('harbour.space' in m or 'harbour space' in m or 'harbourspace' in m or
-            'harbor.space' in m or 'harbor space' in m or 'harborspace' in m):
-            if any(k in m for k in ['scholar', 'стипенд']):
-                seeds.extend(['https://harbour.space/admissions/scholarship', 'https://harbour.space/scholarships'])
-            if any(k in m for k in ['admission', 'apply', 'поступлен', 'подач']):
-                seeds.append('https://harbour.space/admissions')
-            if any(k in m for k in ['submission', 'intake', 'интейк', 'deadline', 'срок', 'calendar', 'распис']):
-                seeds.append('https://harbour.space/admissions')
-            if any(k in m for k in ['bachelor', 'bachelors', 'undergraduate', 'foundation']):
-                seeds.extend(['https://harbour.space/bachelors', 'https://harbour.space/programmes', 'https://harbour.space/admissions'])
-            if any(k in m for k in ['about', 'foundation', 'history', 'о нас', 'об университете']):
-                seeds.append('https://harbour.space/about')
-            if not seeds:
-                seeds.append('https://harbour.space/')
-        if seeds:
-            app.logger.info(f"[search] using seed urls for '{query}': {seeds}")
-        urls.extend([u for u in seeds if u not in seen])
-        for u in seeds:
-            seen.add(u)
-    if not urls:
-        return ''
-    items = []
-    for i, u in enumerate(urls[:max_sources], start=1):
-        try:
-            doc = fetch_and_clean(u, max_chars=max_chars_per)
-            items.append((i, doc['url'], doc['title'], doc['text']))
-        except Exception as e:
-            try:
-                app.logger.info(f"[fetch] error url={u} err={e}")
-            except Exception:
-                pass
-            continue
-    if not items:
-        return ''
-    # Build compact block: header list + excerpts
-    header = '\n'.join([f"[{i}] {t} — {u}" for (i, u, t, _) in items])
-    excerpts = '\n\n'.join([f"[{i}] EXCERPT: {txt}" for (i, _, _, txt) in items])
-    block = f"{header}\n\n{excerpts}"
-    try:
-        app.logger.info(f"Web sources used for query: {query or 'urls'} -> {[u for (_, u, _, _) in items]}")
-    except Exception:
-        pass
-    return block
+# ---------- Simple web-doc retrieval (no citations) ----------
 
+# Collapse mirror URLs and near-duplicate pages in collect_web_docs
+DEDUPE_PAGES = os.getenv('DEDUPE_PAGES', '1') == '1'
+# Extra search results collect_web_docs may fetch to replace pages dropped as duplicates
+DEDUPE_SPARE_FETCHES = int(os.getenv('DEDUPE_SPARE_FETCHES', '2')) if DEDUPE_PAGES else 0
+# Page fetches one request runs at the same time (1 = one after another)
+FETCH_PARALLEL = int(os.getenv('FETCH_PARALLEL', '4'))
 
-# ---------- Simple web-doc retrieval (no citations) ----------
 
-def collect_web_docs(web_urls: list | None, query: str | None, max_sources: int = 3) -> list:
+def candidate_urls(web_urls: list | None, query: str | None, max_sources: int = 3, deadline: float | None = None) -> list:
+    """Canonical, de-duplicated URLs to fetch: the given ones, else search results (spares included) or seeds.
+
+    With a deadline (time.monotonic()) each search request only gets the time
+    left, and no further query variant is searched once it has passed.
+    """
     urls = []
     seen = set()
+
+    def add(u):
+        # Mirror URLs (tracking params, trailing slash, http/https, www.) collapse to one fetch
+        key = dedupe.url_key(u) if DEDUPE_PAGES else u
+        if key in seen:
+            metrics.incr('dedupe.hit')
+            metrics.incr('dedupe.url')
+            return
+        seen.add(key)
+        urls.append(dedupe.canonical_url(u) if DEDUPE_PAGES else u)
+
     if web_urls:
         for u in web_urls:
-            if u not in seen:
-                urls.append(u); seen.add(u)
+            add(u)
     if query:
         # prefer harbour.space
         variants = [
@@ -635,18 +1332,21 @@ def collect_web_docs(web_urls: list | None, query: str | None, max_sources: int
             f"Harbour.Space University {query}",
             query,
         ]
+        n = max_sources + DEDUPE_SPARE_FETCHES
         for q in variants:
-            res = search_duckduckgo(q, max_results=max_sources) or []
-            if not res:
-                res = search_bing_html(q, max_results=max_sources)
+            if _search_timeout(deadline) <= 0:
+                metrics.incr('search.deadline_skipped')
+                app.logger.info(f"[search] time budget spent, not searching '{q}'")
+                break
+            # Batch items asking the same thing search once
+            res = batch.shared('search', (q, n), lambda: search_duckduckgo(q, max_results=n, deadline=deadline)
+                               or search_bing_html(q, max_results=n, deadline=deadline))
+            # Keep every result of this search: the extras are spares for duplicate pages
             for u in res:
-                if u not in seen:
-                    urls.append(u); seen.add(u)
-                if len(urls) >= max_sources:
-                    break
+                add(u)
             if len(urls) >= max_sources:
                 break
-        # seeds fallback (same как в build_sources_block)
+        # Seed fallback for known Harbour.Space sections when query hints at them
         if len(urls) == 0:
             m = query.lower()
             seeds = []
@@ -667,22 +1367,126 @@ def collect_web_docs(web_urls: list | None, query: str | None, max_sources: int
             if seeds:
                 app.logger.info(f"[search] using seed urls (collect) for '{query}': {seeds}")
             for u in seeds:
-                if u not in seen:
-                    urls.append(u); seen.add(u)
+                add(u)
+    return urls
 
-    docs = []
-    for u in urls[:max_sources]:
+
+def _request_bound(fn):
+    """fn wrapped to run on a helper thread as part of the calling request (stage timings, recording, profile)."""
+    stages, rec, work = metrics.current_request(), recorder.current(), batch.current()
+
+    @profiling.follow
+    def run(*args, **kwargs):
+        metrics.bind_request(stages)
+        recorder.bind(rec)
+        batch.bind(work)
         try:
-            doc = fetch_and_clean(u, max_chars=3000)
+            return fn(*args, **kwargs)
+        finally:
+            metrics.bind_request(None)
+            recorder.bind(None)
+            batch.bind(None)
+    return run
+
+
+def _fetch_one(u: str):
+    try:
+        return fetch_and_clean(u, max_chars=3000)
+    except Exception as e:
+        app.logger.info(f"[collect] fetch error for {u}: {e}")
+        return None
+
+
+def _fetch_batch(urls: list, timeout: float | None) -> list:
+    """Docs for urls (None where a fetch failed or missed the timeout), fetching uncached pages concurrently."""
+    out = {}
+    misses = []
+    for u in urls:
+        if page_cache.fresh(u):
+            out[u] = _fetch_one(u)
+        else:
+            misses.append(u)
+    if len(misses) == 1 and timeout is None:
+        out[misses[0]] = _fetch_one(misses[0])
+    elif misses:
+        pool = ThreadPoolExecutor(max_workers=len(misses), thread_name_prefix='collect')
+        futures = {pool.submit(_request_bound(_fetch_one), u): u for u in misses}
+        done, pending = wait(futures, timeout=timeout)
+        # Pages still loading finish in the background (and land in page_cache) but are not waited for
+        pool.shutdown(wait=False)
+        for fut in done:
+            out[futures[fut]] = fut.result()
+        if pending:
+            metrics.incr('collect.abandoned', len(pending))
+            app.logger.info(f"[collect] time budget spent, left {len(pending)} page(s) loading: {[futures[f] for f in pending]}")
+    return [out.get(u) for u in urls]
+
+
+def fetch_docs(urls: list, max_sources: int = 3, deadline: float | None = None) -> list:
+    """Fetch up to max_sources distinct pages from urls, in their order.
+
+    Pages are fetched in parallel rounds of as many URLs as there are free
+    slots; a later round (spare URLs) only runs when pages of the previous one
+    failed or duplicated a page already kept. With a deadline
+    (time.monotonic()), cached pages are still used but uncached ones not
+    loaded by then are left out.
+    """
+    docs = []
+    todo = list(urls[:max_sources + DEDUPE_SPARE_FETCHES])
+    while todo and len(docs) < max_sources:
+        n = max(1, min(max_sources - len(docs), FETCH_PARALLEL))
+        round_urls, todo = todo[:n], todo[n:]
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        for u, doc in zip(round_urls, _fetch_batch(round_urls, timeout)):
+            if doc is None:
+                continue
+            dup = DEDUPE_PAGES and next((d for d in docs if dedupe.near_duplicate(d.get('simhash'), doc.get('simhash'))), None)
+            if dup:
+                metrics.incr('dedupe.hit')
+                metrics.incr('dedupe.content')
+                app.logger.info(f"[collect] near-duplicate {u} of {dup.get('url')}")
+                continue
+            metrics.incr('dedupe.miss')
             docs.append(doc)
-        except Exception as e:
-            app.logger.info(f"[collect] fetch error for {u}: {e}")
+        if deadline is not None and time.monotonic() >= deadline:
+            break
     return docs
 
 
-def choose_best_doc(docs: list, query: str | None) -> dict | None:
-    if not docs:
-        return None
+def collect_web_docs(web_urls: list | None, query: str | None, max_sources: int = 3, deadline: float | None = None) -> list:
+    """Fetch up to max_sources distinct pages for the given URLs or search query.
+
+    URLs are canonicalized before fetching, and pages whose text fingerprint
+    matches an earlier one are dropped; spare search results fill their slots.
+    A deadline bounds the searches as well as the page loads.
+    """
+    return fetch_docs(candidate_urls(web_urls, query, max_sources, deadline), max_sources, deadline)
+
+
+# 'bm25' (default) or 'heuristic' (the original substring scoring, kept for comparison)
+RANKER = os.getenv('RANKER', 'bm25')
+
+
+def doc_scores(docs: list, query: str | None, ranker: str = None) -> list:
+    """Score of each candidate doc for query (same order as docs) with the given or configured ranker."""
+    if (ranker or RANKER) == 'heuristic':
+        return heuristic_doc_scores(docs, query)
+    relevance = ranking.bm25_scores(docs, query or '')
+    scores = []
+    for doc, rel in zip(docs, relevance):
+        s = rel
+        if 'harbour.space' in doc.get('url', ''):
+            s += 5
+        # Near-empty pages are skipped later anyway
+        L = len(doc.get('text') or '')
+        if L < 250:
+            s -= 1
+        # Tie-break towards fuller pages when no query term matches (e.g. Russian question, English site)
+        scores.append(s + min(L / 2000.0, 2.0) * 0.01)
+    return scores
+
+
+def heuristic_doc_scores(docs: list, query: str | None) -> list:
     q = (query or '').lower()
     q_terms = [t for t in re.split(r"[^\w]+", q) if t and len(t) > 2]
     def score(doc):
@@ -705,8 +1509,76 @@ def choose_best_doc(docs: list, query: str | None) -> dict | None:
         else:
             s += min(L / 2000.0, 2.0)
         return s
-    best = max(docs, key=score)
-    return best
+    return [score(d) for d in docs]
+
+
+def choose_best_doc(docs: list, query: str | None) -> dict | None:
+    if not docs:
+        return None
+    with metrics.timed('rank'):
+        scores = doc_scores(docs, query)
+    return docs[max(range(len(docs)), key=scores.__getitem__)]
+
+
+# ---------- Multi-source citation answers ----------
+
+# Answer every searched turn from several numbered sources (otherwise only 'cite:' messages do)
+CITATION_MODE = os.getenv('CITATION_MODE', '0') == '1'
+CITATION_PREFIXES = ('cite:', 'sources:', 'источники:')
+CITATION_MAX_SOURCES = int(os.getenv('CITATION_MAX_SOURCES', '4'))
+# Prompt tokens the excerpts of all sources may use together (about 4 characters per token)
+CITATION_TOKEN_BUDGET = int(os.getenv('CITATION_TOKEN_BUDGET', '1500'))
+# A source that would get fewer tokens than this is left out
+CITATION_MIN_TOKENS = int(os.getenv('CITATION_MIN_TOKENS', '150'))
+# Time for searching and fetching the sources; pages still loading after it are left out
+CITATION_TIME_BUDGET_MS = float(os.getenv('CITATION_TIME_BUDGET_MS', '4000'))
+
+
+def pack_sources(docs: list, query: str | None, token_budget: int = None) -> tuple:
+    """'[n] title — url' list plus '[n] EXCERPT: ...' passages within token_budget; returns (block, docs used).
+
+    docs are expected best first. The budget is split evenly over the sources,
+    and what a short page leaves unused goes to the ones after it.
+    """
+    budget = (token_budget or CITATION_TOKEN_BUDGET) * 4
+    n = min(len(docs), max(1, budget // (CITATION_MIN_TOKENS * 4)))
+    if n < len(docs):
+        metrics.incr('citation.over_budget', len(docs) - n)
+    items = []
+    for i, doc in enumerate(docs[:n]):
+        excerpt = ranking.best_excerpt(doc.get('text') or '', query or '', budget // (n - i))
+        budget -= len(excerpt)
+        items.append((doc, excerpt))
+    if not items:
+        return '', []
+    header = '\n'.join(f"[{i}] {d.get('title') or d.get('url')} — {d.get('url')}" for i, (d, _) in enumerate(items, start=1))
+    excerpts = '\n\n'.join(f"[{i}] EXCERPT: {x}" for i, (_, x) in enumerate(items, start=1))
+    return f"{header}\n\n{excerpts}", [d for d, _ in items]
+
+
+def citation_sources(web_urls: list | None, query: str | None, max_sources: int = None,
+                     token_budget: int = None, time_budget_ms: float = None) -> tuple:
+    """(sources block, docs in citation order) for a citation answer, within the time and token budgets."""
+    deadline = time.monotonic() + (time_budget_ms or CITATION_TIME_BUDGET_MS) / 1000.0
+    docs = collect_web_docs(web_urls, None if web_urls else query, max_sources or CITATION_MAX_SOURCES, deadline)
+    # Same floor as single-page answers: near-empty pages only add noise
+    docs = [d for d in docs if len(d.get('text') or '') >= 350]
+    if not docs:
+        return '', []
+    with metrics.timed('rank'):
+        scores = doc_scores(docs, query)
+    order = sorted(range(len(docs)), key=lambda i: -scores[i])
+    block, used = pack_sources([docs[i] for i in order], query, token_budget)
+    metrics.incr('citation.answers')
+    metrics.incr('citation.sources', len(used))
+    metrics.incr('citation.tokens', len(block) // 4)
+    app.logger.info(f"Web sources used for query: {query or 'urls'} -> {[d.get('url') for d in used]}")
+    return block, used
+
+
+def build_sources_block(web_urls: list = None, query: str = None, max_sources: int = None, token_budget: int = None) -> str:
+    """Numbered sources block for CITATION_PROMPT ('' when nothing could be fetched)."""
+    return citation_sources(web_urls, query, max_sources, token_budget)[0]
 
 @app.route('/api/health', methods=['GET'])
 def health():
@@ -718,6 +1590,33 @@ def health():
     })
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_route():
+    """Per-worker counters, stage latency percentiles and memory"""
+    return jsonify(metrics.snapshot())
+
+
+@app.route('/api/metrics/reset', methods=['POST'])
+def metrics_reset_route():
+    """Clear metrics (only when METRICS_ALLOW_RESET=1, used by the benchmarks)"""
+    if os.getenv('METRICS_ALLOW_RESET') != '1':
+        return jsonify({'error': 'Metrics reset disabled'}), 403
+    metrics.reset()
+    return jsonify({'status': 'reset'})
+
+
+# Warm the page cache at startup (again per worker after a fork, on its first request).
+# serve.py preloads the app in the gunicorn master and starts them in each worker instead.
+if os.getenv('BACKGROUND_WORKERS_ON_IMPORT', '1') == '1':
+    start_background_workers()
+
+# Opt-in traffic recording (no-op unless RECORD_TRAFFIC_DIR is set)
+recorder.install(app, 'chat')
+
+# Opt-in request profiling (no-op unless PROFILE_ADMIN_TOKEN / PROFILE_SAMPLE_RATE is set)
+profiling.install(app, 'chat')
+
+
 if __name__ == '__main__':
     # Check if OpenAI API key is set
     if not openai.api_key:
@@ -726,7 +1625,7 @@ if __name__ == '__main__':
     else:
         print('✅ OpenAI API key configured')
     
-    # Run the Flask app
+    # Run the Flask app (development server; use serve.py in production)
     print('🚀 Starting Harbour.Space Chatbot...')
     print('📍 Open http://localhost:8080 in your browser')
     app.run(debug=True, host='0.0.0.0', port=8080)
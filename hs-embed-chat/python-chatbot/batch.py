@@ -0,0 +1,238 @@
+"""
+Batch runs of chat turns for offline evaluation and bulk questions.
+
+run() plays many items through the normal /api/chat path, at most `parallel`
+items at a time. An item is one question or a conversation of several turns.
+It yields one result per turn as each finishes, then a summary.
+
+Items of one batch share a Work memo. The same search query, the same
+uncached page or the same question to classify runs once. Other items that
+ask for it while it is in flight wait for that call instead of repeating it.
+Empty or failed results are not kept, so a later item tries again. Once a
+page has loaded, later items find it in page_cache anyway. BATCH_SHARE=0
+turns sharing off.
+
+The endpoint is off unless BATCH_ADMIN_TOKEN is set; callers send it in
+X-Batch-Token. All batches of a worker together run at most BATCH_MAX_PARALLEL
+items at once, which stays below ADMISSION_MAX_ACTIVE so interactive chats
+keep free slots.
+"""
+
+import copy
+import hmac
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import admission
+import metrics
+
+BATCH_ADMIN_TOKEN = os.getenv('BATCH_ADMIN_TOKEN', '')
+# 0: every item does its own searches, page loads and classification
+BATCH_SHARE = os.getenv('BATCH_SHARE', '1') == '1'
+BATCH_PARALLEL = int(os.getenv('BATCH_PARALLEL', '4'))
+# Half the worker's admission slots by default, and never all of them
+BATCH_MAX_PARALLEL = min(int(os.getenv('BATCH_MAX_PARALLEL', '0') or 0) or admission.ADMISSION_MAX_ACTIVE // 2,
+                         admission.ADMISSION_MAX_ACTIVE - 1) or 1
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+
+# How often an item waiting for a slot checks whether its batch was closed
+BATCH_SLOT_POLL_S = 0.2
+
+_SOURCE_LINE_RE = re.compile(r'\n\nSource: (https?://\S+)\s*$')
+
+# Item slots shared by every batch in this worker
+_slots = threading.BoundedSemaphore(BATCH_MAX_PARALLEL)
+
+_local = threading.local()
+
+
+class Work:
+    """Calls shared by the items of one batch: (kind, key) -> Future of the first caller's result."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.ran = Counter()
+        self.reused = Counter()
+
+    def stats(self) -> dict:
+        """{kind: {'ran': calls made, 'reused': calls answered by another item's call}}."""
+        with self._lock:
+            return {kind: {'ran': self.ran[kind], 'reused': self.reused[kind]}
+                    for kind in sorted(set(self.ran) | set(self.reused))}
+
+    def shared(self, kind: str, key, fn):
+        with self._lock:
+            fut = self._calls.get((kind, key))
+            owner = fut is None
+            if owner:
+                fut = self._calls[(kind, key)] = Future()
+            (self.ran if owner else self.reused)[kind] += 1
+        if not owner:
+            metrics.incr(f'batch.reused_{kind}')
+            # Callers may change what they get back (e.g. truncate page text)
+            return copy.copy(fut.result())
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self._calls.pop((kind, key), None)
+            fut.set_exception(e)
+            raise
+        if not result:
+            with self._lock:
+                self._calls.pop((kind, key), None)
+        fut.set_result(result)
+        return copy.copy(result)
+
+
+def authorized(token: str) -> bool:
+    """True when BATCH_ADMIN_TOKEN is set and token matches it."""
+    return bool(BATCH_ADMIN_TOKEN) and hmac.compare_digest((token or '').encode(), BATCH_ADMIN_TOKEN.encode())
+
+
+def bind(work):
+    """Share work (or None) for calls made on this thread."""
+    _local.work = work
+
+
+def current():
+    return getattr(_local, 'work', None)
+
+
+def shared(kind: str, key, fn):
+    """fn() - run once per batch for (kind, key) when this thread plays a batch item."""
+    work = current()
+    if work is None:
+        return fn()
+    return work.shared(kind, key, fn)
+
+
+def source_url(body: dict) -> str:
+    """The page a chat response answered from: first cited source, degraded source or 'Source:' line."""
+    data = body.get('data') or {}
+    if data.get('sources'):
+        return data['sources'][0].get('url') or ''
+    if data.get('source'):
+        return data['source']
+    m = _SOURCE_LINE_RE.search(body.get('response') or '')
+    return m.group(1) if m else ''
+
+
+def item_turns(item: dict) -> list:
+    """The messages of one batch item: its 'conversation' list, or its single 'message'."""
+    turns = item.get('conversation')
+    if turns is None:
+        turns = [item.get('message')]
+    return [t for t in turns if isinstance(t, str) and t.strip()]
+
+
+def _play(index: int, item: dict, turn, stop: threading.Event):
+    """Yield the result of each turn of item; a conversation stops at the first failed turn."""
+    item_id = item.get('id', index)
+    history = list(item.get('history') or [])
+    active = item.get('active_scenario') or ''
+    for n, message in enumerate(item_turns(item)):
+        if stop.is_set():
+            return
+        payload = {'message': message, 'history': list(history), 'active_scenario': active,
+                   'session_id': f"batch-{item_id}"}
+        if item.get('citations'):
+            payload['citations'] = True
+        t0 = time.perf_counter()
+        try:
+            status, body, stages = turn(payload)
+        except Exception as e:
+            status, body, stages = 500, {'error': str(e)}, {}
+        ms = (time.perf_counter() - t0) * 1000
+        data = body.get('data') or {}
+        line = {
+            'id': item_id,
+            'index': index,
+            'turn': n,
+            'message': message,
+            'status': status,
+            'ms': round(ms, 1),
+            'scenario': data.get('active_scenario') or '',
+            'source': source_url(body),
+            'type': body.get('type') or '',
+            'degraded': data.get('degraded') or '',
+            'response': body.get('response') or '',
+            'stages': stages,
+        }
+        if body.get('error'):
+            line['error'] = body['error']
+        yield line
+        if status != 200:
+            return
+        history.append({'role': 'user', 'content': message})
+        history.append({'role': 'assistant', 'content': body.get('response') or ''})
+        active = data.get('active_scenario') or active
+
+
+def run(items: list, turn, parallel: int = None):
+    """Play items with bounded parallelism; yield one dict per turn as it finishes, then {'summary': ...}.
+
+    At most parallel items of this batch run at once, and at most
+    BATCH_MAX_PARALLEL items of all batches together. turn(payload) answers
+    one /api/chat payload and returns (status, body, stages).
+    Closing the generator stops items from starting new turns.
+    """
+    parallel = max(1, min(parallel or BATCH_PARALLEL, BATCH_MAX_PARALLEL, len(items) or 1))
+    work = Work() if BATCH_SHARE else None
+    stop = threading.Event()
+    out = queue.Queue()
+
+    def play(index, item):
+        try:
+            # Concurrent batches share BATCH_MAX_PARALLEL slots
+            while not _slots.acquire(timeout=BATCH_SLOT_POLL_S):
+                if stop.is_set():
+                    return
+            bind(work)
+            try:
+                for line in _play(index, item, turn, stop):
+                    out.put(line)
+            finally:
+                bind(None)
+                _slots.release()
+        finally:
+            out.put(None)
+
+    t0 = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=parallel, thread_name_prefix='batch')
+    for i, item in enumerate(items):
+        pool.submit(play, i, item)
+    pool.shutdown(wait=False)
+    metrics.incr('batch.runs')
+    metrics.incr('batch.items', len(items))
+    statuses, latencies = {}, []
+    remaining = len(items)
+    try:
+        while remaining:
+            line = out.get()
+            if line is None:
+                remaining -= 1
+                continue
+            statuses[str(line['status'])] = statuses.get(str(line['status']), 0) + 1
+            latencies.append(line['ms'])
+            yield line
+    finally:
+        stop.set()
+    wall_s = time.perf_counter() - t0
+    metrics.incr('batch.turns', len(latencies))
+    yield {'summary': {
+        'items': len(items),
+        'turns': len(latencies),
+        'parallel': parallel,
+        'statuses': statuses,
+        'wall_s': round(wall_s, 3),
+        'turns_per_s': round(len(latencies) / wall_s, 2) if wall_s else 0.0,
+        'latency_ms': metrics.summarize(latencies),
+        'shared': work.stats() if work else {},
+    }}
@@ -0,0 +1,145 @@
+"""
+Batch evaluation of questions through /api/chat/batch.
+
+Sends a file of questions or conversations to the batch endpoint, writes
+every result line (scenario, source URL, stage timings, answer) to a JSON
+lines file and prints a summary. The summary has throughput, latency, per-stage
+p95, the work shared between items and, for items with an "expect" label,
+scenario accuracy on their first turn.
+
+    python -m bench.batch_eval                                  # fixtures/batch_questions.json against the stubs
+    python -m bench.batch_eval questions.txt --parallel 8 --repeat 5 --latency openai=600,search=250
+    python -m bench.batch_eval items.jsonl --app-url http://127.0.0.1:8080 --out nightly.jsonl
+
+Input: a JSON list of items, JSON lines (one item per line) or plain text
+(one question per line). An item is {"id", "message"} or {"id", "conversation": [...]},
+optionally with "expect" (scenario label), "history", "active_scenario" and "citations".
+
+The endpoint needs the app's BATCH_ADMIN_TOKEN: pass --token (or set
+BATCH_ADMIN_TOKEN) for --app-url; an app started here gets a fresh one.
+"""
+
+import argparse
+import json
+import os
+import secrets
+import sys
+import time
+
+import requests
+
+from bench.stubs import start_stubs, app_env, add_stub_arguments, config_from_args, FIXTURES_DIR
+from bench.loadtest import DEFAULT_APP_CMD, RESULTS_DIR, start_app, stop_app
+
+import metrics  # app dir is put on sys.path by bench.loadtest
+
+
+def load_items(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        raw = f.read()
+    if path.endswith('.json'):
+        return json.loads(raw)
+    if path.endswith('.jsonl'):
+        return [json.loads(line) for line in raw.splitlines() if line.strip()]
+    return [{'id': f'q{i}', 'message': line.strip()} for i, line in enumerate(raw.splitlines()) if line.strip()]
+
+
+def repeat_items(items: list, times: int) -> list:
+    if times <= 1:
+        return items
+    return [dict(item, id=f"{item.get('id', i)}#{r}") for r in range(times) for i, item in enumerate(items)]
+
+
+def evaluate(lines: list, items: list) -> dict:
+    """Per-stage p95, source and degraded rates, and first-turn scenario accuracy of result lines."""
+    stage_values = {}
+    for line in lines:
+        for name, ms in (line.get('stages') or {}).items():
+            stage_values.setdefault(name, []).append(ms)
+    expected = {str(item.get('id', i)): item.get('expect') for i, item in enumerate(items) if item.get('expect')}
+    per_label = {}
+    for line in lines:
+        label = expected.get(str(line.get('id')))
+        if not label or line.get('turn') != 0:
+            continue
+        counts = per_label.setdefault(label, {'n': 0, 'correct': 0})
+        counts['n'] += 1
+        counts['correct'] += int(line.get('scenario') == label)
+    judged = sum(c['n'] for c in per_label.values())
+    return {
+        'stages_p95_ms': {name: metrics.summarize(v)['p95'] for name, v in sorted(stage_values.items())},
+        'with_source': round(sum(1 for ln in lines if ln.get('source')) / len(lines), 3) if lines else 0.0,
+        'degraded': sum(1 for ln in lines if ln.get('degraded')),
+        'scenario_accuracy': round(sum(c['correct'] for c in per_label.values()) / judged, 3) if judged else None,
+        'missed_scenarios': {label: f"{c['correct']}/{c['n']}" for label, c in sorted(per_label.items())
+                             if c['correct'] < c['n']},
+    }
+
+
+def run_batch(url: str, items: list, parallel: int, timeout: float, out, token: str = '') -> tuple:
+    """POST items and copy result lines to out as they stream in; return (lines, summary)."""
+    lines, summary = [], None
+    with requests.post(url + '/api/chat/batch', json={'items': items, 'parallel': parallel},
+                       headers={'X-Batch-Token': token}, stream=True, timeout=timeout) as r:
+        if r.status_code != 200:
+            raise SystemExit(f"batch request failed: {r.status_code} {r.text[:300]}")
+        for raw in r.iter_lines():
+            if not raw:
+                continue
+            line = json.loads(raw)
+            if 'summary' in line:
+                summary = line['summary']
+                continue
+            lines.append(line)
+            out.write(json.dumps(line, ensure_ascii=False) + '\n')
+            print(f"[{len(lines)}] {line['id']} turn={line['turn']} status={line['status']} "
+                  f"{line['ms']:.0f}ms scenario={line['scenario'] or '-'} source={line['source'] or '-'}",
+                  file=sys.stderr)
+    return lines, summary
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default=os.path.join(FIXTURES_DIR, 'batch_questions.json'))
+    parser.add_argument('--parallel', type=int, default=4, help='items played at once by the server')
+    parser.add_argument('--repeat', type=int, default=1, help='send the items this many times (throughput runs)')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds to wait for the whole batch')
+    parser.add_argument('--app-url', default=None, help='use an already running app instead of starting one')
+    parser.add_argument('--token', default=os.getenv('BATCH_ADMIN_TOKEN', ''), help="the app's BATCH_ADMIN_TOKEN (default: $BATCH_ADMIN_TOKEN)")
+    parser.add_argument('--app-cmd', default=DEFAULT_APP_CMD, help='command to start the app; {python} and {port} are substituted')
+    parser.add_argument('--app-log', default=None, help='write app stdout/stderr to this file')
+    parser.add_argument('--env', action='append', help='extra KEY=VALUE for the app process (repeatable)')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--out', default=None, help='result lines (default bench/results/batch-<label>-<time>.jsonl)')
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+
+    items = repeat_items(load_items(args.input), args.repeat)
+    stubs = proc = None
+    url = args.app_url
+    token = args.token or ('' if url else secrets.token_hex(16))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = args.out or os.path.join(RESULTS_DIR, f"batch-{args.label or 'run'}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl")
+    try:
+        if not url:
+            stubs = start_stubs(config_from_args(args))
+            env = app_env(stubs.base_url)
+            env['BATCH_ADMIN_TOKEN'] = token
+            for kv in args.env or []:
+                k, _, v = kv.partition('=')
+                env[k] = v
+            proc, url = start_app(args.app_cmd, env, args.app_log)
+        with open(out_path, 'w', encoding='utf-8') as out:
+            lines, summary = run_batch(url, items, args.parallel, args.timeout, out, token)
+    finally:
+        stop_app(proc)
+        if stubs:
+            stubs.shutdown()
+    report = {'summary': summary, 'evaluation': evaluate(lines, items)}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    print(f"results written to {out_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,436 @@
+"""
+Offline load test for /api/chat.
+
+Starts the stub upstreams (bench/stubs.py), launches the app pointed at them
+(or uses --app-url), and drives concurrent multi-turn conversations from
+fixtures/conversations.json. Writes a JSON report with requests/sec, end-to-end
+and per-stage p50/p95/p99 (from the app's Server-Timing header) and peak RSS
+per worker process.
+
+    python -m bench.loadtest run --concurrency 8 --conversations 80
+    python -m bench.loadtest compare bench/results/a.json bench/results/b.json
+"""
+
+import argparse
+import base64
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.stubs import start_stubs, app_env, add_stub_arguments, config_from_args, FIXTURES_DIR
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(APP_DIR, 'bench', 'results')
+DEFAULT_APP_CMD = "{python} -c \"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)\""
+
+sys.path.insert(0, APP_DIR)
+import metrics  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def fake_image_data_url(kb: int) -> str:
+    payload = b'\x89PNG\r\n\x1a\n' + os.urandom(max(0, kb * 1024 - 8))
+    return 'data:image/png;base64,' + base64.b64encode(payload).decode('ascii')
+
+
+def load_conversations(path: str = None) -> list:
+    with open(path or os.path.join(FIXTURES_DIR, 'conversations.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def start_app(cmd_template: str, env: dict, log_path: str = None):
+    port = free_port()
+    cmd = cmd_template.format(python=sys.executable, port=port)
+    full_env = dict(os.environ)
+    full_env.update(env)
+    out = open(log_path, 'w') if log_path else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, shell=True, cwd=APP_DIR, env=full_env, stdout=out, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"app exited with code {proc.returncode} (command: {cmd})")
+        try:
+            if requests.get(url + '/api/health', timeout=1).ok:
+                return proc, url
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('app did not become healthy within 30s')
+
+
+def stop_app(proc):
+    if proc is None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+class WorkerPoller(threading.Thread):
+    """Polls /api/metrics and keeps peak RSS per worker pid."""
+
+    def __init__(self, url: str, interval: float):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.rss_kb = {}
+        self.counters = {}
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.poll()
+
+    def poll(self):
+        try:
+            snap = requests.get(self.url + '/api/metrics', timeout=2).json()
+        except (requests.RequestException, ValueError):
+            return
+        pid = str(snap.get('pid'))
+        self.rss_kb[pid] = max(self.rss_kb.get(pid, 0), snap.get('rss_kb') or 0)
+        self.counters[pid] = snap.get('counters') or {}
+
+    def stop(self):
+        self._stop.set()
+
+
+def post_chat(session, url: str, payload: dict, timeout: float, lang: str = '') -> tuple:
+    """POST one chat turn; return (sample, response body)."""
+    t0 = time.perf_counter()
+    try:
+        r = session.post(url + '/api/chat', json=payload, timeout=timeout)
+    except requests.RequestException as e:
+        return ({'status': 0, 'latency_ms': (time.perf_counter() - t0) * 1000, 'bytes': 0, 'wire_bytes': 0,
+                 'stages': {}, 'lang': lang, 'error': type(e).__name__}, None)
+    elapsed = (time.perf_counter() - t0) * 1000
+    body = r.json() if r.headers.get('Content-Type', '').startswith('application/json') else {}
+    return ({
+        'status': r.status_code,
+        'latency_ms': elapsed,
+        'bytes': len(r.content),
+        # requests decodes gzip/br: the header has the size on the wire
+        'wire_bytes': int(r.headers.get('Content-Length') or len(r.content)),
+        'stages': metrics.parse_server_timing(r.headers.get('Server-Timing')),
+        'lang': lang,
+    }, body)
+
+
+_ASSET_RE = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+_browser = threading.local()
+
+
+def load_page(session, url: str, timeout: float) -> list:
+    """Fetch the chat page, its assets and the scenario list like a browser with a per-thread cache.
+
+    Immutable responses are reused without a request; others are revalidated with If-None-Match.
+    """
+    cache = getattr(_browser, 'cache', None)
+    if cache is None:
+        cache = _browser.cache = {}
+    samples = []
+
+    def get(path: str) -> str:
+        cached = cache.get(path)
+        if cached and cached['immutable']:
+            samples.append({'path': path, 'status': 'cached', 'latency_ms': 0.0, 'bytes': 0, 'wire_bytes': 0})
+            return cached['body']
+        headers = {'If-None-Match': cached['etag']} if cached and cached['etag'] else {}
+        t0 = time.perf_counter()
+        try:
+            r = session.get(url + path, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            samples.append({'path': path, 'status': 0, 'latency_ms': (time.perf_counter() - t0) * 1000,
+                            'bytes': 0, 'wire_bytes': 0, 'error': type(e).__name__})
+            return ''
+        samples.append({'path': path, 'status': r.status_code, 'latency_ms': (time.perf_counter() - t0) * 1000,
+                        'bytes': len(r.content), 'wire_bytes': int(r.headers.get('Content-Length') or len(r.content))})
+        if r.status_code == 200:
+            cache[path] = {'etag': r.headers.get('ETag'), 'body': r.text,
+                           'immutable': 'immutable' in r.headers.get('Cache-Control', '')}
+            return r.text
+        return cached['body'] if cached and r.status_code == 304 else ''
+
+    html = get('/')
+    for asset in _ASSET_RE.findall(html):
+        get(asset.replace('&amp;', '&'))
+    get('/api/scenarios')
+    return samples
+
+
+def summarize_page_loads(samples: list) -> dict:
+    """Bytes and statuses of the page/asset requests made by load_page()."""
+    loads = sum(1 for s in samples if s['path'] == '/')
+    statuses = {}
+    for s in samples:
+        statuses[str(s['status'])] = statuses.get(str(s['status']), 0) + 1
+    wire = sum(s['wire_bytes'] for s in samples)
+    return {
+        'loads': loads,
+        'requests': sum(1 for s in samples if s['status'] != 'cached'),
+        'statuses': statuses,
+        'bytes': sum(s['bytes'] for s in samples),
+        'wire_bytes': wire,
+        'wire_bytes_per_load': round(wire / loads, 1) if loads else 0.0,
+        'latency_ms': metrics.summarize([s['latency_ms'] for s in samples if s['status'] != 'cached']),
+    }
+
+
+def run_conversation(url: str, conv: dict, image_kb: int, timeout: float, page_samples: list = None) -> list:
+    """Play one conversation; with page_samples, load the chat page first and record its requests there."""
+    history = []
+    active_scenario = ''
+    samples = []
+    session = requests.Session()
+    session_id = uuid.uuid4().hex
+    if page_samples is not None:
+        page_samples.extend(load_page(session, url, timeout))
+    for turn in conv.get('turns', []):
+        message = turn.get('message', '')
+        payload = {'message': message, 'history': list(history), 'active_scenario': active_scenario, 'session_id': session_id}
+        if turn.get('image'):
+            payload['image'] = fake_image_data_url(image_kb)
+        sample, body = post_chat(session, url, payload, timeout, conv.get('lang', ''))
+        samples.append(sample)
+        if body is None:
+            break
+        if message:
+            history.append({'role': 'user', 'content': message})
+        history.append({'role': 'assistant', 'content': body.get('response', '')})
+        if (body.get('data') or {}).get('active_scenario'):
+            active_scenario = body['data']['active_scenario']
+    return samples
+
+
+def sum_counters(per_worker: dict) -> dict:
+    total = {}
+    for counters in per_worker.values():
+        for name, value in counters.items():
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def hit_rates(counters: dict) -> dict:
+    """Derive <name>: hits / (hits + misses) for every <name>.hit / <name>.miss counter pair."""
+    rates = {}
+    for name, hits in counters.items():
+        if name.endswith('.hit'):
+            base = name[:-len('.hit')]
+            misses = counters.get(base + '.miss', 0)
+            if hits + misses:
+                rates[base] = round(hits / (hits + misses), 4)
+    return rates
+
+
+def summarize_samples(samples: list, wall_s: float, poller: WorkerPoller) -> dict:
+    """Throughput, latency, stage and worker figures shared by load and replay reports."""
+    ok = [s for s in samples if s['status'] == 200]
+    stage_values = {}
+    for s in ok:
+        for name, ms in s['stages'].items():
+            stage_values.setdefault(name, []).append(ms)
+    statuses = {}
+    for s in samples:
+        statuses[str(s['status'])] = statuses.get(str(s['status']), 0) + 1
+    counters = sum_counters(poller.counters)
+    return {
+        'requests': len(samples),
+        'ok': len(ok),
+        'statuses': statuses,
+        'duration_s': round(wall_s, 3),
+        'rps': round(len(samples) / wall_s, 2) if wall_s else 0.0,
+        'latency_ms': metrics.summarize([s['latency_ms'] for s in ok]),
+        'stages_ms': {name: metrics.summarize(v) for name, v in sorted(stage_values.items())},
+        'response_bytes': metrics.summarize([s['bytes'] for s in ok]),
+        'wire_bytes': metrics.summarize([s.get('wire_bytes', s['bytes']) for s in ok]),
+        # Turns shed by admission control (503 with a degraded answer)
+        'shed_latency_ms': metrics.summarize([s['latency_ms'] for s in samples if s['status'] == 503]),
+        'workers': {pid: {'peak_rss_kb': rss} for pid, rss in poller.rss_kb.items()},
+        'app_counters': counters,
+        'hit_rates': hit_rates(counters),
+    }
+
+
+def build_report(samples: list, wall_s: float, poller: WorkerPoller, stub_stats: dict, args,
+                 page_samples: list = None) -> dict:
+    report = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'concurrency': args.concurrency,
+            'conversations': args.conversations,
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'fail': args.fail,
+            'image_kb': args.image_kb,
+            'page_load': args.page_load,
+            'app_cmd': args.app_cmd if not args.app_url else None,
+        },
+    }
+    report.update(summarize_samples(samples, wall_s, poller))
+    if page_samples:
+        report['page_load'] = summarize_page_loads(page_samples)
+    report['upstream'] = stub_stats
+    return report
+
+
+def cmd_run(args) -> int:
+    stubs = None
+    if not args.app_url:
+        stubs = start_stubs(config_from_args(args))
+    proc = None
+    url = args.app_url
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    try:
+        if not url:
+            env = app_env(stubs.base_url)
+            env['METRICS_ALLOW_RESET'] = '1'
+            for kv in args.env or []:
+                k, _, v = kv.partition('=')
+                env[k] = v
+            proc, url = start_app(args.app_cmd, env, args.app_log)
+        conversations = load_conversations(args.fixture)
+        jobs = [conversations[i % len(conversations)] for i in range(args.conversations)]
+        if args.warmup:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                list(pool.map(lambda c: run_conversation(url, c, args.image_kb, args.timeout), jobs[:args.warmup]))
+        try:
+            requests.post(url + '/api/metrics/reset', timeout=2)
+        except requests.RequestException:
+            pass
+        stub_before = stubs.stats.snapshot() if stubs else None
+        poller = WorkerPoller(url, args.poll_interval)
+        poller.start()
+        t0 = time.perf_counter()
+        samples = []
+        page_samples = [] if args.page_load else None
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for conv_samples in pool.map(
+                    lambda c: run_conversation(url, c, args.image_kb, args.timeout, page_samples), jobs):
+                samples.extend(conv_samples)
+        wall = time.perf_counter() - t0
+        poller.stop()
+        poller.poll()
+        stub_stats = None
+        if stubs:
+            after = stubs.stats.snapshot()
+            stub_stats = {kind: {role: after[kind][role] - stub_before[kind][role] for role in after[kind]}
+                          for kind in after}
+        report = build_report(samples, wall, poller, stub_stats, args, page_samples)
+    finally:
+        stop_app(proc)
+        if stubs:
+            stubs.shutdown()
+    out = args.out or os.path.join(RESULTS_DIR, f"load-{args.label or 'run'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({k: report[k] for k in ('requests', 'ok', 'rps', 'latency_ms', 'stages_ms', 'workers')}, indent=2))
+    print(f"report written to {out}")
+    return 0
+
+
+# (path in report, higher_is_better)
+COMPARED_METRICS = [
+    (('rps',), True),
+    (('latency_ms', 'p50'), False),
+    (('latency_ms', 'p95'), False),
+    (('latency_ms', 'p99'), False),
+    (('wire_bytes', 'p50'), False),
+    (('page_load', 'wire_bytes_per_load'), False),
+]
+
+
+def _get(d: dict, path: tuple):
+    for key in path:
+        if not isinstance(d, dict) or key not in d:
+            return None
+        d = d[key]
+    return d
+
+
+def compare_reports(base: dict, new: dict, threshold_pct: float) -> tuple:
+    """Return (lines, regressed) comparing two load reports."""
+    paths = list(COMPARED_METRICS)
+    for stage in sorted(set(base.get('stages_ms', {})) | set(new.get('stages_ms', {}))):
+        paths.append((('stages_ms', stage, 'p95'), False))
+    for name in sorted(set(base.get('hit_rates', {})) | set(new.get('hit_rates', {}))):
+        paths.append((('hit_rates', name), True))
+    lines = []
+    regressed = False
+    for path, higher_better in paths:
+        a, b = _get(base, path), _get(new, path)
+        name = '.'.join(path)
+        if a is None or b is None:
+            lines.append(f"{name:40s} {str(a):>10s} -> {str(b):>10s}")
+            continue
+        delta = ((b - a) / a * 100.0) if a else 0.0
+        worse = (delta < -threshold_pct) if higher_better else (delta > threshold_pct)
+        regressed = regressed or worse
+        lines.append(f"{name:40s} {a:10.2f} -> {b:10.2f} {delta:+7.1f}%{'  REGRESSION' if worse else ''}")
+    for pid_map, label in ((base.get('workers', {}), 'base'), (new.get('workers', {}), 'new')):
+        peak = max((w.get('peak_rss_kb', 0) for w in pid_map.values()), default=0)
+        lines.append(f"peak worker rss ({label}){'':22s} {peak / 1024:10.1f} MiB")
+    return lines, regressed
+
+
+def cmd_compare(args) -> int:
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+    lines, regressed = compare_reports(base, new, args.threshold)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Offline load test for /api/chat against local stubs')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    run = sub.add_parser('run', help='run a load test and write a JSON report')
+    run.add_argument('--concurrency', type=int, default=8)
+    run.add_argument('--conversations', type=int, default=40, help='number of conversations (fixtures are cycled)')
+    run.add_argument('--warmup', type=int, default=0, help='conversations to run before measuring')
+    run.add_argument('--fixture', default=None, help='conversations JSON (default fixtures/conversations.json)')
+    run.add_argument('--image-kb', type=int, default=60, help='size of the fake image attached to image turns')
+    run.add_argument('--timeout', type=float, default=60.0)
+    run.add_argument('--page-load', action='store_true',
+                     help='load the chat page, its assets and /api/scenarios before each conversation')
+    run.add_argument('--app-url', default=None, help='use an already running app instead of starting one')
+    run.add_argument('--app-cmd', default=DEFAULT_APP_CMD, help='command to start the app; {python} and {port} are substituted')
+    run.add_argument('--app-log', default=None, help='write app stdout/stderr to this file')
+    run.add_argument('--env', action='append', help='extra KEY=VALUE for the app process (repeatable)')
+    run.add_argument('--poll-interval', type=float, default=0.5)
+    run.add_argument('--label', default='')
+    run.add_argument('--out', default=None)
+    add_stub_arguments(run)
+    run.set_defaults(func=cmd_run)
+
+    cmp_ = sub.add_parser('compare', help='compare two reports; exits 1 on regression')
+    cmp_.add_argument('base')
+    cmp_.add_argument('new')
+    cmp_.add_argument('--threshold', type=float, default=10.0, help='allowed change in percent')
+    cmp_.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
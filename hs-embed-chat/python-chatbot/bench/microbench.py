@@ -0,0 +1,172 @@
+"""
+Microbenchmarks for the pure functions on the /api/chat hot path.
+
+Covers choose_best_doc, match_scenario, _normalize_text, extract_urls,
+scenario_definitions_text, clean_html (the parsing step of fetch_and_clean)
+and the dedupe helpers with fixtures from bench/fixtures: long English, Russian
+and mixed-language messages, the recorded site pages and candidate lists of
+3 to 30 documents.
+
+    python -m bench.microbench run                  # print timings
+    python -m bench.microbench run -k choose_best   # only matching cases
+    python -m bench.microbench save                 # store bench/baselines/microbench.json
+    python -m bench.microbench compare              # run and compare with the stored baseline
+
+Baselines are machine-specific; re-save them on the machine that runs the
+comparison before starting performance work.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import timeit
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+# Pure-function timings only: no background page fetching while measuring
+os.environ.setdefault('CACHE_WARMER', '0')
+os.environ.setdefault('PREFETCH_LINKS', '0')
+
+import app  # noqa: E402
+import dedupe  # noqa: E402
+import scenarios  # noqa: E402
+from bench.stubs import SITE_DIR, FIXTURES_DIR  # noqa: E402
+
+BASELINE_PATH = os.path.join(APP_DIR, 'bench', 'baselines', 'microbench.json')
+
+
+def load_messages() -> dict:
+    with open(os.path.join(FIXTURES_DIR, 'messages.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_pages() -> dict:
+    pages = {}
+    for fn in sorted(os.listdir(SITE_DIR)):
+        if fn.endswith('.html'):
+            with open(os.path.join(SITE_DIR, fn), encoding='utf-8') as f:
+                pages[fn[:-len('.html')]] = f.read()
+    return pages
+
+
+def candidate_docs(pages: dict, n: int) -> list:
+    """n cleaned documents cycling through the recorded pages (with distinct URLs)."""
+    base = []
+    for name, html in pages.items():
+        url = 'https://harbour.space/' + ('' if name == 'index' else name.replace('__', '/'))
+        title, text = app.clean_html(html, url)
+        base.append({'url': url, 'title': title, 'text': text[:3000]})
+    docs = []
+    for i in range(n):
+        d = dict(base[i % len(base)])
+        if i >= len(base):
+            d['url'] = f"{d['url']}?v={i}"
+        docs.append(d)
+    return docs
+
+
+def build_cases() -> list:
+    """Return [(name, callable)] for every benchmark case."""
+    messages = load_messages()
+    pages = load_pages()
+    big_page = max(pages.values(), key=len)
+    cases = []
+    for key in ('short_en', 'long_en', 'long_ru', 'mixed'):
+        msg = messages[key]
+        cases.append((f"match_scenario[{key}]", lambda m=msg: scenarios.match_scenario(m)))
+        cases.append((f"_normalize_text[{key}]", lambda m=msg: scenarios._normalize_text(m)))
+        cases.append((f"extract_urls[{key}]", lambda m=msg: app.extract_urls(m)))
+    # Messages with no alias hit fall through to the fuzzy difflib stages
+    cases.append(("match_scenario[greeting]", lambda m=messages['greeting']: scenarios.match_scenario(m)))
+    cases.append(("match_scenario[follow_up]", lambda m=messages['follow_up']: scenarios.match_scenario(m)))
+    cases.append(("scenario_definitions_text", scenarios.scenario_definitions_text))
+    cases.append(("clean_html[admissions]", lambda h=pages['admissions']: app.clean_html(h, 'https://harbour.space/admissions')))
+    cases.append(("clean_html[largest]", lambda h=big_page: app.clean_html(h, 'https://harbour.space/')))
+    _, admissions_text = app.clean_html(pages['admissions'], 'https://harbour.space/admissions')
+    cases.append(("dedupe.simhash[admissions]", lambda t=admissions_text: dedupe.simhash(t)))
+    cases.append(("dedupe.canonical_url", lambda: dedupe.canonical_url('HTTP://Harbour.Space:80/admissions/?utm_source=x&b=2&a=1#top')))
+    for n in (3, 12, 30):
+        docs = candidate_docs(pages, n)
+        for key in ('long_en', 'long_ru'):
+            q = messages[key]
+            cases.append((f"choose_best_doc[{n}docs,{key}]", lambda d=docs, q=q: app.choose_best_doc(d, q)))
+    return cases
+
+
+def measure(fn, repeat: int, min_time: float) -> dict:
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    if elapsed < min_time:
+        number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    runs = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        'loops': number,
+        'min_us': round(min(runs), 3),
+        'median_us': round(statistics.median(runs), 3),
+        'mean_us': round(statistics.mean(runs), 3),
+    }
+
+
+def run_cases(filter_: str = None, repeat: int = 5, min_time: float = 0.2) -> dict:
+    results = {}
+    for name, fn in build_cases():
+        if filter_ and filter_ not in name:
+            continue
+        results[name] = measure(fn, repeat, min_time)
+        print(f"{name:45s} {results[name]['median_us']:12.2f} us  (min {results[name]['min_us']:.2f}, loops {results[name]['loops']})")
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+
+def compare(base: dict, new: dict, threshold_pct: float) -> bool:
+    regressed = False
+    for name, cur in new['results'].items():
+        ref = base.get('results', {}).get(name)
+        if not ref:
+            print(f"{name:45s} {'-':>12s} -> {cur['median_us']:12.2f} us  (new)")
+            continue
+        delta = (cur['median_us'] - ref['median_us']) / ref['median_us'] * 100.0
+        worse = delta > threshold_pct
+        regressed = regressed or worse
+        print(f"{name:45s} {ref['median_us']:12.2f} -> {cur['median_us']:12.2f} us {delta:+7.1f}%{'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Microbenchmarks for hot-path helper functions')
+    parser.add_argument('cmd', choices=['run', 'save', 'compare'])
+    parser.add_argument('-k', dest='filter', default=None, help='only run cases whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per repeat')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--threshold', type=float, default=15.0, help='allowed slowdown in percent for compare')
+    parser.add_argument('--out', default=None, help='also write this run to a JSON file')
+    args = parser.parse_args(argv)
+
+    report = run_cases(args.filter, args.repeat, args.min_time)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.cmd == 'save':
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    elif args.cmd == 'compare':
+        with open(args.baseline, encoding='utf-8') as f:
+            base = json.load(f)
+        print()
+        return 1 if compare(base, report, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Relevance and latency comparison of the choose_best_doc rankers.
+
+Relevance uses the labelled questions in bench/fixtures/ranking.json against
+every recorded site page (reader text for JavaScript-only pages): top-1
+accuracy and mean reciprocal rank of the first relevant page. Latency is
+the time to score 3, 12 and 30 candidates, with term vectors already on the
+docs ("warm", as for pages from the page cache) and rebuilt on every call
+("cold", a page fetched in this request).
+
+    python -m bench.ranking
+    python -m bench.ranking --out bench/results/ranking.json
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.environ.setdefault('CACHE_WARMER', '0')
+os.environ.setdefault('PREFETCH_LINKS', '0')
+
+import app  # noqa: E402
+import ranking  # noqa: E402
+from bench.microbench import measure  # noqa: E402
+from bench.stubs import FIXTURES_DIR, SITE_URL, _site_file, site_paths  # noqa: E402
+
+RANKERS = ('heuristic', 'bm25')
+
+
+def site_docs() -> list:
+    docs = []
+    for path in site_paths():
+        url = SITE_URL + path
+        try:
+            with open(_site_file(path, '.txt'), encoding='utf-8') as f:
+                raw = f.read()
+            m = re.search(r'^Title:\s*(.+)$', raw, re.M)
+            title, text = (m.group(1).strip() if m else url), ' '.join(raw.split())
+        except OSError:
+            with open(_site_file(path, '.html'), encoding='utf-8') as f:
+                title, text = app.clean_html(f.read(), url)
+        docs.append({'url': url, 'title': title, 'text': text[:3000]})
+    return docs
+
+
+def relevance(docs: list, cases: list, ranker: str) -> dict:
+    hits, rr, misses = 0, 0.0, []
+    for case in cases:
+        scores = app.doc_scores(docs, case['query'], ranker)
+        order = sorted(range(len(docs)), key=lambda i: -scores[i])
+        paths = [docs[i]['url'][len(SITE_URL):] or '/' for i in order]
+        rank = next((k + 1 for k, p in enumerate(paths) if p in case['relevant']), None)
+        hits += rank == 1
+        rr += 1.0 / rank if rank else 0.0
+        if rank != 1:
+            misses.append({'query': case['query'], 'top': paths[0], 'relevant_rank': rank})
+    n = len(cases) or 1
+    return {'top1': round(hits / n, 3), 'mrr': round(rr / n, 3), 'misses': misses}
+
+
+def latency(docs: list, query: str, ranker: str, n: int, warm: bool) -> dict:
+    cands = [dict(docs[i % len(docs)], url=f"{docs[i % len(docs)]['url']}?v={i}") for i in range(n)]
+    if warm:
+        app.doc_scores(cands, query, ranker)
+        return measure(lambda: app.doc_scores(cands, query, ranker), 5, 0.2)
+
+    def cold():
+        for d in cands:
+            d.pop('tf', None)
+        app.doc_scores(cands, query, ranker)
+    return measure(cold, 5, 0.2)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Compare choose_best_doc rankers')
+    parser.add_argument('--out', default=None, help='also write the report to a JSON file')
+    args = parser.parse_args(argv)
+
+    with open(os.path.join(FIXTURES_DIR, 'ranking.json'), encoding='utf-8') as f:
+        cases = json.load(f)
+    with open(os.path.join(FIXTURES_DIR, 'messages.json'), encoding='utf-8') as f:
+        query = json.load(f)['long_en']
+    docs = site_docs()
+    report = {'cases': len(cases), 'rankers': {}}
+    for ranker in RANKERS:
+        ranking.reset()
+        rel = relevance(docs, cases, ranker)
+        timings = {}
+        for n in (3, 12, 30):
+            for warm in (True, False):
+                if ranker == 'heuristic' and not warm:
+                    continue  # nothing to precompute
+                timings[f"{n}docs{'' if warm else ',cold'}"] = latency(docs, query, ranker, n, warm)['median_us']
+        report['rankers'][ranker] = {'relevance': rel, 'median_us': timings}
+        print(f"{ranker:10s} top1={rel['top1']:.3f} mrr={rel['mrr']:.3f}  " +
+              '  '.join(f"{k}={v:.1f}us" for k, v in timings.items()))
+        for miss in rel['misses']:
+            print(f"{'':10s} miss: {miss['query']!r} -> {miss['top']} (relevant at {miss['relevant_rank']})")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
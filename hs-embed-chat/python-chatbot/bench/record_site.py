@@ -0,0 +1,58 @@
+"""
+Refresh the recorded harbour.space pages served by the stub site.
+
+    python -m bench.record_site                      # default hot pages
+    python -m bench.record_site https://harbour.space/bangkok
+
+Pages are saved under fixtures/site using the stub naming scheme
+(/admissions/scholarship -> admissions__scholarship.html). The checked-in
+fixtures are trimmed stand-ins; re-record when the live site changes shape.
+"""
+
+import os
+import sys
+from urllib.parse import urlparse
+
+import requests
+
+from bench.stubs import SITE_DIR
+
+DEFAULT_URLS = [
+    'https://harbour.space/',
+    'https://harbour.space/admissions',
+    'https://harbour.space/admissions/scholarship',
+    'https://harbour.space/scholarships',
+    'https://harbour.space/bachelors',
+    'https://harbour.space/programmes',
+    'https://harbour.space/about',
+    'https://harbour.space/barcelona/master/computer-science',
+    'https://harbour.space/barcelona/master/data-science',
+]
+
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
+}
+
+
+def main(argv=None) -> int:
+    urls = (argv if argv is not None else sys.argv[1:]) or DEFAULT_URLS
+    os.makedirs(SITE_DIR, exist_ok=True)
+    failed = 0
+    for url in urls:
+        name = urlparse(url).path.strip('/').replace('/', '__') or 'index'
+        try:
+            r = requests.get(url, headers=HEADERS, timeout=15)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            print(f"skip {url}: {e}")
+            failed += 1
+            continue
+        with open(os.path.join(SITE_DIR, name + '.html'), 'w', encoding='utf-8') as f:
+            f.write(r.text)
+        print(f"saved {url} -> {name}.html ({len(r.text)} chars)")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""
+Replay recorded /api/chat traffic (see recorder.py) against the local stubs.
+
+The stubs serve the recorded upstream responses (search pages, fetched pages,
+reader output, OpenAI completions) with their recorded latency; anything not
+in the recording falls back to the synthetic stubs. Requests are re-sent with
+their original spacing divided by --speed (0 = as fast as --concurrency allows),
+with history and images synthesised to the recorded sizes.
+
+    python -m bench.replay run recordings/chat-20261019.jsonl --speed 10 --label v2
+    python -m bench.loadtest compare bench/results/replay-v1-*.json bench/results/replay-v2-*.json
+
+The report has the same shape as a load-test report plus replay hit/miss
+counts, so hit_rates (e.g. page cache) can be compared across versions.
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench.stubs import start_stubs, app_env, add_stub_arguments, config_from_args, replay_key
+from bench.loadtest import (
+    DEFAULT_APP_CMD, RESULTS_DIR, WorkerPoller, fake_image_data_url, post_chat,
+    start_app, stop_app, summarize_samples,
+)
+import metrics
+
+
+class ReplayBook:
+    """Recorded upstream responses keyed like stub requests; repeated keys are served round-robin."""
+
+    def __init__(self, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self._entries = {}
+        self._next = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, role: str, key: tuple, status: int, body: str, elapsed_ms):
+        self._entries.setdefault((role,) + key, []).append({'status': status, 'body': body or '', 'elapsed_ms': elapsed_ms})
+
+    def lookup(self, role: str, key: tuple):
+        k = (role,) + key
+        with self._lock:
+            items = self._entries.get(k)
+            if not items:
+                self.misses += 1
+                return None
+            i = self._next.get(k, 0)
+            self._next[k] = i + 1
+            self.hits += 1
+            return items[i % len(items)]
+
+    @classmethod
+    def from_records(cls, records: list, latency_scale: float = 1.0):
+        book = cls(latency_scale)
+        for rec in records:
+            for up in rec.get('upstream', []):
+                role = up.get('role')
+                if role == 'openai':
+                    kind = up.get('url')
+                    book.add(role, (kind, rec.get('message', '').strip()), up.get('status', 200), up.get('body'), up.get('elapsed_ms'))
+                elif role in ('search', 'site', 'reader'):
+                    book.add(role, replay_key(role, up.get('url', '')), up.get('status', 200), up.get('body'), up.get('elapsed_ms'))
+        return book
+
+
+def load_records(paths: list) -> list:
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r.get('ts', 0))
+    return records
+
+
+def synth_history(n: int, chars: int) -> list:
+    per = max(1, chars // n) if n else 0
+    return [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': ('lorem ipsum ' * (per // 12 + 1))[:per]}
+            for i in range(n)]
+
+
+def build_payload(rec: dict) -> dict:
+    payload = {
+        'message': rec.get('message', ''),
+        'history': synth_history(rec.get('history_len', 0), rec.get('history_chars', 0)),
+        'active_scenario': rec.get('active_scenario', ''),
+    }
+    if rec.get('image_bytes'):
+        payload['image'] = fake_image_data_url(max(1, rec['image_bytes'] * 3 // 4 // 1024))
+    return payload
+
+
+def traffic_mix(records: list) -> dict:
+    n = len(records) or 1
+    return {
+        'requests': len(records),
+        'sessions': len({r.get('session') for r in records}),
+        'cyrillic_share': round(sum(1 for r in records if r.get('cyrillic')) / n, 3),
+        'image_share': round(sum(1 for r in records if r.get('image_bytes')) / n, 3),
+        'prefixed_share': round(sum(1 for r in records if r.get('prefix')) / n, 3),
+        'mean_history_len': round(sum(r.get('history_len', 0) for r in records) / n, 2),
+    }
+
+
+def cmd_run(args) -> int:
+    records = load_records(args.recordings)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print('no records to replay')
+        return 1
+    book = ReplayBook.from_records(records, args.latency_scale)
+    stubs = start_stubs(config_from_args(args), replay=book)
+    proc = None
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    try:
+        env = app_env(stubs.base_url)
+        env['METRICS_ALLOW_RESET'] = '1'
+        for kv in args.env or []:
+            k, _, v = kv.partition('=')
+            env[k] = v
+        proc, url = start_app(args.app_cmd, env, args.app_log)
+        poller = WorkerPoller(url, args.poll_interval)
+        poller.start()
+        t_first = records[0].get('ts', 0)
+        local = threading.local()
+
+        def send(rec):
+            if args.speed > 0:
+                delay = (rec.get('ts', t_first) - t_first) / args.speed - (time.perf_counter() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            sample, _ = post_chat(local.session, url, build_payload(rec), args.timeout, 'ru' if rec.get('cyrillic') else '')
+            sample['recorded_latency_ms'] = rec.get('latency_ms')
+            return sample
+
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            samples = list(pool.map(send, records))
+        wall = time.perf_counter() - t0
+        poller.stop()
+        poller.poll()
+        report = {
+            'label': args.label,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {
+                'recordings': args.recordings,
+                'speed': args.speed,
+                'concurrency': args.concurrency,
+                'latency_scale': args.latency_scale,
+                'app_cmd': args.app_cmd,
+            },
+            'traffic': traffic_mix(records),
+        }
+        report.update(summarize_samples(samples, wall, poller))
+        recorded = [r['latency_ms'] for r in records if r.get('latency_ms') is not None]
+        report['recorded_latency_ms'] = metrics.summarize(recorded)
+        report['replay'] = {'hits': book.hits, 'misses': book.misses}
+        report['upstream'] = stubs.stats.snapshot()
+    finally:
+        stop_app(proc)
+        stubs.shutdown()
+    out = args.out or os.path.join(RESULTS_DIR, f"replay-{args.label or 'run'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps({k: report[k] for k in ('traffic', 'requests', 'ok', 'rps', 'latency_ms', 'recorded_latency_ms', 'hit_rates', 'replay')}, indent=2))
+    print(f"report written to {out}")
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Replay recorded /api/chat traffic against local stubs')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    run = sub.add_parser('run', help='replay one or more recording files and write a JSON report')
+    run.add_argument('recordings', nargs='+', help='JSONL files written by the recorder')
+    run.add_argument('--speed', type=float, default=1.0, help='pacing multiplier (1 = original spacing, 0 = no pacing)')
+    run.add_argument('--concurrency', type=int, default=16)
+    run.add_argument('--latency-scale', type=float, default=1.0, help='multiplier for recorded upstream latencies')
+    run.add_argument('--limit', type=int, default=0, help='replay only the first N records')
+    run.add_argument('--timeout', type=float, default=60.0)
+    run.add_argument('--app-cmd', default=DEFAULT_APP_CMD)
+    run.add_argument('--app-log', default=None)
+    run.add_argument('--env', action='append', help='extra KEY=VALUE for the app process (repeatable)')
+    run.add_argument('--poll-interval', type=float, default=0.5)
+    run.add_argument('--label', default='')
+    run.add_argument('--out', default=None)
+    add_stub_arguments(run)
+    run.set_defaults(func=cmd_run)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
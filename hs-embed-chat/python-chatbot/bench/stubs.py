@@ -0,0 +1,483 @@
+"""
+Local stand-ins for every upstream the chatbot talks to.
+
+One threaded HTTP server answers, by path prefix:
+    /openai/v1/chat/completions   fake OpenAI chat-completions API
+    /ddg/html/, /ddg/lite/        fake DuckDuckGo HTML and lite result pages
+    /bing/search                  fake Bing result page
+    /reader/<url>                 fake r.jina.ai reader proxy
+    /site/<path>                  recorded harbour.space pages from fixtures/site
+
+Each role has configurable latency (mean ms, +/- jitter) and failure rate, and
+the server counts calls per role. With a replay book attached (bench/replay.py)
+recorded upstream responses are served first, with their recorded latency.
+Run standalone with
+    python -m bench.stubs --port 9100
+and point the app at it with the printed environment variables.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scenarios import SCENARIO_NAMES, match_scenario  # noqa: E402
+from recorder import redact  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+SITE_DIR = os.path.join(FIXTURES_DIR, 'site')
+SITE_URL = 'https://harbour.space'
+
+ROLES = ('openai', 'search', 'reader', 'site')
+
+DEFAULT_LATENCY_MS = {'openai': 600, 'search': 250, 'reader': 400, 'site': 120}
+
+ANSWER_SENTENCES = [
+    "Harbour.Space teaches in English through intensive three-week modules.",
+    "Applications are reviewed on a rolling basis, so applying early is recommended.",
+    "Every admitted student is automatically considered for a scholarship.",
+    "The admissions process includes an online application, a test or portfolio review and an interview.",
+    "You can find the current deadlines on the programme page.",
+    "Feel free to ask about a specific programme or campus.",
+]
+
+
+def parse_role_map(spec: str, cast=float) -> dict:
+    """Parse 'openai=600,search=250' into {'openai': 600.0, 'search': 250.0}."""
+    out = {}
+    for part in (spec or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        key, _, value = part.partition('=')
+        key = key.strip()
+        if key not in ROLES:
+            raise ValueError(f"unknown stub role '{key}' (expected one of {ROLES})")
+        out[key] = cast(value)
+    return out
+
+
+class StubConfig:
+    def __init__(self, latency_ms=None, jitter=0.25, fail_rate=None, ms_per_token=2.0, ms_per_prompt_token=0.05, seed=None,
+                 mirror_rate=0.0):
+        self.latency_ms = dict(DEFAULT_LATENCY_MS)
+        self.latency_ms.update(latency_ms or {})
+        self.jitter = jitter
+        self.fail_rate = dict(fail_rate or {})
+        self.ms_per_token = ms_per_token
+        self.ms_per_prompt_token = ms_per_prompt_token
+        self.mirror_rate = mirror_rate
+        self.random = random.Random(seed)
+
+
+class StubStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {r: 0 for r in ROLES}
+        self.failures = {r: 0 for r in ROLES}
+
+    def record(self, role: str, failed: bool):
+        with self._lock:
+            self.calls[role] += 1
+            if failed:
+                self.failures[role] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'calls': dict(self.calls), 'failures': dict(self.failures)}
+
+
+def _site_file(path: str, ext: str) -> str:
+    name = path.strip('/').replace('/', '__') or 'index'
+    return os.path.join(SITE_DIR, name + ext)
+
+
+def site_paths() -> list:
+    paths = []
+    for fn in sorted(os.listdir(SITE_DIR)):
+        if fn.endswith('.html'):
+            name = fn[:-len('.html')]
+            paths.append('/' if name == 'index' else '/' + name.replace('__', '/'))
+    return paths
+
+
+def _page_text(path: str) -> str:
+    try:
+        with open(_site_file(path, '.txt'), encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        pass
+    with open(_site_file(path, '.html'), encoding='utf-8') as f:
+        return BeautifulSoup(f.read(), 'html.parser').get_text(separator=' ')
+
+
+_SEARCH_INDEX = None
+
+
+def _search_index() -> list:
+    global _SEARCH_INDEX
+    if _SEARCH_INDEX is None:
+        idx = []
+        for path in site_paths():
+            words = set(re.findall(r'\w+', (path + ' ' + _page_text(path)).lower()))
+            idx.append((path, words))
+        _SEARCH_INDEX = idx
+    return _SEARCH_INDEX
+
+
+# Ways search engines return the same page under another URL
+MIRROR_VARIANTS = (
+    lambda u: u + '/',
+    lambda u: u + '?utm_source=newsletter&utm_medium=email',
+    lambda u: u.replace('https://', 'http://', 1),
+    lambda u: u.replace(SITE_URL, SITE_URL + '/barcelona', 1),
+)
+
+
+def search_results(query: str, n: int = 5, rnd: random.Random = None, mirror_rate: float = 0.0) -> list:
+    """Rank recorded pages by word overlap with the query; always returns harbour.space URLs.
+
+    With mirror_rate > 0 each result after the first is, with that probability,
+    replaced by a mirror URL of an earlier result.
+    """
+    terms = set(re.findall(r'\w+', (query or '').lower())) - {'site', 'harbour', 'space', 'university'}
+    scored = []
+    for path, words in _search_index():
+        scored.append((len(terms & words) + (2 if any(t in path for t in terms) else 0), path))
+    scored.sort(key=lambda x: (-x[0], x[1]))
+    urls = [SITE_URL + path for score, path in scored[:n]]
+    if rnd is not None and mirror_rate > 0:
+        for i in range(1, len(urls)):
+            if rnd.random() < mirror_rate:
+                urls[i] = rnd.choice(MIRROR_VARIANTS)(urls[rnd.randrange(i)])
+    return urls
+
+
+def _fake_classification(messages: list) -> str:
+    label = match_scenario(_last_user_text(messages))
+    return label if label in SCENARIO_NAMES else 'off_topic'
+
+
+def _fake_answer(rnd: random.Random) -> str:
+    # Like a real model, the answer's length does not depend on max_tokens; completion_response cuts it
+    words_budget = rnd.randint(30, 160)
+    out = []
+    while sum(len(s.split()) for s in out) < words_budget:
+        out.append(rnd.choice(ANSWER_SENTENCES))
+    return ' '.join(out)
+
+
+def _last_user_text(messages: list) -> str:
+    user = ''
+    for m in messages:
+        if m.get('role') == 'user':
+            content = m.get('content')
+            if isinstance(content, list):
+                content = ' '.join(p.get('text', '') for p in content if p.get('type') == 'text')
+            user = content or ''
+    return user
+
+
+def _is_classifier_call(messages: list) -> bool:
+    system = ' '.join(m.get('content', '') for m in messages if m.get('role') == 'system' and isinstance(m.get('content'), str))
+    return 'intent classifier' in system
+
+
+def replay_key(role: str, url: str) -> tuple:
+    """Key a recorded or incoming upstream URL so recordings made against live services match stub requests."""
+    parsed = urlparse(url)
+    if role == 'search':
+        engine = 'ddg_lite' if 'lite' in url else ('bing' if 'bing' in url else 'ddg_html')
+        # Recordings keep the query redacted like the message; key live queries the same way
+        return (engine, redact((parse_qs(parsed.query).get('q') or [''])[0]))
+    if role == 'reader':
+        # https://r.jina.ai/http://host/path (recorded) or /reader/http://host/path (stub)
+        idx = url.find('http', 1)
+        target = urlparse(url[idx:]) if idx > 0 else parsed
+        path = target.path
+    else:
+        path = parsed.path
+        if 'harbour' not in parsed.netloc and (path == '/site' or path.startswith('/site/')):
+            path = path[len('/site'):]
+    return ((path.rstrip('/') or '/') + (f"?{parsed.query}" if role == 'site' and parsed.query else ''),)
+
+
+def openai_replay_key(body: dict) -> tuple:
+    messages = body.get('messages') or []
+    return ('classify' if _is_classifier_call(messages) else 'answer', _last_user_text(messages).strip())
+
+
+def completion_response(body: dict, rnd: random.Random, content: str = None) -> dict:
+    messages = body.get('messages') or []
+    if content is None:
+        if _is_classifier_call(messages):
+            content = _fake_classification(messages)
+        else:
+            content = _fake_answer(rnd)
+    message = {'role': 'assistant', 'content': content}
+    if body.get('functions'):
+        # Single-call mode: answer and scenario label come back as function arguments
+        args = json.dumps({'scenario': _fake_classification(messages), 'answer': content}, ensure_ascii=False)
+        message = {'role': 'assistant', 'content': None,
+                   'function_call': {'name': body['functions'][0]['name'], 'arguments': args}}
+        content = args
+    prompt_chars = sum(len(json.dumps(m.get('content'))) for m in messages) + len(json.dumps(body.get('functions') or ''))
+    finish_reason = 'stop'
+    max_tokens = body.get('max_tokens')
+    # About 4 characters per token: output past max_tokens is cut off mid-text, as the API does
+    if max_tokens and len(content) > max_tokens * 4:
+        content = content[:max_tokens * 4]
+        finish_reason = 'length'
+        if message.get('function_call'):
+            message['function_call']['arguments'] = content
+        else:
+            message['content'] = content
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        'id': 'chatcmpl-' + uuid.uuid4().hex[:12],
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'stub'),
+        'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+        'usage': {'prompt_tokens': prompt_chars // 4, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_chars // 4 + completion_tokens},
+    }
+
+
+def ddg_html_page(urls: list) -> str:
+    items = ''.join(
+        f'<div class="result"><h2 class="result__title"><a class="result__a" href="//duckduckgo.com/l/?uddg={quote(u, safe="")}&rut=x">{u}</a></h2></div>'
+        for u in urls
+    )
+    return f'<html><body><div id="links">{items}</div></body></html>'
+
+
+def ddg_lite_page(urls: list) -> str:
+    rows = ''.join(f'<tr><td><a rel="nofollow" href="//duckduckgo.com/l/?uddg={quote(u, safe="")}">{u}</a></td></tr>' for u in urls)
+    return f'<html><body><a href="/lite/">DuckDuckGo</a><table>{rows}</table></body></html>'
+
+
+def bing_page(urls: list) -> str:
+    items = ''.join(f'<li class="b_algo"><h2><a href="{u}">{u}</a></h2><p>snippet</p></li>' for u in urls)
+    return f'<html><body><ol id="b_results">{items}</ol></body></html>'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = 'ChatbotStub/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body, content_type='text/html; charset=utf-8'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            content_type = 'application/json'
+        data = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _role(self, path: str):
+        if path.startswith('/openai/'):
+            return 'openai'
+        if path.startswith(('/ddg/', '/bing/')):
+            return 'search'
+        if path.startswith('/reader/'):
+            return 'reader'
+        if path.startswith('/site'):
+            return 'site'
+        return None
+
+    def _delay(self, role: str, extra_ms: float = 0.0):
+        cfg = self.server.config
+        base = cfg.latency_ms.get(role, 0)
+        ms = base * (1 + cfg.random.uniform(-cfg.jitter, cfg.jitter)) + extra_ms
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def _replay(self, role: str, key) -> bool:
+        book = self.server.replay
+        if book is None:
+            return False
+        hit = book.lookup(role, key)
+        if hit is None:
+            return False
+        self.server.stats.record(role, hit['status'] >= 400)
+        if hit.get('elapsed_ms'):
+            time.sleep(hit['elapsed_ms'] * book.latency_scale / 1000.0)
+        if role == 'openai':
+            if hit['status'] >= 400:
+                self._send(hit['status'], {'error': {'message': 'Rate limit reached (replay)', 'type': 'requests'}})
+            else:
+                self._send(200, completion_response(self._body, self.server.config.random, content=hit['body']))
+        else:
+            ctype = 'text/plain; charset=utf-8' if role == 'reader' else 'text/html; charset=utf-8'
+            self._send(hit['status'], hit['body'], ctype)
+        return True
+
+    def _maybe_fail(self, role: str) -> bool:
+        cfg = self.server.config
+        if cfg.random.random() >= cfg.fail_rate.get(role, 0.0):
+            return False
+        self._delay(role)
+        if role == 'openai':
+            self._send(429, {'error': {'message': 'Rate limit reached (stub)', 'type': 'requests', 'code': 'rate_limit_exceeded'}})
+        else:
+            self._send(503, '<html><body>Service unavailable (stub)</body></html>')
+        return True
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        role = self._role(parsed.path)
+        if role is None or role == 'openai':
+            self._send(404, 'not found')
+            return
+        if self._replay(role, replay_key(role, self.path)):
+            return
+        failed = self._maybe_fail(role)
+        self.server.stats.record(role, failed)
+        if failed:
+            return
+        self._delay(role)
+        if role == 'search':
+            q = (parse_qs(parsed.query).get('q') or [''])[0]
+            cfg = self.server.config
+            urls = search_results(q, n=5, rnd=cfg.random, mirror_rate=cfg.mirror_rate)
+            if parsed.path.startswith('/ddg/html'):
+                self._send(200, ddg_html_page(urls))
+            elif parsed.path.startswith('/ddg/lite'):
+                self._send(200, ddg_lite_page(urls))
+            else:
+                self._send(200, bing_page(urls))
+        elif role == 'reader':
+            target = urlparse(self.path[len('/reader/'):])
+            try:
+                self._send(200, _page_text(target.path or '/'), 'text/plain; charset=utf-8')
+            except OSError:
+                self._send(404, 'Reader: page not found')
+        else:
+            path = parsed.path[len('/site'):] or '/'
+            if path.startswith('/barcelona/') and not os.path.exists(_site_file(path, '.html')):
+                # Campus-prefixed mirror of a root page
+                path = path[len('/barcelona'):]
+            try:
+                with open(_site_file(path, '.html'), 'rb') as f:
+                    self._send(200, f.read())
+            except OSError:
+                self._send(404, '<html><head><title>Not found</title></head><body>Page not found</body></html>')
+
+    def do_POST(self):
+        parsed = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if not parsed.path.endswith('/chat/completions'):
+            self._send(404, {'error': {'message': 'not found'}})
+            return
+        try:
+            body = json.loads(raw or b'{}')
+        except ValueError:
+            self._send(400, {'error': {'message': 'invalid json'}})
+            return
+        self._body = body
+        if self._replay('openai', openai_replay_key(body)):
+            return
+        failed = self._maybe_fail('openai')
+        self.server.stats.record('openai', failed)
+        if failed:
+            return
+        resp = completion_response(body, self.server.config.random)
+        cfg = self.server.config
+        self._delay('openai', resp['usage']['completion_tokens'] * cfg.ms_per_token
+                    + resp['usage']['prompt_tokens'] * cfg.ms_per_prompt_token)
+        self._send(200, resp)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, config: StubConfig):
+        super().__init__(addr, StubHandler)
+        self.config = config
+        self.stats = StubStats()
+        self.replay = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stubs(config: StubConfig = None, host: str = '127.0.0.1', port: int = 0, replay=None) -> StubServer:
+    server = StubServer((host, port), config or StubConfig())
+    server.replay = replay
+    threading.Thread(target=server.serve_forever, name='stub-server', daemon=True).start()
+    return server
+
+
+def app_env(base_url: str) -> dict:
+    """Environment variables that point app.py at a stub server."""
+    return {
+        'OPENAI_API_KEY': 'sk-stub',
+        'OPENAI_API_BASE': f"{base_url}/openai/v1",
+        'DDG_HTML_URL': f"{base_url}/ddg/html/",
+        'DDG_LITE_URL': f"{base_url}/ddg/lite/",
+        'BING_SEARCH_URL': f"{base_url}/bing/search",
+        'READER_PROXY_URL': f"{base_url}/reader/",
+        'SITE_ORIGIN': f"{base_url}/site",
+    }
+
+
+def add_stub_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', default='', help="per-role mean latency in ms, e.g. 'openai=600,search=250,reader=400,site=120'")
+    parser.add_argument('--jitter', type=float, default=0.25, help='uniform +/- jitter as a fraction of the mean latency')
+    parser.add_argument('--fail', default='', help="per-role failure rate, e.g. 'openai=0.02,site=0.05'")
+    parser.add_argument('--ms-per-token', type=float, default=2.0, help='extra fake OpenAI latency per completion token')
+    parser.add_argument('--ms-per-prompt-token', type=float, default=0.05, help='extra fake OpenAI latency per prompt token')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--mirror-rate', type=float, default=0.0, help='share of search results replaced by mirror URLs of earlier results')
+
+
+def config_from_args(args) -> StubConfig:
+    return StubConfig(
+        latency_ms=parse_role_map(args.latency),
+        jitter=args.jitter,
+        fail_rate=parse_role_map(args.fail),
+        ms_per_token=args.ms_per_token,
+        ms_per_prompt_token=args.ms_per_prompt_token,
+        seed=args.seed,
+        mirror_rate=args.mirror_rate,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run local stand-ins for OpenAI, search engines, the reader proxy and harbour.space')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    add_stub_arguments(parser)
+    args = parser.parse_args(argv)
+    server = start_stubs(config_from_args(args), args.host, args.port)
+    print(f"Stubs listening on {server.base_url}")
+    for k, v in app_env(server.base_url).items():
+        print(f"export {k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Background warmer for the page cache.
+
+At startup and then every CACHE_WARM_INTERVAL seconds (with jitter), fetches
+and cleans the known hot harbour.space pages plus the URLs users requested most
+recently, at most CACHE_WARM_CONCURRENCY at a time, so user requests find them
+in page_cache. Disable with CACHE_WARMER=0.
+"""
+
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import page_cache
+
+CACHE_WARMER = os.getenv('CACHE_WARMER', '1') == '1'
+CACHE_WARM_INTERVAL = float(os.getenv('CACHE_WARM_INTERVAL', '600'))
+CACHE_WARM_JITTER = float(os.getenv('CACHE_WARM_JITTER', '0.2'))
+CACHE_WARM_CONCURRENCY = int(os.getenv('CACHE_WARM_CONCURRENCY', '2'))
+CACHE_WARM_HOT = int(os.getenv('CACHE_WARM_HOT', '10'))
+
+# The seed and fallback pages used by chat() and collect_web_docs
+SEED_URLS = [
+    'https://harbour.space/admissions',
+    'https://harbour.space/admissions/scholarship',
+    'https://harbour.space/scholarships',
+    'https://harbour.space/bachelors',
+    'https://harbour.space/programmes',
+    'https://harbour.space/about',
+    'https://harbour.space/',
+] + [u for u in os.getenv('CACHE_WARM_URLS', '').split(',') if u]
+
+_state_lock = threading.Lock()
+_started_pid = None
+
+
+def warm_once(fetch, logger) -> int:
+    """Fetch seeds and hot URLs through fetch(url); returns the number of pages refreshed."""
+    urls = SEED_URLS + page_cache.hot_urls(CACHE_WARM_HOT, exclude=SEED_URLS)
+    page_cache.decay_demand()
+    ok = 0
+
+    def _one(url):
+        try:
+            fetch(url)
+            metrics.incr('cache_warmer.fetched')
+            return True
+        except Exception as e:
+            metrics.incr('cache_warmer.errors')
+            logger.info(f"[warm] error url={url}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=CACHE_WARM_CONCURRENCY, thread_name_prefix='cache-warm') as pool:
+        ok = sum(1 for done in pool.map(_one, urls) if done)
+    logger.info(f"[warm] refreshed {ok}/{len(urls)} pages")
+    return ok
+
+
+def _jittered(seconds: float) -> float:
+    return max(0.0, seconds * (1 + random.uniform(-CACHE_WARM_JITTER, CACHE_WARM_JITTER)))
+
+
+def _loop(fetch, logger):
+    # Small initial jitter so workers started together do not hit the site at the same instant
+    delay = random.uniform(0, 2.0)
+    stop = threading.Event()
+    while not stop.wait(delay):
+        try:
+            warm_once(fetch, logger)
+        except Exception as e:
+            logger.info(f"[warm] cycle error: {e}")
+        delay = _jittered(CACHE_WARM_INTERVAL)
+
+
+def ensure_started(fetch, logger) -> bool:
+    """Start the warmer thread once per process (also after a fork). Returns True if it runs."""
+    global _started_pid
+    if not CACHE_WARMER:
+        return False
+    pid = os.getpid()
+    if _started_pid == pid:
+        return True
+    with _state_lock:
+        if _started_pid == pid:
+            return True
+        _started_pid = pid
+    threading.Thread(target=_loop, args=(fetch, logger), name='cache-warmer', daemon=True).start()
+    logger.info(f"[warm] started pid={pid} interval={CACHE_WARM_INTERVAL}s urls={len(SEED_URLS)}+hot")
+    return True
@@ -0,0 +1,73 @@
+"""
+URL canonicalization and near-duplicate detection for retrieved pages.
+
+canonical_url() removes the differences that never change a page (fragment,
+tracking parameters, parameter order, trailing slash, default port, host
+case) so mirror URLs from search results are fetched once. url_key() also
+drops the scheme and a leading "www." for comparing URLs. simhash() fingerprints
+cleaned page text; pages within DEDUPE_SIMHASH_DISTANCE bits of each other
+are treated as the same page (e.g. /barcelona/admissions vs /admissions).
+"""
+
+import hashlib
+import os
+import re
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+DEDUPE_SIMHASH_DISTANCE = int(os.getenv('DEDUPE_SIMHASH_DISTANCE', '3'))
+# Pages shorter than this are not fingerprinted (error pages and stubs all look alike)
+DEDUPE_MIN_CHARS = int(os.getenv('DEDUPE_MIN_CHARS', '300'))
+# Only this much of a page is fingerprinted, the same prefix choose_best_doc ranks (RANK_MAX_CHARS)
+DEDUPE_MAX_CHARS = int(os.getenv('DEDUPE_MAX_CHARS', '3000'))
+
+TRACKING_PARAMS = {'gclid', 'fbclid', 'msclkid', 'yclid', 'mc_cid', 'mc_eid', 'ref', 'ref_src', '_ga', '_gl', 'igshid', 'si'}
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def canonical_url(url: str) -> str:
+    """URL without fragment, tracking parameters, default port or trailing slash; host lowercased, params sorted."""
+    try:
+        p = urlparse((url or '').strip())
+    except ValueError:
+        return url
+    if p.scheme not in ('http', 'https') or not p.netloc:
+        return url
+    host = p.hostname or ''
+    if p.port and not ((p.scheme == 'http' and p.port == 80) or (p.scheme == 'https' and p.port == 443)):
+        host = f"{host}:{p.port}"
+    path = re.sub(r'/{2,}', '/', p.path or '/')
+    if len(path) > 1:
+        path = path.rstrip('/')
+    query = sorted((k, v) for k, v in parse_qsl(p.query, keep_blank_values=True)
+                   if not k.lower().startswith('utm_') and k.lower() not in TRACKING_PARAMS)
+    return urlunparse((p.scheme, host, path, '', urlencode(query), ''))
+
+
+def url_key(url: str) -> str:
+    """Comparison key for URLs: canonical form without scheme and leading 'www.'."""
+    canon = canonical_url(url)
+    rest = canon.split('://', 1)[-1]
+    return rest[4:] if rest.startswith('www.') else rest
+
+
+def simhash(text: str, bits: int = 64) -> int:
+    """64-bit SimHash over word 3-shingles of the first DEDUPE_MAX_CHARS of text (0 for texts too short to fingerprint)."""
+    if not text or len(text) < DEDUPE_MIN_CHARS:
+        return 0
+    words = _WORD_RE.findall(text[:DEDUPE_MAX_CHARS].lower())
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(1, len(words) - 2))]
+    # One bit string per shingle; a bit is set when more than half of the shingles set it
+    rows = [format(int.from_bytes(hashlib.blake2b(sh.encode('utf-8'), digest_size=8).digest(), 'big'), f'0{bits}b')[-bits:]
+            for sh in shingles]
+    half = len(rows) / 2
+    out = 0
+    for column in zip(*rows):
+        out = (out << 1) | (column.count('1') > half)
+    return out
+
+
+def near_duplicate(a: int, b: int, distance: int = None) -> bool:
+    if not a or not b:
+        return False
+    return bin(a ^ b).count('1') <= (DEDUPE_SIMHASH_DISTANCE if distance is None else distance)
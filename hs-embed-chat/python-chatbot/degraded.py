@@ -0,0 +1,116 @@
+"""
+No-LLM answers for chat turns that cannot get a completion.
+
+Used when a turn is rate-limited, shed by admission control, timed out or
+cannot reach the OpenAI API. answer() first looks for a recently generated
+answer to a similar question in the same scenario (remember() keeps them per
+worker, from opening turns only), then for the best matching passage of a page in page_cache. Both come
+back with their source URL. None means the caller should fall back to the
+canned replies. Matching only uses term vectors and cached pages, so it takes
+about a millisecond. Disable with DEGRADED_ANSWERS=0.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import page_cache
+import ranking
+
+DEGRADED_ANSWERS = os.getenv('DEGRADED_ANSWERS', '1') == '1'
+DEGRADED_MAX_ANSWERS = int(os.getenv('DEGRADED_MAX_ANSWERS', '512'))
+DEGRADED_ANSWER_TTL = float(os.getenv('DEGRADED_ANSWER_TTL', '3600'))
+# Share of the idf weight of both questions' terms they must have in common (0..1)
+DEGRADED_MIN_SIMILARITY = float(os.getenv('DEGRADED_MIN_SIMILARITY', '0.6'))
+# Cached pages up to this old may be quoted: stale text beats a canned reply while upstreams are down
+DEGRADED_PAGE_MAX_AGE = float(os.getenv('DEGRADED_PAGE_MAX_AGE', '86400'))
+DEGRADED_MIN_PAGE_SCORE = float(os.getenv('DEGRADED_MIN_PAGE_SCORE', '2.0'))
+DEGRADED_SNIPPET_CHARS = int(os.getenv('DEGRADED_SNIPPET_CHARS', '600'))
+
+_lock = threading.Lock()
+_answers = OrderedDict()  # (scenario, sorted question terms) -> entry
+
+
+def remember(question: str, scenario: str, answer: str, source: str = '', history: list = None):
+    """Keep a generated answer for reuse when later turns cannot reach the model.
+
+    Only answers to the opening turn of a conversation are kept: a later turn's
+    answer rests on (and may quote) that conversation, so it must not be shown
+    to someone else. Off-topic answers are not kept either.
+    """
+    if not DEGRADED_ANSWERS or not answer or history or scenario == 'off_topic':
+        return
+    terms = frozenset(ranking.tokenize(question))
+    if not terms:
+        return
+    key = (scenario or '', ' '.join(sorted(terms)))
+    with _lock:
+        _answers[key] = {'terms': terms, 'scenario': scenario or '', 'answer': answer, 'source': source or '',
+                         'at': time.time()}
+        _answers.move_to_end(key)
+        while len(_answers) > DEGRADED_MAX_ANSWERS:
+            _answers.popitem(last=False)
+        size = len(_answers)
+    metrics.set_gauge('degraded.answers', size)
+
+
+def best_answer(question: str, scenario: str = ''):
+    """Most similar remembered answer (entry dict with 'similarity'), or None below DEGRADED_MIN_SIMILARITY.
+
+    With a scenario only answers remembered under that same scenario qualify.
+    """
+    terms = frozenset(ranking.tokenize(question))
+    if not terms:
+        return None
+    now = time.time()
+    with _lock:
+        candidates = [e for e in _answers.values()
+                      if now - e['at'] <= DEGRADED_ANSWER_TTL and e['terms'] & terms
+                      and (not scenario or e['scenario'] == scenario)]
+    if not candidates:
+        return None
+    weights = ranking.idf(list(terms.union(*(e['terms'] for e in candidates))))
+    best, best_sim = None, DEGRADED_MIN_SIMILARITY
+    for e in candidates:
+        union = sum(weights[t] for t in terms | e['terms'])
+        sim = sum(weights[t] for t in terms & e['terms']) / union if union else 0.0
+        if sim >= best_sim:
+            best, best_sim = e, sim
+    return dict(best, similarity=round(best_sim, 3)) if best else None
+
+
+def page_snippet(question: str, hint: str = ''):
+    """{'title', 'text', 'source', 'score'} for the cached page matching question (plus hint terms) best, or None."""
+    docs = [d for d in page_cache.docs(DEGRADED_PAGE_MAX_AGE) if len(d.get('text') or '') >= 350]
+    if not docs:
+        return None
+    scores = ranking.bm25_scores(docs, f"{question} {hint}".strip())
+    i = max(range(len(docs)), key=scores.__getitem__)
+    if scores[i] < DEGRADED_MIN_PAGE_SCORE:
+        return None
+    doc = docs[i]
+    return {'title': doc.get('title') or '', 'source': doc.get('url') or '', 'score': round(scores[i], 2),
+            'text': ranking.best_excerpt(doc.get('text') or '', question, DEGRADED_SNIPPET_CHARS)}
+
+
+def answer(question: str, scenario: str = '', hint: str = ''):
+    """{'kind': 'answer'|'page', 'text', 'source', ...} from remembered answers or cached pages, or None."""
+    if not DEGRADED_ANSWERS:
+        return None
+    hit = best_answer(question, scenario)
+    if hit:
+        metrics.incr('degraded.answer')
+        return {'kind': 'answer', 'text': hit['answer'], 'source': hit['source'], 'similarity': hit['similarity']}
+    hit = page_snippet(question, hint)
+    if hit:
+        metrics.incr('degraded.page')
+        return dict(hit, kind='page')
+    metrics.incr('degraded.none')
+    return None
+
+
+def clear():
+    with _lock:
+        _answers.clear()
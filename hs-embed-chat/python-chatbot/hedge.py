@@ -0,0 +1,160 @@
+"""
+Hedged upstream calls: start a backup request when the primary is slow.
+
+race() runs the primary call on a per-process thread pool and, if it
+has not produced a usable result within delay_s (or right away when asked),
+starts the secondary too and returns whichever usable result arrives first.
+The loser is abandoned: requests cannot abort a read in flight, so its
+result is discarded when it completes. HostPaths remembers per host which
+path produced the result, so hosts and pages that always need the secondary
+hedge immediately. A race can also be abandoned early through should_stop
+(used when the browser has disconnected). Callers whose calls must not wait
+behind page fetches pass their own pool from executor(name, size).
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+HEDGE_POOL_SIZE = int(os.getenv('HEDGE_POOL_SIZE', '16'))
+HEDGE_HOST_WINDOW = int(os.getenv('HEDGE_HOST_WINDOW', '8'))
+HEDGE_MAX_KEYS = int(os.getenv('HEDGE_MAX_KEYS', '1024'))
+# How often a waiting race() checks should_stop()
+HEDGE_POLL_S = float(os.getenv('HEDGE_POLL_S', '0.2'))
+
+_pools = {}  # name -> (pid, ThreadPoolExecutor)
+_pool_lock = threading.Lock()
+
+
+def executor(name: str = 'hedge', size: int = HEDGE_POOL_SIZE) -> ThreadPoolExecutor:
+    """The named per-process pool, created with size threads on first use (again after a fork)."""
+    pid = os.getpid()
+    entry = _pools.get(name)
+    if entry is None or entry[0] != pid:
+        with _pool_lock:
+            entry = _pools.get(name)
+            if entry is None or entry[0] != pid:
+                entry = _pools[name] = (pid, ThreadPoolExecutor(max_workers=size, thread_name_prefix=name))
+    return entry[1]
+
+
+class HostPaths:
+    """Last HEDGE_HOST_WINDOW winning paths ('primary' / 'secondary') per key (a host or a page)."""
+
+    def __init__(self, window: int = HEDGE_HOST_WINDOW):
+        self.window = window
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def record(self, path: str, *keys):
+        with self._lock:
+            for key in keys:
+                self._hosts.setdefault(key, deque(maxlen=self.window)).append(path)
+            while len(self._hosts) > HEDGE_MAX_KEYS:
+                self._hosts.pop(next(iter(self._hosts)))
+
+    def needs_secondary(self, key: str, min_samples: int = 1):
+        """True when at least half of the recent results for key came from the secondary path.
+
+        None when key has fewer than min_samples results.
+        """
+        with self._lock:
+            paths = list(self._hosts.get(key) or ())
+        if len(paths) < max(1, min_samples):
+            return None
+        return paths.count('secondary') * 2 >= len(paths)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {h: list(p) for h, p in self._hosts.items()}
+
+
+class Cancelled(Exception):
+    """race() gave up because should_stop() returned True (e.g. the client disconnected)."""
+
+
+def _wait(fs, timeout, return_when, should_stop):
+    """concurrent.futures.wait that polls should_stop() every HEDGE_POLL_S seconds."""
+    if should_stop is None:
+        return wait(fs, timeout=timeout, return_when=return_when)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        left = HEDGE_POLL_S if deadline is None else min(HEDGE_POLL_S, max(0.0, deadline - time.monotonic()))
+        done, pending = wait(fs, timeout=left, return_when=return_when)
+        if done or (deadline is not None and time.monotonic() >= deadline):
+            return done, pending
+        if should_stop():
+            raise Cancelled()
+
+
+def _abandon(futures: dict, pending, on_abandoned):
+    for fut in pending:
+        if not fut.cancel() and on_abandoned:
+            fut.add_done_callback(lambda f, n=futures[fut]: on_abandoned(n, f))
+
+
+def race(primary, secondary, delay_s, usable, start_both: bool = False, on_abandoned=None,
+         fallback: bool = True, should_stop=None, pool: ThreadPoolExecutor = None):
+    """Run primary(), hedged by secondary() after delay_s seconds; returns (winner, results, fired).
+
+    winner is 'primary' or 'secondary', or None when neither result is usable.
+    results maps each call whose result was consumed to that result (None if it
+    raised); the winner's is always there. delay_s=None waits for the primary,
+    i.e. no hedging. usable(result) decides whether a result can be returned.
+    When the primary finishes unusable before the hedge, secondary() runs as a
+    plain fallback unless fallback=False. on_abandoned(name, future) is called
+    for a call whose result is discarded. Raises Cancelled (abandoning running
+    calls) as soon as should_stop() returns True. Calls run on pool, by default
+    the shared 'hedge' pool.
+    """
+    pool = pool or executor()
+    futures = {pool.submit(primary): 'primary'}
+    results = {}
+    if not start_both:
+        try:
+            done, _ = _wait(futures, None if delay_s is None else max(0.0, delay_s), FIRST_COMPLETED, should_stop)
+        except Cancelled:
+            _abandon(futures, set(futures), on_abandoned)
+            raise
+        if done:
+            results['primary'] = _result(next(iter(done)))
+            if results['primary'] is not None and usable(results['primary']):
+                return 'primary', results, False
+            if not fallback:
+                return None, results, False
+            # Primary answered but unusable: the secondary is a plain fallback, not a hedge
+            results['secondary'] = _result_of(secondary)
+            if results['secondary'] is not None and usable(results['secondary']):
+                return 'secondary', results, False
+            return None, results, False
+    futures[pool.submit(secondary)] = 'secondary'
+    pending = set(futures)
+    while pending:
+        try:
+            done, pending = _wait(pending, None, FIRST_COMPLETED, should_stop)
+        except Cancelled:
+            _abandon(futures, pending, on_abandoned)
+            raise
+        for fut in done:
+            name = futures[fut]
+            results[name] = _result(fut)
+            if results[name] is not None and usable(results[name]):
+                _abandon(futures, pending, on_abandoned)
+                return name, {name: results[name]}, True
+    return None, results, True
+
+
+def _result(fut):
+    try:
+        return fut.result()
+    except Exception:
+        return None
+
+
+def _result_of(fn):
+    try:
+        return fn()
+    except Exception:
+        return None
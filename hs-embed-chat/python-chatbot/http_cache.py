@@ -0,0 +1,215 @@
+"""
+HTTP caching and compression for responses that do not change per request.
+
+- Static assets: url_for('static', ...) adds ?v=<content hash>. A request
+  carrying the current hash is served with a one-year immutable
+  Cache-Control, so browsers never revalidate it. Changing the file changes
+  the hash and therefore the URL. The page that links the assets is sent with
+  an ETag and no-cache, so it is revalidated on every visit.
+- Fixed JSON (scenario list, each scenario, the programme catalogue) is
+  serialized once per worker with a strong ETag. A GET whose If-None-Match
+  matches gets an empty 304.
+- Text responses of at least COMPRESS_MIN_BYTES are gzipped, or brotli'd
+  when the optional brotli package is installed and the client accepts br.
+  Static assets are compressed once per version at the highest level.
+  Streamed responses are left alone.
+
+HTTP_CACHE=0 turns all of it off.
+"""
+
+import gzip
+import hashlib
+import os
+import stat
+import threading
+
+from flask import Response, current_app, request
+from werkzeug.security import safe_join
+
+import metrics
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+HTTP_CACHE = os.getenv('HTTP_CACHE', '1') == '1'
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', '31536000'))
+# How long clients may reuse fixed JSON before revalidating it
+JSON_MAX_AGE = int(os.getenv('JSON_MAX_AGE', '300'))
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+# Per-response compression; static assets always use the maximum, once
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '6'))
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))
+
+_COMPRESSIBLE = {'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml'}
+
+_lock = threading.Lock()
+_versions = {}  # path -> (mtime, size, hash)
+_static_bodies = {}  # (path, hash, encoding) -> compressed bytes
+_json = {}  # key -> (body, etag)
+
+
+def _static_path(folder: str, filename: str):
+    """Path of filename inside folder, or None when it escapes folder."""
+    return safe_join(folder, filename) if filename else None
+
+
+def static_version(folder: str, filename: str) -> str:
+    """Short content hash of a regular file inside the static folder ('' otherwise)."""
+    path = _static_path(folder, filename)
+    if path is None:
+        return ''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ''
+    if not stat.S_ISREG(st.st_mode):
+        return ''
+    with _lock:
+        cached = _versions.get(path)
+    if cached and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:12]
+    with _lock:
+        _versions[path] = (st.st_mtime, st.st_size, digest)
+    return digest
+
+
+def version_static_url(folder: str, values: dict):
+    """url_defaults hook body: add v=<hash> to url_for('static', filename=...)."""
+    if not HTTP_CACHE or 'v' in values:
+        return
+    version = static_version(folder, values.get('filename') or '')
+    if version:
+        values['v'] = version
+
+
+def _accepted_encoding() -> str:
+    accept = request.accept_encodings
+    if brotli is not None and accept['br']:
+        return 'br'
+    if accept['gzip']:
+        return 'gzip'
+    return ''
+
+
+def _compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def _static_body(folder: str, filename: str, version: str, encoding: str) -> bytes:
+    path = _static_path(folder, filename)
+    key = (path, version, encoding)
+    with _lock:
+        body = _static_bodies.get(key)
+    if body is None:
+        with open(path, 'rb') as f:
+            body = _compress(f.read(), encoding, best=True)
+        with _lock:
+            _static_bodies[key] = body
+    return body
+
+
+def conditional(response: Response, max_age: int = 0) -> Response:
+    """Strong ETag from the body plus Cache-Control; 304 when the client's copy matches."""
+    if not HTTP_CACHE:
+        return response
+    response.add_etag()
+    response.headers['Cache-Control'] = f'public, max-age={max_age}' if max_age else 'no-cache'
+    response.make_conditional(request)
+    if response.status_code == 304:
+        metrics.incr('http.not_modified')
+    return response
+
+
+def json_response(key: str, build) -> Response:
+    """Response for the fixed JSON payload build() returns, serialized once per worker under key."""
+    if not HTTP_CACHE:
+        return current_app.json.response(build())
+    with _lock:
+        entry = _json.get(key)
+    if entry is None:
+        body = (current_app.json.dumps(build()) + '\n').encode('utf-8')
+        entry = (body, hashlib.sha256(body).hexdigest()[:20])
+        with _lock:
+            _json[key] = entry
+        metrics.incr('http.json_built')
+    response = Response(entry[0], mimetype='application/json')
+    response.set_etag(entry[1])
+    if request.method in ('GET', 'HEAD'):
+        response.headers['Cache-Control'] = f'public, max-age={JSON_MAX_AGE}'
+        response.make_conditional(request)
+        if response.status_code == 304:
+            metrics.incr('http.not_modified')
+    return response
+
+
+def finish(response: Response) -> Response:
+    """after_request hook: immutable caching for versioned static files, compression for large text bodies."""
+    if not HTTP_CACHE:
+        return response
+    static = request.endpoint == 'static'
+    # Only a file actually served is versioned: 404s and other errors are never hashed or cached
+    if static and response.status_code == 200 and request.args.get('v'):
+        filename = (request.view_args or {}).get('filename') or ''
+        if request.args['v'] == static_version(current_app.static_folder, filename):
+            response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable'
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    mimetype = response.mimetype or ''
+    if not (mimetype.startswith('text/') or mimetype in _COMPRESSIBLE):
+        return response
+    if static:
+        # send_file's body is a pass-through file wrapper: only the header knows its length
+        size = response.content_length
+        if size is None or size < COMPRESS_MIN_BYTES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = _accepted_encoding()
+        if not encoding:
+            return response
+        filename = request.view_args['filename']
+        version = static_version(current_app.static_folder, filename)
+        if not version:
+            return response
+        body = _static_body(current_app.static_folder, filename, version, encoding)
+        # Drop the file wrapper send_file opened; the compressed copy is in memory
+        original = response.response
+        response.direct_passthrough = False
+        response.set_data(body)
+        if hasattr(original, 'close'):
+            original.close()
+    else:
+        if response.is_streamed or response.direct_passthrough:
+            return response
+        data = response.get_data()
+        size = len(data)
+        if size < COMPRESS_MIN_BYTES:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = _accepted_encoding()
+        if not encoding:
+            return response
+        with metrics.timed('compress'):
+            body = _compress(data, encoding)
+        response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # Same content, different bytes: a strong validator would claim byte equality
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    metrics.incr(f'http.compressed_{encoding}')
+    metrics.incr('http.bytes_before', size)
+    metrics.incr('http.bytes_after', len(body))
+    return response
+
+
+def clear():
+    with _lock:
+        _versions.clear()
+        _static_bodies.clear()
+        _json.clear()
@@ -0,0 +1,171 @@
+"""
+Lightweight in-process metrics for the chatbot backend.
+
+Counters and rolling latency windows per stage, plus a per-request stage
+breakdown that app.py emits as a Server-Timing header. Everything is kept in
+memory per worker process; /api/metrics exposes a snapshot.
+"""
+
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', '2048'))
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+_timing_totals = defaultdict(int)
+_gauges = {}
+_local = threading.local()
+
+
+def incr(name: str, n: int = 1):
+    with _lock:
+        _counters[name] += n
+
+
+def set_gauge(name: str, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name: str, ms: float, per_request: bool = True):
+    """Record one latency sample (milliseconds) for a stage.
+
+    per_request=False keeps the sample out of the request's Server-Timing breakdown.
+    """
+    with _lock:
+        _timings[name].append(ms)
+        _timing_totals[name] += 1
+    stages = getattr(_local, 'stages', None)
+    if per_request and stages is not None:
+        stages[name] = stages.get(name, 0.0) + ms
+
+
+@contextmanager
+def timed(stage: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, (time.perf_counter() - t0) * 1000)
+
+
+def begin_request():
+    """Start collecting the per-request stage breakdown on this thread."""
+    _local.stages = {}
+
+
+def end_request() -> dict:
+    """Stop collecting and return {stage: total_ms} for the current request."""
+    stages = getattr(_local, 'stages', None) or {}
+    _local.stages = None
+    return stages
+
+
+def request_stages() -> dict:
+    return dict(getattr(_local, 'stages', None) or {})
+
+
+def current_request():
+    """The live stage breakdown of this thread's request (None outside one), for bind_request()."""
+    return getattr(_local, 'stages', None)
+
+
+def bind_request(stages):
+    """Add per-request samples on this (helper) thread to the given breakdown; None stops."""
+    _local.stages = stages
+
+
+def server_timing_header(stages: dict) -> str:
+    return ', '.join(f"{name};dur={ms:.1f}" for name, ms in stages.items())
+
+
+def parse_server_timing(header: str) -> dict:
+    """{stage: ms} from a Server-Timing header written by server_timing_header()."""
+    out = {}
+    for part in (header or '').split(','):
+        name, _, rest = part.strip().partition(';')
+        if not name:
+            continue
+        for attr in rest.split(';'):
+            key, _, value = attr.strip().partition('=')
+            if key == 'dur':
+                try:
+                    out[name] = float(value)
+                except ValueError:
+                    pass
+    return out
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def summarize(values) -> dict:
+    values = list(values)
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 2) if values else 0.0,
+        'p50': round(percentile(values, 50), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+    }
+
+
+def recent_percentile(name: str, p: float, default: float = 0.0, min_samples: int = 1) -> float:
+    """Percentile of the rolling window for one timing, or default when it has fewer than min_samples samples."""
+    with _lock:
+        values = list(_timings.get(name) or ())
+    return percentile(values, p) if values and len(values) >= min_samples else default
+
+
+def rss_kb() -> int:
+    """Current resident set size of this process in KiB (0 if unknown)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import resource
+        return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    except Exception:
+        return 0
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timings = {name: list(win) for name, win in _timings.items()}
+        totals = dict(_timing_totals)
+    stages = {}
+    for name, values in timings.items():
+        s = summarize(values)
+        s['total'] = totals.get(name, 0)
+        stages[name] = s
+    return {
+        'pid': os.getpid(),
+        'rss_kb': rss_kb(),
+        'counters': counters,
+        'gauges': gauges,
+        'timings': stages,
+    }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _timing_totals.clear()
+        _gauges.clear()
@@ -0,0 +1,95 @@
+"""
+In-process cache of cleaned web pages, shared by every retrieval path.
+
+Entries are the dicts fetch_and_clean returns ({'url', 'title', 'text', ...})
+with the untruncated text, kept for PAGE_CACHE_TTL seconds and evicted least
+recently used beyond PAGE_CACHE_MAX entries. Lookups are counted per URL so
+the warmer can refresh the pages users actually ask for.
+"""
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import metrics
+
+PAGE_CACHE_TTL = float(os.getenv('PAGE_CACHE_TTL', '900'))
+PAGE_CACHE_MAX = int(os.getenv('PAGE_CACHE_MAX', '256'))
+# Longest text kept per page; callers truncate further with their own max_chars
+PAGE_CACHE_MAX_CHARS = int(os.getenv('PAGE_CACHE_MAX_CHARS', '20000'))
+
+_lock = threading.Lock()
+_entries = OrderedDict()  # url -> (stored_at, doc)
+_demand = Counter()
+
+
+def get(url: str):
+    """Return a copy of the cached doc for url, or None when missing or expired."""
+    now = time.time()
+    with _lock:
+        _demand[url] += 1
+        item = _entries.get(url)
+        if item and now - item[0] <= PAGE_CACHE_TTL:
+            _entries.move_to_end(url)
+            metrics.incr('page_cache.hit')
+            return dict(item[1])
+        if item:
+            del _entries[url]
+    metrics.incr('page_cache.miss')
+    return None
+
+
+def put(url: str, doc: dict):
+    doc = dict(doc)
+    doc['text'] = (doc.get('text') or '')[:PAGE_CACHE_MAX_CHARS]
+    with _lock:
+        _entries[url] = (time.time(), doc)
+        _entries.move_to_end(url)
+        while len(_entries) > PAGE_CACHE_MAX:
+            _entries.popitem(last=False)
+        metrics.set_gauge('page_cache.size', len(_entries))
+
+
+def age(url: str):
+    """Seconds since url was stored, or None if it is not cached."""
+    with _lock:
+        item = _entries.get(url)
+    return time.time() - item[0] if item else None
+
+
+def fresh(url: str) -> bool:
+    """True when url is cached and not expired (does not count as demand)."""
+    a = age(url)
+    return a is not None and a <= PAGE_CACHE_TTL
+
+
+def docs(max_age: float = None) -> list:
+    """Copies of the docs stored within max_age seconds (default PAGE_CACHE_TTL), without counting demand."""
+    limit = PAGE_CACHE_TTL if max_age is None else max_age
+    now = time.time()
+    with _lock:
+        return [dict(doc) for stored, doc in _entries.values() if now - stored <= limit]
+
+
+def hot_urls(n: int, exclude=()) -> list:
+    """Most requested URLs since the last decay, excluding the given ones."""
+    with _lock:
+        ranked = [u for u, _ in _demand.most_common(n + len(exclude))]
+    skip = set(exclude)
+    return [u for u in ranked if u not in skip][:n]
+
+
+def decay_demand():
+    """Halve all demand counts so the hot list follows recent traffic."""
+    with _lock:
+        for url in list(_demand):
+            _demand[url] //= 2
+            if not _demand[url]:
+                del _demand[url]
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+        _demand.clear()
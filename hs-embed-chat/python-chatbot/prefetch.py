@@ -0,0 +1,150 @@
+"""
+Speculative prefetch of pages linked from the page a chat turn answered from.
+
+After choose_best_doc picks a source, the same-site links fetch_and_clean kept
+for it are ranked against the question and active scenario, and the top
+PREFETCH_PER_DOC are queued for a single low-priority background thread that
+puts them into page_cache. Each session may queue at most
+PREFETCH_SESSION_BUDGET pages per PREFETCH_SESSION_TTL seconds. Prefetching
+pauses while the worker has more than PREFETCH_MAX_ACTIVE requests in
+flight. Disable with PREFETCH_LINKS=0.
+"""
+
+import os
+import queue
+import re
+import threading
+import time
+
+import metrics
+import page_cache
+
+PREFETCH_LINKS = os.getenv('PREFETCH_LINKS', '1') == '1'
+PREFETCH_PER_DOC = int(os.getenv('PREFETCH_PER_DOC', '3'))
+PREFETCH_SESSION_BUDGET = int(os.getenv('PREFETCH_SESSION_BUDGET', '8'))
+PREFETCH_SESSION_TTL = float(os.getenv('PREFETCH_SESSION_TTL', '1800'))
+PREFETCH_QUEUE_MAX = int(os.getenv('PREFETCH_QUEUE_MAX', '64'))
+PREFETCH_MAX_ACTIVE = int(os.getenv('PREFETCH_MAX_ACTIVE', '4'))
+
+# Words that point at the pages follow-up questions usually go to
+FOLLOW_UP_HINTS = {
+    'scholarship', 'scholarships', 'deadline', 'deadlines', 'apply', 'admission', 'admissions', 'tuition', 'fee',
+    'fees', 'bachelor', 'bachelors', 'master', 'masters', 'programme', 'programmes', 'program', 'computer',
+    'science', 'data', 'requirements', 'intake', 'visa', 'housing',
+}
+
+_lock = threading.Lock()
+_queue = queue.Queue(maxsize=PREFETCH_QUEUE_MAX)
+_sessions = {}  # session -> [window_start, queued]
+_prefetched = {}  # url -> fetched_at, until a chat turn uses it
+_active = 0
+_started_pid = None
+
+
+def _terms(text: str) -> set:
+    return {t for t in re.split(r'[^\w]+', (text or '').lower()) if len(t) > 2}
+
+
+def rank_links(links: list, query: str, scenario: str = '') -> list:
+    """Links ordered by overlap of their anchor text and path with the question, scenario and follow-up hints."""
+    q = _terms(query) | _terms(scenario.replace('_', ' '))
+    scored = []
+    for i, link in enumerate(links or []):
+        words = _terms(link.get('text')) | _terms(link.get('url', '').split('://', 1)[-1].split('/', 1)[-1])
+        score = 2.0 * len(words & q) + len(words & FOLLOW_UP_HINTS)
+        # Earlier links in the body are usually the prominent ones
+        scored.append((score - i * 0.01, link['url']))
+    scored.sort(reverse=True)
+    return [u for score, u in scored if score > 0]
+
+
+def _take_budget(session: str, n: int) -> int:
+    now = time.time()
+    with _lock:
+        for key in [k for k, (start, _) in _sessions.items() if now - start > PREFETCH_SESSION_TTL]:
+            del _sessions[key]
+        window = _sessions.setdefault(session, [now, 0])
+        granted = max(0, min(n, PREFETCH_SESSION_BUDGET - window[1]))
+        window[1] += granted
+    return granted
+
+
+def schedule(session: str, doc: dict, query: str, scenario: str = '') -> int:
+    """Queue the top-ranked uncached links of doc for this session; returns how many were queued."""
+    if not PREFETCH_LINKS or not doc:
+        return 0
+    candidates = [u for u in rank_links(doc.get('links'), query, scenario)
+                  if u != doc.get('url') and not page_cache.fresh(u)][:PREFETCH_PER_DOC]
+    if not candidates:
+        return 0
+    granted = _take_budget(session, len(candidates))
+    if granted < len(candidates):
+        metrics.incr('prefetch.over_budget', len(candidates) - granted)
+    queued = 0
+    for url in candidates[:granted]:
+        try:
+            _queue.put_nowait(url)
+            queued += 1
+        except queue.Full:
+            metrics.incr('prefetch.dropped')
+    metrics.incr('prefetch.queued', queued)
+    return queued
+
+
+def note_used(url: str):
+    """Count a chat turn answering from a page the prefetcher fetched."""
+    with _lock:
+        hit = _prefetched.pop(url, None) is not None
+    if hit:
+        metrics.incr('prefetch.used')
+
+
+def request_started():
+    global _active
+    with _lock:
+        _active += 1
+
+
+def request_finished():
+    global _active
+    with _lock:
+        _active = max(0, _active - 1)
+
+
+def _loop(fetch, logger):
+    while True:
+        url = _queue.get()
+        # Stay out of the way of user requests on this worker
+        while _active > PREFETCH_MAX_ACTIVE:
+            time.sleep(0.05)
+        if page_cache.fresh(url):
+            metrics.incr('prefetch.already_cached')
+            continue
+        t0 = time.perf_counter()
+        try:
+            fetch(url)
+            with _lock:
+                _prefetched[url] = time.time()
+                if len(_prefetched) > PREFETCH_QUEUE_MAX * 4:
+                    _prefetched.pop(next(iter(_prefetched)))
+            metrics.incr('prefetch.fetched')
+            metrics.observe('prefetch.fetch_ms', (time.perf_counter() - t0) * 1000, per_request=False)
+        except Exception as e:
+            metrics.incr('prefetch.errors')
+            logger.info(f"[prefetch] error url={url}: {e}")
+
+
+def ensure_started(fetch, logger) -> bool:
+    """Start the prefetch thread once per process (also after a fork). Returns True if it runs."""
+    global _started_pid
+    if not PREFETCH_LINKS:
+        return False
+    pid = os.getpid()
+    if _started_pid == pid:
+        return True
+    with _lock:
+        if _started_pid == pid:
+            return True
+        _started_pid = pid
+    threading.Thread(target=_loop, args=(fetch, logger), name='link-prefetch', daemon=True).start()
+    return True
@@ -0,0 +1,245 @@
+"""
+On-demand profiling for live /api/chat requests.
+
+Off by default. When PROFILE_ADMIN_TOKEN or PROFILE_SAMPLE_RATE is set, single
+requests are wrapped in a stack sampler (folded stacks, flamegraph.pl /
+speedscope compatible) plus a tracemalloc snapshot, and the result is stored
+under PROFILE_DIR for later download. When both are unset the view function is
+left untouched, so there is no per-request cost.
+"""
+
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from functools import wraps
+
+from flask import request, jsonify, send_from_directory, abort
+
+PROFILE_ADMIN_TOKEN = os.getenv('PROFILE_ADMIN_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0') or 0)
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000.0
+PROFILE_TOP_ALLOCS = int(os.getenv('PROFILE_TOP_ALLOCS', '25'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '200'))
+
+# Only one request is profiled at a time: tracemalloc is process-wide
+_profile_lock = threading.Lock()
+
+_local = threading.local()
+
+
+def profiling_enabled() -> bool:
+    return bool(PROFILE_ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def _is_admin(req) -> bool:
+    token = req.headers.get('X-Profile-Token', '')
+    return bool(PROFILE_ADMIN_TOKEN) and hmac.compare_digest(token.encode(), PROFILE_ADMIN_TOKEN.encode())
+
+
+def _should_profile(req) -> bool:
+    if _is_admin(req) and req.headers.get('X-Profile', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class StackSampler:
+    """Samples the Python stacks of a request's threads at a fixed interval into folded form.
+
+    The request thread is sampled from start to stop. Helper threads working for
+    the request (see follow()) are sampled while they do; their stacks are rooted
+    at the thread pool's name so a flamegraph keeps them apart.
+    """
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._helpers = {}  # thread id -> stack root
+        self._helpers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def add_thread(self, thread_id: int, root: str):
+        with self._helpers_lock:
+            self._helpers[thread_id] = root
+
+    def remove_thread(self, thread_id: int):
+        with self._helpers_lock:
+            self._helpers.pop(thread_id, None)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._helpers_lock:
+                threads = [(self.thread_id, '')] + list(self._helpers.items())
+            for thread_id, root in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                if root:
+                    parts.append(root)
+                self.stacks[';'.join(reversed(parts))] += 1
+
+    def folded(self) -> str:
+        return '\n'.join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def follow(fn):
+    """fn wrapped so that, run on a helper thread, it is sampled with the calling request.
+
+    Returns fn itself when the calling thread is not being profiled.
+    """
+    sampler = getattr(_local, 'sampler', None)
+    if sampler is None:
+        return fn
+
+    @wraps(fn)
+    def run(*args, **kwargs):
+        thread_id = threading.get_ident()
+        # ThreadPoolExecutor names its threads <prefix>_<n>
+        sampler.add_thread(thread_id, f"[{threading.current_thread().name.rsplit('_', 1)[0]}]")
+        _local.sampler = sampler
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.sampler = None
+            sampler.remove_thread(thread_id)
+    return run
+
+
+def _top_allocations(snapshot, limit: int) -> list:
+    stats = snapshot.statistics('lineno')
+    out = []
+    for stat in stats[:limit]:
+        frame = stat.traceback[0]
+        out.append({
+            'file': frame.filename,
+            'line': frame.lineno,
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        })
+    return out
+
+
+def _prune_old_profiles():
+    try:
+        names = sorted(
+            (n for n in os.listdir(PROFILE_DIR) if n.endswith('.json')),
+            key=lambda n: os.path.getmtime(os.path.join(PROFILE_DIR, n)),
+        )
+        for n in names[:max(0, len(names) - PROFILE_KEEP)]:
+            pid = n[:-len('.json')]
+            for ext in ('.json', '.folded'):
+                try:
+                    os.remove(os.path.join(PROFILE_DIR, pid + ext))
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+
+def _run_profiled(view, logger, *args, **kwargs):
+    pid = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+    sampler = StackSampler(threading.get_ident())
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    sampler.start()
+    _local.sampler = sampler
+    t0 = time.perf_counter()
+    try:
+        result = view(*args, **kwargs)
+    finally:
+        wall_ms = (time.perf_counter() - t0) * 1000
+        _local.sampler = None
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(os.path.join(PROFILE_DIR, pid + '.folded'), 'w', encoding='utf-8') as f:
+                f.write(sampler.folded())
+            meta = {
+                'id': pid,
+                'path': request.path,
+                'wall_ms': round(wall_ms, 1),
+                'samples': sum(sampler.stacks.values()),
+                'interval_ms': sampler.interval * 1000,
+                'peak_kb': round(peak / 1024, 1),
+                'top_allocations': _top_allocations(snapshot, PROFILE_TOP_ALLOCS),
+            }
+            with open(os.path.join(PROFILE_DIR, pid + '.json'), 'w', encoding='utf-8') as f:
+                json.dump(meta, f, indent=2)
+            _prune_old_profiles()
+            logger.info(f"[profile] stored id={pid} wall_ms={meta['wall_ms']} samples={meta['samples']}")
+        except Exception as e:
+            logger.info(f"[profile] store error: {e}")
+    return result, pid
+
+
+def install(app, endpoint: str = 'chat'):
+    """Wrap the given endpoint with the profiler and add admin download routes.
+
+    Does nothing when profiling is not configured.
+    """
+    if not profiling_enabled():
+        return
+    view = app.view_functions[endpoint]
+
+    @wraps(view)
+    def profiled_view(*args, **kwargs):
+        if not _should_profile(request) or not _profile_lock.acquire(blocking=False):
+            return view(*args, **kwargs)
+        try:
+            result, pid = _run_profiled(view, app.logger, *args, **kwargs)
+        finally:
+            _profile_lock.release()
+        resp = app.make_response(result)
+        resp.headers['X-Profile-Id'] = pid
+        return resp
+
+    app.view_functions[endpoint] = profiled_view
+
+    @app.route('/api/admin/profiles', methods=['GET'])
+    def profiles_list_route():
+        """List stored request profiles (admin only)"""
+        if not _is_admin(request):
+            abort(403)
+        try:
+            names = sorted((n[:-len('.json')] for n in os.listdir(PROFILE_DIR) if n.endswith('.json')), reverse=True)
+        except OSError:
+            names = []
+        return jsonify({'profiles': names})
+
+    @app.route('/api/admin/profiles/<name>', methods=['GET'])
+    def profiles_get_route(name):
+        """Download a stored profile: <id>.json (allocations) or <id>.folded (stacks)"""
+        if not _is_admin(request):
+            abort(403)
+        if not name.endswith(('.json', '.folded')):
+            abort(404)
+        return send_from_directory(PROFILE_DIR, name, as_attachment=True)
+
+    app.logger.info(f"[profile] enabled sample_rate={PROFILE_SAMPLE_RATE} admin_header={'yes' if PROFILE_ADMIN_TOKEN else 'no'} dir={PROFILE_DIR}")
@@ -0,0 +1,184 @@
+"""
+BM25 ranking of candidate pages for choose_best_doc.
+
+Each document is tokenized once: its term-frequency vector (a sparse
+{term: count} dict) is stored on the doc itself under 'tf', so page_cache
+copies carry it across requests. Document frequencies are kept per worker
+over every distinct page ranked so far, which keeps IDF stable even when a
+request has only three candidates. Title terms count RANK_TITLE_WEIGHT times;
+long questions are scored on their RANK_MAX_QUERY_TERMS rarest terms. A
+question's terms are computed once and reused by every ranking call of the
+request (choose_best_doc, each best_excerpt, prefetch).
+
+best_excerpt() picks the passages of one page that share the most rare query
+terms, for packing several pages into a citation prompt.
+"""
+
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+RANK_K1 = float(os.getenv('RANK_K1', '1.2'))
+RANK_B = float(os.getenv('RANK_B', '0.75'))
+RANK_TITLE_WEIGHT = int(os.getenv('RANK_TITLE_WEIGHT', '3'))
+# Only the text the answer prompt can see is scored
+RANK_MAX_CHARS = int(os.getenv('RANK_MAX_CHARS', '3000'))
+RANK_CORPUS_MAX = int(os.getenv('RANK_CORPUS_MAX', '2048'))
+RANK_MAX_QUERY_TERMS = int(os.getenv('RANK_MAX_QUERY_TERMS', '16'))
+# Passage size best_excerpt() selects by
+RANK_PASSAGE_CHARS = int(os.getenv('RANK_PASSAGE_CHARS', '400'))
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+_lock = threading.Lock()
+_corpus = OrderedDict()  # url -> set of terms, for document frequencies
+_df = Counter()
+_total_len = 0
+
+
+def _stem(t: str) -> str:
+    # Plural folding only: scholarships -> scholarship, universities -> university
+    if len(t) > 4 and t.endswith('ies'):
+        return t[:-3] + 'y'
+    if len(t) > 3 and t.endswith('s') and not t.endswith('ss'):
+        return t[:-1]
+    return t
+
+
+def tokenize(text: str) -> list:
+    # Only words ending in 's' can change when stemmed
+    return [_stem(t) if t[-1] == 's' else t for t in _TOKEN_RE.findall((text or '').lower())
+            if len(t) > 1 and not t.isdigit()]
+
+
+@lru_cache(maxsize=256)
+def query_terms(query: str) -> tuple:
+    """Distinct terms of query in order of appearance."""
+    return tuple(dict.fromkeys(tokenize(query)))
+
+
+def doc_vector(doc: dict) -> tuple:
+    """(tf, length) for doc, computed once and stored on the doc."""
+    tf = doc.get('tf')
+    if tf is None:
+        tf = Counter(tokenize((doc.get('text') or '')[:RANK_MAX_CHARS]))
+        for t in tokenize(doc.get('title') or ''):
+            tf[t] += RANK_TITLE_WEIGHT
+        tf = dict(tf)
+        doc['tf'] = tf
+        doc['tf_len'] = sum(tf.values())
+    _add_to_corpus(doc.get('url') or str(id(doc)), tf, doc['tf_len'])
+    return tf, doc['tf_len']
+
+
+def _add_to_corpus(url: str, tf: dict, length: int):
+    global _total_len
+    with _lock:
+        if url in _corpus:
+            _corpus.move_to_end(url)
+            return
+        _corpus[url] = (frozenset(tf), length)
+        _df.update(tf.keys())
+        _total_len += length
+        while len(_corpus) > RANK_CORPUS_MAX:
+            terms, old_len = _corpus.popitem(last=False)[1]
+            _df.subtract(terms)
+            _total_len -= old_len
+
+
+def _stats(terms) -> tuple:
+    with _lock:
+        n = len(_corpus)
+        avg = _total_len / n if n else 1.0
+        return n, avg, {t: _df.get(t, 0) for t in terms}
+
+
+def idf(terms) -> dict:
+    """BM25 idf of each term over the pages ranked so far (unseen terms weigh most)."""
+    n, _, df = _stats(terms)
+    return {t: math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5)) for t in terms}
+
+
+def bm25_scores(docs: list, query: str) -> list:
+    """BM25 score of each doc for query (same order as docs)."""
+    q_terms = query_terms(query)
+    vectors = [doc_vector(d) for d in docs]
+    if not q_terms:
+        return [0.0] * len(docs)
+    n, avg_len, df = _stats(q_terms)
+    # Terms no ranked page contains cannot change any score; long messages keep their rarest terms
+    idf = sorted(((t, math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))) for t in q_terms if df[t]),
+                 key=lambda tw: -tw[1])[:RANK_MAX_QUERY_TERMS]
+    k1 = RANK_K1
+    scores = []
+    for tf, length in vectors:
+        norm = k1 * (1 - RANK_B + RANK_B * length / max(avg_len, 1.0))
+        s = 0.0
+        for t, w in idf:
+            f = tf.get(t)
+            if f:
+                s += w * f * (k1 + 1) / (f + norm)
+        scores.append(s)
+    return scores
+
+
+def _passages(text: str) -> list:
+    """text as consecutive chunks of whole sentences, each at most RANK_PASSAGE_CHARS long."""
+    out, cur = [], ''
+    for sent in _SENTENCE_RE.split(text):
+        while len(sent) > RANK_PASSAGE_CHARS:
+            if cur:
+                out.append(cur)
+                cur = ''
+            out.append(sent[:RANK_PASSAGE_CHARS])
+            sent = sent[RANK_PASSAGE_CHARS:]
+        if cur and len(cur) + 1 + len(sent) > RANK_PASSAGE_CHARS:
+            out.append(cur)
+            cur = ''
+        cur = f"{cur} {sent}" if cur else sent
+    if cur:
+        out.append(cur)
+    return out
+
+
+def best_excerpt(text: str, query: str, max_chars: int) -> str:
+    """At most max_chars of text: the passages matching query best, in page order ('…' marks gaps)."""
+    text = text or ''
+    if len(text) <= max_chars:
+        return text
+    q_terms = query_terms(query)
+    passages = _passages(text)
+    if not q_terms or len(passages) < 2:
+        return text[:max_chars]
+    weights = idf(q_terms)
+    scores = []
+    for i, p in enumerate(passages):
+        words = set(tokenize(p))
+        # Earlier passages win ties: page intros usually summarise
+        scores.append((sum(w for t, w in weights.items() if t in words), -i))
+    chosen, used = [], 0
+    for s, neg_i in sorted(scores, reverse=True):
+        p = passages[-neg_i]
+        if used + len(p) + 3 > max_chars:
+            continue
+        chosen.append(-neg_i)
+        used += len(p) + 3
+    if not chosen:
+        return text[:max_chars]
+    chosen.sort()
+    out = passages[chosen[0]]
+    for prev, i in zip(chosen, chosen[1:]):
+        out += (' ' if i == prev + 1 else ' … ') + passages[i]
+    return out
+
+
+def reset():
+    global _total_len
+    with _lock:
+        _corpus.clear()
+        _df.clear()
+        _total_len = 0
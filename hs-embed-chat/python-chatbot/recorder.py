@@ -0,0 +1,166 @@
+"""
+Opt-in recorder for /api/chat traffic.
+
+When RECORD_TRAFFIC_DIR is set, a sample of chat requests (RECORD_SAMPLE_RATE,
+default all) is appended as JSON lines to RECORD_TRAFFIC_DIR/chat-YYYYMMDD.jsonl:
+the redacted message, history length and size, image size, the response
+status and stage timings, and every upstream exchange the request made
+(search pages, fetched pages, reader proxy, OpenAI completions). bench/replay.py
+replays these files against the local stubs.
+
+Redaction removes e-mail addresses, phone numbers and long digit runs from
+messages, model answers and search exchanges (whose query string and result
+page carry the message); history and image contents are never stored.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from functools import wraps
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from flask import request
+
+import metrics
+
+RECORD_TRAFFIC_DIR = os.getenv('RECORD_TRAFFIC_DIR', '')
+RECORD_SAMPLE_RATE = float(os.getenv('RECORD_SAMPLE_RATE', '1') or 0)
+RECORD_MAX_BODY = int(os.getenv('RECORD_MAX_BODY', '200000'))
+
+_EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+_PHONE_RE = re.compile(r'\+?\d[\d\s().-]{6,}\d')
+_DIGITS_RE = re.compile(r'\d{5,}')
+
+_write_lock = threading.Lock()
+_local = threading.local()
+_salt = os.urandom(8)
+
+
+def recording_enabled() -> bool:
+    return bool(RECORD_TRAFFIC_DIR) and RECORD_SAMPLE_RATE > 0
+
+
+def redact(text: str) -> str:
+    if not text:
+        return text or ''
+    text = _EMAIL_RE.sub('<email>', text)
+    text = _PHONE_RE.sub('<phone>', text)
+    return _DIGITS_RE.sub('<num>', text)
+
+
+def redact_url(url: str) -> str:
+    """url with every query-string value redacted."""
+    parts = urlsplit(url or '')
+    if not parts.query:
+        return url or ''
+    query = urlencode([(k, redact(v)) for k, v in parse_qsl(parts.query, keep_blank_values=True)])
+    return urlunsplit(parts._replace(query=query))
+
+
+def note_upstream(role: str, url: str, status: int, body: str = '', elapsed_ms: float = None):
+    """Attach one upstream exchange to the request being recorded on this thread (no-op otherwise)."""
+    rec = getattr(_local, 'record', None)
+    if rec is None:
+        return
+    if role in ('openai', 'search'):
+        body = redact(body)
+    if role == 'search':
+        url = redact_url(url)
+    rec['upstream'].append({
+        'role': role,
+        'url': url,
+        'status': status,
+        'elapsed_ms': round(elapsed_ms, 1) if elapsed_ms is not None else None,
+        'body': (body or '')[:RECORD_MAX_BODY],
+    })
+
+
+def note_response(resp, role: str):
+    """note_upstream for a requests.Response."""
+    if getattr(_local, 'record', None) is None:
+        return
+    note_upstream(role, resp.url, resp.status_code, resp.text, resp.elapsed.total_seconds() * 1000)
+
+
+def current():
+    """The record being collected on this thread, if any, for bind() on a helper thread."""
+    return getattr(_local, 'record', None)
+
+
+def bind(rec):
+    _local.record = rec
+
+
+def _session_key(req) -> str:
+    raw = f"{req.remote_addr}|{req.headers.get('User-Agent', '')}".encode('utf-8')
+    return hashlib.sha1(_salt + raw).hexdigest()[:12]
+
+
+def _start_record(data: dict) -> dict:
+    message = (data.get('message') or '').strip()
+    history = data.get('history') or []
+    image = data.get('image') or ''
+    prefix = ''
+    m = re.match(r'^(web|найди|lookup|search|find|cite|sources|источники):', message.lower())
+    if m:
+        prefix = m.group(1) + ':'
+    return {
+        'ts': round(time.time(), 3),
+        'session': _session_key(request),
+        'message': redact(message),
+        'prefix': prefix,
+        'cyrillic': bool(re.search(r'[а-яё]', message.lower())),
+        'history_len': len(history),
+        'history_chars': sum(len(str(h.get('content', ''))) for h in history if isinstance(h, dict)),
+        'image_bytes': len(image),
+        'active_scenario': data.get('active_scenario') or '',
+        'upstream': [],
+    }
+
+
+def _write(rec: dict):
+    os.makedirs(RECORD_TRAFFIC_DIR, exist_ok=True)
+    path = os.path.join(RECORD_TRAFFIC_DIR, time.strftime('chat-%Y%m%d.jsonl'))
+    line = json.dumps(rec, ensure_ascii=False)
+    with _write_lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def install(app, endpoint: str = 'chat'):
+    """Wrap the endpoint with the recorder. Does nothing unless RECORD_TRAFFIC_DIR is set."""
+    if not recording_enabled():
+        return
+    view = app.view_functions[endpoint]
+
+    @wraps(view)
+    def recorded_view(*args, **kwargs):
+        if random.random() >= RECORD_SAMPLE_RATE:
+            return view(*args, **kwargs)
+        data = request.get_json(silent=True) or {}
+        rec = _start_record(data)
+        _local.record = rec
+        t0 = time.perf_counter()
+        try:
+            result = view(*args, **kwargs)
+        finally:
+            _local.record = None
+        resp = app.make_response(result)
+        rec['latency_ms'] = round((time.perf_counter() - t0) * 1000, 1)
+        rec['status'] = resp.status_code
+        rec['stages'] = metrics.request_stages()
+        try:
+            body = resp.get_json(silent=True) or {}
+            rec['scenario'] = (body.get('data') or {}).get('active_scenario', '')
+            rec['type'] = body.get('type', '')
+            _write(rec)
+        except Exception as e:
+            app.logger.info(f"[record] write error: {e}")
+        return resp
+
+    app.view_functions[endpoint] = recorded_view
+    app.logger.info(f"[record] enabled dir={RECORD_TRAFFIC_DIR} sample_rate={RECORD_SAMPLE_RATE}")
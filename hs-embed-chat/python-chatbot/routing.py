@@ -0,0 +1,140 @@
+"""
+Model and output-budget routing for answer completions.
+
+route() picks the model, max_tokens and temperature of one answer call:
+
+- images go to ROUTE_VISION_MODEL;
+- multi-source citation answers get ROUTE_CITED_MAX_TOKENS, short factual
+  scenarios (ROUTE_SHORT_SCENARIOS, e.g. contact_us) ROUTE_SHORT_MAX_TOKENS,
+  answers from one fetched page ROUTE_WEB_MAX_TOKENS, everything else
+  ROUTE_MAX_TOKENS;
+- conversations whose prompt is over ROUTE_LONG_PROMPT_TOKENS go to
+  ROUTE_LONG_MODEL (larger context).
+
+A text model that was rate-limited within the last ROUTE_COOLDOWN_S seconds
+(or the server's Retry-After), or whose recent p95 latency is above
+ROUTE_SLOW_MS, is swapped for its ROUTE_FALLBACKS partner. Every call is
+recorded per route and per model: calls, latency and prompt/completion tokens.
+ROUTING=0 restores the fixed choice (text/vision model, 500 tokens).
+"""
+
+import os
+import threading
+import time
+
+import metrics
+
+
+def _pairs(raw: str) -> dict:
+    return {k.strip(): v.strip() for k, v in (item.split('=', 1) for item in raw.split(',') if '=' in item)}
+
+
+ROUTING = os.getenv('ROUTING', '1') == '1'
+ROUTE_TEXT_MODEL = os.getenv('ROUTE_TEXT_MODEL', 'gpt-3.5-turbo')
+ROUTE_VISION_MODEL = os.getenv('ROUTE_VISION_MODEL', 'gpt-4o-mini')
+ROUTE_LONG_MODEL = os.getenv('ROUTE_LONG_MODEL', 'gpt-4o-mini')
+# Text model -> model to use while it is rate-limited or slow
+ROUTE_FALLBACKS = _pairs(os.getenv('ROUTE_FALLBACKS', 'gpt-3.5-turbo=gpt-4o-mini,gpt-4o-mini=gpt-3.5-turbo'))
+ROUTE_MAX_TOKENS = int(os.getenv('ROUTE_MAX_TOKENS', '500'))
+ROUTE_WEB_MAX_TOKENS = int(os.getenv('ROUTE_WEB_MAX_TOKENS', '400'))
+ROUTE_CITED_MAX_TOKENS = int(os.getenv('ROUTE_CITED_MAX_TOKENS', os.getenv('CITATION_ANSWER_MAX_TOKENS', '600')))
+ROUTE_SHORT_MAX_TOKENS = int(os.getenv('ROUTE_SHORT_MAX_TOKENS', '200'))
+ROUTE_SHORT_SCENARIOS = {s.strip() for s in os.getenv(
+    'ROUTE_SHORT_SCENARIOS', 'contact_us,campus_map,cafeteria,transport,library,sports').split(',') if s.strip()}
+# Estimated prompt tokens (about 4 characters each) above which ROUTE_LONG_MODEL is used
+ROUTE_LONG_PROMPT_TOKENS = int(os.getenv('ROUTE_LONG_PROMPT_TOKENS', '6000'))
+ROUTE_COOLDOWN_S = float(os.getenv('ROUTE_COOLDOWN_S', '60'))
+# 0 disables latency-based fallback
+ROUTE_SLOW_MS = float(os.getenv('ROUTE_SLOW_MS', '8000'))
+ROUTE_SLOW_MIN_SAMPLES = int(os.getenv('ROUTE_SLOW_MIN_SAMPLES', '20'))
+
+_lock = threading.Lock()
+_limited_until = {}  # model -> time.time() when its rate-limit cooldown ends
+
+
+def prompt_tokens(messages: list) -> int:
+    """Rough prompt size of messages (text parts only)."""
+    chars = 0
+    for m in messages or []:
+        content = m.get('content')
+        if isinstance(content, list):
+            chars += sum(len(p.get('text', '')) for p in content if isinstance(p, dict))
+        elif content:
+            chars += len(content)
+    return chars // 4
+
+
+def note_rate_limited(model: str, retry_after: float = None):
+    """Keep model out of routing for retry_after (server hint) or ROUTE_COOLDOWN_S seconds."""
+    until = time.time() + (retry_after if retry_after else ROUTE_COOLDOWN_S)
+    with _lock:
+        _limited_until[model] = max(until, _limited_until.get(model, 0))
+    metrics.incr(f'model.{model}.rate_limited')
+
+
+def headroom(model: str) -> str:
+    """'' when model can take calls, else why not ('rate_limited' or 'slow')."""
+    with _lock:
+        if _limited_until.get(model, 0) > time.time():
+            return 'rate_limited'
+    if ROUTE_SLOW_MS and metrics.recent_percentile(
+            f'model.{model}_ms', 95, min_samples=ROUTE_SLOW_MIN_SAMPLES) > ROUTE_SLOW_MS:
+        return 'slow'
+    return ''
+
+
+def available(model: str) -> tuple:
+    """(model to call, reason) - model itself, or its fallback while it has no headroom."""
+    why = headroom(model)
+    alt = ROUTE_FALLBACKS.get(model)
+    if why and alt and not headroom(alt):
+        return alt, f'{model} {why}'
+    return model, ''
+
+
+def route(scenario: str = '', image: bool = False, web: bool = False, cited: bool = False,
+          messages: list = None) -> dict:
+    """{'name', 'model', 'max_tokens', 'temperature', 'reason'} for one answer completion."""
+    temperature = 0.2 if web or cited else 0.7
+    if not ROUTING:
+        model = ROUTE_VISION_MODEL if image else ROUTE_TEXT_MODEL
+        return {'name': 'fixed', 'model': model, 'max_tokens': ROUTE_CITED_MAX_TOKENS if cited else 500,
+                'temperature': temperature, 'reason': 'routing off'}
+    if cited:
+        name, max_tokens = 'cited', ROUTE_CITED_MAX_TOKENS
+    elif scenario in ROUTE_SHORT_SCENARIOS:
+        # A phone number or an opening time needs no essay, with or without a page
+        name, max_tokens = 'short', ROUTE_SHORT_MAX_TOKENS
+    elif web:
+        name, max_tokens = 'web', ROUTE_WEB_MAX_TOKENS
+    else:
+        name, max_tokens = 'chat', ROUTE_MAX_TOKENS
+    reason = name
+    if image:
+        # Only vision models can read the image: no fallback
+        return {'name': 'vision', 'model': ROUTE_VISION_MODEL, 'max_tokens': max_tokens,
+                'temperature': temperature, 'reason': 'image'}
+    model = ROUTE_TEXT_MODEL
+    if prompt_tokens(messages) > ROUTE_LONG_PROMPT_TOKENS:
+        model, reason = ROUTE_LONG_MODEL, f'{name}, long prompt'
+    model, why = available(model)
+    if why:
+        metrics.incr(f'route.{name}.fallback')
+        reason = f'{reason}, {why}'
+    return {'name': name, 'model': model, 'max_tokens': max_tokens, 'temperature': temperature, 'reason': reason}
+
+
+def record(rt: dict, ms: float, response=None):
+    """Count one completed call of route rt: latency per route and model, token usage when reported."""
+    name, model = rt['name'], rt['model']
+    metrics.incr(f'route.{name}.calls')
+    metrics.observe(f'route.{name}_ms', ms, per_request=False)
+    metrics.observe(f'model.{model}_ms', ms, per_request=False)
+    usage = getattr(response, 'usage', None) or {}
+    try:
+        prompt, completion = int(usage.get('prompt_tokens') or 0), int(usage.get('completion_tokens') or 0)
+    except (AttributeError, TypeError, ValueError):
+        return
+    metrics.incr(f'route.{name}.prompt_tokens', prompt)
+    metrics.incr(f'route.{name}.completion_tokens', completion)
+    metrics.incr(f'model.{model}.tokens', prompt + completion)
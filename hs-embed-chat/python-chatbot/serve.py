@@ -0,0 +1,98 @@
+"""
+Production launcher: runs the chatbot under gunicorn with several workers.
+
+    python serve.py                                  # gthread workers, port $PORT (8080)
+    WEB_WORKERS=4 WEB_THREADS=32 python serve.py
+    WEB_WORKER_CLASS=gevent python serve.py          # greenlets; needs `pip install gevent`
+
+The app is imported once in the master (preload), so prompts, regexes and the
+scenario tables are built before fork and shared copy-on-write. Per-process
+state (page cache warmer, link prefetcher, hedge pool, metrics) starts in each
+worker right after fork. On SIGTERM/SIGINT workers stop accepting connections
+and finish in-flight requests for up to WEB_GRACEFUL_TIMEOUT seconds.
+"""
+
+import os
+
+WEB_WORKER_CLASS = os.getenv('WEB_WORKER_CLASS', 'gthread')
+
+if WEB_WORKER_CLASS == 'gevent':
+    # Must run before requests/urllib3/threading are imported by the preloaded app
+    from gevent import monkey
+    monkey.patch_all()
+
+from gunicorn.app.base import BaseApplication  # noqa: E402
+
+HOST = os.getenv('HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+# Every worker keeps its own page cache, ranking corpus and metrics: prefer few workers, many connections
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Requests one gthread worker serves at once; above ADMISSION_MAX_ACTIVE + ADMISSION_QUEUE_MAX
+# so overload is shed with a quick answer instead of waiting in gunicorn's accept queue
+WEB_THREADS = int(os.getenv('WEB_THREADS', '64'))
+# Open connections per worker (gevent: concurrent requests; gthread: including idle keep-alives)
+WEB_WORKER_CONNECTIONS = int(os.getenv('WEB_WORKER_CONNECTIONS', '200'))
+# A worker that stops heartbeating this long is restarted; covers the slowest search + OpenAI path
+WEB_TIMEOUT = int(os.getenv('WEB_TIMEOUT', '120'))
+WEB_GRACEFUL_TIMEOUT = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+WEB_KEEPALIVE = int(os.getenv('WEB_KEEPALIVE', '5'))
+WEB_BACKLOG = int(os.getenv('WEB_BACKLOG', '2048'))
+# Recycle a worker after this many requests (0 = never), jittered so they do not restart together
+WEB_MAX_REQUESTS = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+WEB_LOG_LEVEL = os.getenv('WEB_LOG_LEVEL', 'info')
+
+
+def _post_fork(server, worker):
+    import app
+    app.start_background_workers()
+
+
+def _worker_int(worker):
+    worker.log.info(f"[serve] worker {worker.pid} interrupted, finishing in-flight requests")
+
+
+def _worker_exit(server, worker):
+    server.log.info(f"[serve] worker {worker.pid} exited")
+
+
+def options() -> dict:
+    return {
+        'bind': f"{HOST}:{PORT}",
+        'workers': WEB_WORKERS,
+        'worker_class': WEB_WORKER_CLASS,
+        'threads': WEB_THREADS,
+        'worker_connections': WEB_WORKER_CONNECTIONS,
+        'timeout': WEB_TIMEOUT,
+        'graceful_timeout': WEB_GRACEFUL_TIMEOUT,
+        'keepalive': WEB_KEEPALIVE,
+        'backlog': WEB_BACKLOG,
+        'max_requests': WEB_MAX_REQUESTS,
+        'max_requests_jitter': WEB_MAX_REQUESTS // 10,
+        'preload_app': True,
+        'accesslog': '-',
+        'errorlog': '-',
+        'loglevel': WEB_LOG_LEVEL,
+        'post_fork': _post_fork,
+        'worker_int': _worker_int,
+        'worker_exit': _worker_exit,
+    }
+
+
+class ChatbotServer(BaseApplication):
+    def __init__(self, opts: dict):
+        self.opts = opts
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.opts.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # Background threads would only run in the master; each worker starts its own in post_fork
+        os.environ['BACKGROUND_WORKERS_ON_IMPORT'] = '0'
+        import app
+        return app.app
+
+
+if __name__ == '__main__':
+    ChatbotServer(options()).run()
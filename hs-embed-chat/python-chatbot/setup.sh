@@ -43,6 +43,6 @@ echo ""
 echo "Next steps:"
 echo "1. Edit .env and add your OpenAI API key"
 echo "2. Run: source venv/bin/activate"
-echo "3. Run: python app.py"
+echo "3. Run: python app.py  (production: python serve.py)"
 echo "4. Open: http://localhost:5000"
 echo ""
@@ -10,6 +10,8 @@ const clearChatButton = document.getElementById('clearChatButton');
 // Store conversation history
 let conversationHistory = [];
 let activeScenario = '';
+// Per-tab id so the server can budget background work per conversation
+const sessionId = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : String(Date.now()) + Math.random().toString(16).slice(2);
 let pendingFile = null; // holds selected or dropped file until user presses Send
 let pendingImageDataUrl = ''; // cached Data URL for preview and sending
 
@@ -200,7 +202,8 @@ async function sendMessage() {
                 message: message,
                 image: imageDataUrl,
                 history: conversationHistory,
-                active_scenario: activeScenario
+                active_scenario: activeScenario,
+                session_id: sessionId
             })
         });
         
@@ -209,22 +212,24 @@ async function sendMessage() {
         // Remove loading indicator
         removeLoading(loadingId);
         
-        if (!response.ok) {
+        if (!response.ok && !data.degraded) {
             addMessage(data.response || 'Sorry, an error occurred.', 'assistant');
             return;
         }
         
-        // Add to conversation history
-        if (message) {
+        // Add to conversation history (not a stand-in answer from an overloaded server, so the question can be asked again)
+        if (!data.degraded) {
+            if (message) {
+                conversationHistory.push({
+                    role: 'user',
+                    content: message
+                });
+            }
             conversationHistory.push({
-                role: 'user',
-                content: message
+                role: 'assistant',
+                content: data.response
             });
         }
-        conversationHistory.push({
-            role: 'assistant',
-            content: data.response
-        });
         
         // If backend activated a scenario this turn, remember it
         if (data && data.data && data.data.active_scenario) {
@@ -0,0 +1,32 @@
+"""
+Point the app at the offline stubs (bench/stubs.py) before it is imported.
+
+Run from hs-embed-chat/python-chatbot: python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from bench.stubs import StubConfig, app_env, start_stubs  # noqa: E402
+
+_stubs = start_stubs(StubConfig(latency_ms={'openai': 5, 'search': 5, 'reader': 5, 'site': 5}, jitter=0))
+os.environ.update(app_env(_stubs.base_url))
+# No background page fetching while testing
+os.environ.setdefault('CACHE_WARMER', '0')
+os.environ.setdefault('PREFETCH_LINKS', '0')
+
+import openai  # noqa: E402
+
+openai.api_base = os.environ['OPENAI_API_BASE']
+
+import app as chat_app  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return chat_app.app.test_client()
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import batch
+
+
+def test_concurrent_batches_share_the_parallel_cap():
+    lock = threading.Lock()
+    running = {'now': 0, 'max': 0}
+
+    def turn(payload):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        time.sleep(0.02)
+        with lock:
+            running['now'] -= 1
+        return 200, {'response': 'ok'}, {}
+
+    items = [{'id': i, 'message': f'question {i}'} for i in range(3 * batch.BATCH_MAX_PARALLEL)]
+    summaries = []
+
+    def run_one():
+        summaries.append(list(batch.run(items, turn, batch.BATCH_MAX_PARALLEL))[-1]['summary'])
+
+    threads = [threading.Thread(target=run_one) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=30)
+    assert [s['turns'] for s in summaries] == [len(items), len(items)]
+    assert running['max'] <= batch.BATCH_MAX_PARALLEL
+    assert batch.BATCH_MAX_PARALLEL < batch.admission.ADMISSION_MAX_ACTIVE
+
+
+def test_closed_batch_frees_waiting_items():
+    items = [{'id': i, 'message': 'q'} for i in range(batch.BATCH_MAX_PARALLEL + 4)]
+    gen = batch.run(items, lambda payload: (time.sleep(0.01), (200, {'response': 'ok'}, {}))[1], 2)
+    next(gen)
+    gen.close()
+    # Every slot comes back once the started items finish
+    deadline = time.monotonic() + 5
+    while batch._slots._value < batch.BATCH_MAX_PARALLEL and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert batch._slots._value == batch.BATCH_MAX_PARALLEL
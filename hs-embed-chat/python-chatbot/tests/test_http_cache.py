@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+import http_cache
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _sha(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def test_versioned_static_file_is_immutable(client):
+    version = http_cache.static_version(os.path.join(APP_DIR, 'static'), 'css/style.css')
+    assert version
+    r = client.get(f'/static/css/style.css?v={version}')
+    assert r.status_code == 200
+    assert 'immutable' in r.headers['Cache-Control']
+
+
+def test_traversal_is_not_hashed_or_cached(client):
+    http_cache.clear()
+    r = client.get(f'/static/../app.py?v={_sha(os.path.join(APP_DIR, "app.py"))}')
+    assert r.status_code == 404
+    assert 'immutable' not in r.headers.get('Cache-Control', '')
+    assert not http_cache._versions
+    assert http_cache.static_version(os.path.join(APP_DIR, 'static'), '../app.py') == ''
+
+
+def test_missing_static_file_with_version_is_not_cached(client):
+    http_cache.clear()
+    r = client.get('/static/no-such-file.js?v=0123456789ab')
+    assert r.status_code == 404
+    assert 'immutable' not in r.headers.get('Cache-Control', '')
+    assert not http_cache._versions
+
+
+def test_device_files_are_not_hashed():
+    assert http_cache.static_version('/dev', 'zero') == ''
@@ -0,0 +1,30 @@
+import openai
+from openai.openai_object import OpenAIObject
+
+import app as chat_app
+
+
+def _completion(arguments: str):
+    return OpenAIObject.construct_from({
+        'choices': [{'index': 0, 'finish_reason': 'length', 'message': {
+            'role': 'assistant', 'content': None,
+            'function_call': {'name': 'reply', 'arguments': arguments}}}],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 50, 'total_tokens': 150},
+    })
+
+
+def test_parse_reply_truncated_without_label():
+    message = _completion('{"answer": "Tuition is 29,000 EUR per ye')['choices'][0]['message']
+    assert chat_app.parse_reply(message) == ('Tuition is 29,000 EUR per ye', '')
+
+
+def test_label_less_reply_keeps_active_scenario(client, monkeypatch):
+    monkeypatch.setattr(chat_app, 'SINGLE_CALL_CLASSIFY', True)
+    monkeypatch.setattr(openai.ChatCompletion, 'create',
+                        lambda **kwargs: _completion('{"answer": "It is 29,000 EUR per year for most master'))
+    r = client.post('/api/chat', json={'message': 'And how much is it?', 'active_scenario': 'finance',
+                                       'history': [{'role': 'user', 'content': 'What are the tuition fees?'},
+                                                   {'role': 'assistant', 'content': 'They depend on the programme.'}]})
+    assert r.status_code == 200
+    assert r.json['response'].startswith('It is 29,000 EUR per year for most master')
+    assert r.json['data']['active_scenario'] == 'finance'